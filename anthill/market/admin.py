@@ -8,7 +8,6 @@ from . model.item import ItemError, NoItemError
 from . model.market import MarketError, NoMarketError
 from . model.order import OrderQuery, OrderQueryError, OrderError, NoOrderError
 
-import math
 import ujson
 
 
@@ -229,7 +228,7 @@ class MarketOrdersAdminController(a.AdminController):
                 a.link("markets", "Markets"),
                 a.link("market", data["market_name"], market_id=self.context.get("market_id"))
             ], "Orders"),
-            a.content("Orders", [
+            a.content("Orders (about {0})".format(data["total"]), [
                 {
                     "id": "id",
                     "title": "ID"
@@ -267,7 +266,11 @@ class MarketOrdersAdminController(a.AdminController):
                     "id": "deadline",
                     "title": "Deadline"
                 }], orders, "default", empty="No orders to display."),
-            a.pages(data["pages"]),
+            a.links("Pages", [
+                a.link("market_orders", "First page", icon="fast-backward", **data["filters"]),
+            ] + ([
+                a.link("market_orders", "Next page", icon="forward", cursor=data["next_cursor"], **data["filters"])
+            ] if data["next_cursor"] else [])),
             a.form("Filters", fields={
                 "order_owner":
                     a.field("Seller", "text", "primary", order=1),
@@ -302,25 +305,20 @@ class MarketOrdersAdminController(a.AdminController):
     async def filter(self, **args):
 
         market_id = self.context.get("market_id")
-        page = self.context.get("page", 1)
 
         filters = {
-            "page": page
-        }
-
-        filters.update({
             k: v for k, v in args.items() if v not in ["0", "any"]
-        })
+        }
 
         raise a.Redirect("market_orders", market_id=market_id, **filters)
 
-    @validate(market_id="int", page="int", order_owner="int",
+    @validate(market_id="int", cursor="str", order_owner="int",
               order_give_item="str_name", order_give_payload="load_json_dict",
               order_give_amount="int", order_give_amount_comparison="str", order_take_item="str_name",
               order_take_payload="load_json_dict", order_take_amount="int", order_take_amount_comparison="str")
     async def get(self,
                   market_id,
-                  page=1,
+                  cursor=None,
                   order_owner=None,
                   order_give_item=None,
                   order_give_payload=None,
@@ -338,13 +336,11 @@ class MarketOrdersAdminController(a.AdminController):
         except NoMarketError:
             raise a.ActionError("No such market")
 
-        page = to_int(page)
-
         orders = self.application.orders
 
         q = orders.orders_query(self.gamespace, market_id)
 
-        q.offset = (page - 1) * MarketOrdersAdminController.ORDERS_PER_PAGE
+        q.cursor = cursor
         q.limit = MarketOrdersAdminController.ORDERS_PER_PAGE
 
         q.order_owner = order_owner
@@ -361,12 +357,30 @@ class MarketOrdersAdminController(a.AdminController):
             q.take_amount = order_take_amount
             q.take_amount_comparison = order_take_amount_comparison
 
-        orders, count = await q.query(count=True)
-        pages = int(math.ceil(float(count) / float(MarketOrdersAdminController.ORDERS_PER_PAGE)))
+        try:
+            orders = await q.query()
+            total = await q.count()
+        except OrderQueryError as e:
+            raise a.ActionError("Cannot query orders: {0}".format(e.message))
+
+        filters = {
+            "market_id": market_id,
+            "order_owner": order_owner,
+            "order_give_item": order_give_item,
+            "order_give_payload": ujson.dumps(order_give_payload) if order_give_payload else None,
+            "order_give_amount": order_give_amount,
+            "order_give_amount_comparison": order_give_amount_comparison,
+            "order_take_item": order_take_item,
+            "order_take_payload": ujson.dumps(order_take_payload) if order_take_payload else None,
+            "order_take_amount": order_take_amount,
+            "order_take_amount_comparison": order_take_amount_comparison
+        }
 
         return {
             "orders": orders,
-            "pages": pages,
+            "total": total,
+            "next_cursor": q.next_cursor,
+            "filters": {k: v for k, v in filters.items() if v is not None},
             "order_owner": order_owner or "0",
             "order_give_item": order_give_item or "0",
             "order_give_payload": order_give_payload or {},
@@ -509,7 +523,7 @@ class OrderAdminController(a.AdminController):
         except OrderError as e:
             raise a.ActionError("Cannot update order: {0}".format(e.message))
 
-        if await self.application.orders.fulfill_order(order_id, self.gamespace, order.order_id, order.market_id):
+        if await self.application.orders.fulfill_order(order_id, self.gamespace, order.owner_id, order.market_id):
             raise a.Redirect("market_orders",
                              message="Order has been updated and then got fulfilled",
                              market_id=order.market_id)
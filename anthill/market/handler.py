@@ -5,10 +5,12 @@ from anthill.common.access import scoped, AccessToken, remote_ip
 from anthill.common.handler import AuthenticatedHandler, AnthillRequestHandler
 from anthill.common.validate import ValidationError, validate, validate_value
 
-from . model.item import NoItemError, ItemError
+from . model.item import NoItemError, ItemError, ItemModel
 from . model.market import NoMarketError, MarketError
-from . model.order import NoOrderError, OrderError
+from . model.order import NoOrderError, OrderError, OrderQueryError
+from . model.transaction import TransactionError
 import logging
+import ujson
 
 
 class MarketHandler(AuthenticatedHandler):
@@ -20,26 +22,86 @@ class MarketHandler(AuthenticatedHandler):
         except MarketError as e:
             raise HTTPError(400, e.message)
 
-    def dump_orders(self, orders):
-        self.dumps({
+    def get_pair(self):
+        """
+        Returns (give_item, give_payload, take_item, take_payload) from the request arguments
+        """
+        try:
+            return (
+                validate_value(self.get_argument("give_item"), "str_name"),
+                validate_value(self.get_argument("give_payload", "{}"), "load_json_dict"),
+                validate_value(self.get_argument("take_item"), "str_name"),
+                validate_value(self.get_argument("take_payload", "{}"), "load_json_dict"))
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+    @staticmethod
+    def dump_order(order):
+        return {
+            "order_id": str(order.order_id),
+            "owner_id": order.owner_id,
+            "give_item": order.give_item,
+            "give_payload": order.give_payload,
+            "give_amount": order.give_amount,
+            "take_item": order.take_item,
+            "take_payload": order.take_payload,
+            "take_amount": order.take_amount,
+            "time": str(order.time),
+            "available": order.available,
+            "payload": order.payload,
+            "deadline": str(order.deadline),
+        }
+
+    def dump_orders(self, orders, **extra):
+        result = {
             "orders": [
-                {
-                    "order_id": str(order.order_id),
-                    "owner_id": order.owner_id,
-                    "give_item": order.give_item,
-                    "give_payload": order.give_payload,
-                    "give_amount": int(order.give_amount),
-                    "take_item": order.take_item,
-                    "take_payload": order.take_payload,
-                    "take_amount": int(order.take_amount),
-                    "time": str(order.time),
-                    "available": int(order.available),
-                    "payload": order.payload,
-                    "deadline": str(order.deadline),
-                }
+                MarketHandler.dump_order(order)
                 for order in orders
             ]
-        })
+        }
+        result.update(extra)
+        self.dumps(result)
+
+    async def stream_orders(self, query, chunk_size, **extra):
+        """
+        Writes the same response as dump_orders does, but chunk by chunk as the orders are read
+        """
+        started = False
+
+        try:
+            async for orders in query.stream(chunk_size):
+                chunk = ",".join(
+                    ujson.dumps(MarketHandler.dump_order(order), escape_forward_slashes=False)
+                    for order in orders)
+
+                if started:
+                    self.write(",")
+                else:
+                    self.set_header("Content-Type", "application/json")
+                    self.write('{"orders":[')
+                    started = True
+
+                self.write(chunk)
+                await self.flush()
+        except Exception:
+            if not started:
+                raise
+
+            # the status has been sent already, so the only way to tell the response is broken is to cut it off
+            logging.exception("Failed to stream orders")
+            self.request.connection.close()
+            return
+
+        if not started:
+            self.set_header("Content-Type", "application/json")
+            self.write('{"orders":[')
+
+        if query.next_cursor:
+            extra["next_cursor"] = query.next_cursor
+
+        self.write("]" + "".join(
+            ",{0}:{1}".format(ujson.dumps(key), ujson.dumps(value, escape_forward_slashes=False))
+            for key, value in extra.items()) + "}")
 
 
 class MarketItemsHandler(MarketHandler):
@@ -126,7 +188,7 @@ class MarketItemHandler(MarketHandler):
             raise HTTPError(404, "No such item")
 
         self.dumps({
-            "amount": int(item.amount)
+            "amount": item.amount
         })
 
 
@@ -184,10 +246,12 @@ class UpdateMarketOrdersHandler(MarketHandler):
         give_amount = self.get_argument("give_amount", None)
         give_amount_comparison = self.get_argument("give_amount_comparison", None)
         give_payload = self.get_argument("give_payload", None)
+        give_payload_exact = self.get_argument("give_payload_exact", "false") == "true"
         take_item = self.get_argument("take_item", None)
         take_amount = self.get_argument("take_amount", None)
         take_amount_comparison = self.get_argument("take_amount_comparison", None)
         take_payload = self.get_argument("take_payload", None)
+        take_payload_exact = self.get_argument("take_payload_exact", "false") == "true"
         sort_by = self.get_argument("sort_by", "")
         if sort_by:
             sort_by = validate_value(sort_by, "str_name")
@@ -195,6 +259,8 @@ class UpdateMarketOrdersHandler(MarketHandler):
 
         q.offset = validate_value(self.get_argument("offset", "0"), "int")
         q.limit = min(validate_value(self.get_argument("limit", "1000"), "int"), 1000)
+        q.cursor = self.get_argument("cursor", None)
+        count = self.get_argument("count", "false") == "true"
 
         if owner_id:
             q.owner = validate_value(owner_id, "int")
@@ -202,6 +268,7 @@ class UpdateMarketOrdersHandler(MarketHandler):
             q.give_item = validate_value(give_item, "str_name")
         if give_payload:
             q.give_payload = validate_value(give_payload, "load_json_dict_of_primitives")
+        q.give_payload_exact = give_payload_exact
         if give_amount and give_amount_comparison:
             q.give_amount = validate_value(give_amount, "str_name")
             q.give_amount_comparison = validate_value(give_amount_comparison, "str")
@@ -209,6 +276,7 @@ class UpdateMarketOrdersHandler(MarketHandler):
             q.take_item = validate_value(take_item, "str_name")
         if take_payload:
             q.take_payload = validate_value(take_payload, "load_json_dict_of_primitives")
+        q.take_payload_exact = take_payload_exact
         if take_amount and take_amount_comparison:
             q.take_amount = validate_value(take_amount, "str_name")
             q.take_amount_comparison = validate_value(take_amount_comparison, "str")
@@ -216,12 +284,59 @@ class UpdateMarketOrdersHandler(MarketHandler):
         q.sort_by = sort_by
         q.sort_desc = sort_desc
 
+        extra = {}
+        chunk_size = self.application.orders_stream_chunk
+
         try:
+            if count:
+                extra["total"] = await q.count()
+
+            if chunk_size:
+                await self.stream_orders(q, chunk_size, **extra)
+                return
+
             orders = await q.query()
+        except (OrderError, OrderQueryError) as e:
+            raise HTTPError(e.code, e.message)
+
+        if q.next_cursor:
+            extra["next_cursor"] = q.next_cursor
+
+        self.dump_orders(orders, **extra)
+
+
+class MarketOrdersBatchHandler(MarketHandler):
+    @scoped(["market", "market_post_order"])
+    async def post(self, market_name):
+        try:
+            orders = validate_value(self.get_argument("orders"), "load_json")
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+        if not isinstance(orders, list):
+            raise HTTPError(400, "Orders should be a list")
+
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+        market = await self.get_market(market_name)
+
+        try:
+            placed = await self.application.orders.new_orders(
+                gamespace_id, self.token.account, market.market_id, orders)
         except OrderError as e:
             raise HTTPError(e.code, e.message)
 
-        self.dump_orders(orders)
+        fulfilled = await self.application.orders.fulfill_orders(
+            gamespace_id, self.token.account, market.market_id, placed)
+
+        self.dumps({
+            "orders": [
+                {
+                    "order_id": str(order_id),
+                    "fulfilled_immediately": fulfilled[order_id]
+                }
+                for order_id, order in placed
+            ]
+        })
 
 
 class UpdateMarketMyOrdersHandler(MarketHandler):
@@ -262,11 +377,11 @@ class OrderHandler(MarketHandler):
             "owner_id": str(order.owner_id),
             "give_item": order.give_item,
             "give_payload": order.give_payload,
-            "give_amount": int(order.give_amount),
+            "give_amount": order.give_amount,
             "take_item": order.take_item,
             "take_payload": order.take_payload,
-            "take_amount": int(order.take_amount),
-            "available": int(order.available),
+            "take_amount": order.take_amount,
+            "available": order.available,
             "time": str(order.time),
             "deadline": str(order.deadline)
         })
@@ -301,24 +416,187 @@ class DeleteOrderHandler(MarketHandler):
         gamespace_id = self.token.get(AccessToken.GAMESPACE)
         market = await self.get_market(market_name)
 
+        # the order is checked once locked, so it's not read twice
+        owner_id = None if self.token.has_scopes(["market_delete_order"]) else self.token.account
+
         try:
-            order = await self.application.orders.get_order(
-                gamespace_id, order_id)
+            await self.application.orders.delete_order(
+                gamespace_id, order_id, market_id=market.market_id, owner_id=owner_id)
         except OrderError as e:
             raise HTTPError(e.code, e.message)
+        except NoOrderError:
+            raise HTTPError(404, "No such order")
 
-        if (str(order.owner_id) != str(self.token.account)) and (not self.token.has_scopes(["market_delete_order"])):
-            raise HTTPError(409, "The order has not been created by you.")
 
-        if str(order.market_id) != str(market.market_id):
-            raise HTTPError(409, "The order does not belong to the market")
+class MarketOrdersCancelHandler(MarketHandler):
+    @scoped(["market", "market_post_order"])
+    async def post(self, market_name):
+        """
+        Cancels the orders listed in `orders`, or, if omitted, every order of the caller in the market
+        (of a single pair, if `give_item` and `take_item` are passed)
+        """
+        try:
+            order_ids = self.get_argument("orders", None)
+            if order_ids is not None:
+                order_ids = validate_value(validate_value(order_ids, "load_json"), "json_list_of_ints")
+            give_item = self.get_argument("give_item", None)
+            if give_item is not None:
+                give_item = validate_value(give_item, "str_name")
+            take_item = self.get_argument("take_item", None)
+            if take_item is not None:
+                take_item = validate_value(take_item, "str_name")
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+        market = await self.get_market(market_name)
+
+        # with the listed orders, the admins may cancel anyone's
+        if order_ids is not None and self.token.has_scopes(["market_delete_order"]):
+            owner_id = None
+        else:
+            owner_id = self.token.account
 
         try:
-            await self.application.orders.delete_order(
-                gamespace_id, order_id)
+            cancelled = await self.application.orders.delete_orders(
+                gamespace_id, market.market_id, owner_id=owner_id, order_ids=order_ids,
+                give_item=give_item, take_item=take_item)
+        except OrderError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "orders": [str(order.order_id) for order in cancelled]
+        })
+
+
+class MarketHistoryHandler(MarketHandler):
+    @scoped(["market"])
+    async def get(self, market_name):
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+        give_item, give_payload, take_item, take_payload = self.get_pair()
+
+        try:
+            period = validate_value(self.get_argument("period", "day"), "str_name")
+            limit = validate_value(self.get_argument("limit", "100"), "int")
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+        market = await self.get_market(market_name)
+
+        async def history():
+            rollups = await self.application.transactions.list_history(
+                gamespace_id, market.market_id, give_item, give_payload, take_item, take_payload,
+                period=period, limit=limit)
+
+            return {
+                "history": [
+                    {
+                        "time": str(rollup.start),
+                        "open": rollup.open,
+                        "high": rollup.high,
+                        "low": rollup.low,
+                        "close": rollup.close,
+                        "give_volume": rollup.give_volume,
+                        "take_volume": rollup.take_volume,
+                        "amount": rollup.amount,
+                        "trades": rollup.trades
+                    }
+                    for rollup in rollups
+                ]
+            }
+
+        key = "history:{0}:{1}:{2}:{3}:{4}:{5}".format(
+            gamespace_id, market.market_id, ItemModel.item_hash(give_item, give_payload),
+            ItemModel.item_hash(take_item, take_payload), period, limit)
+
+        try:
+            result = await self.application.market_data.get(key, self.application.history_cache_ttl, history)
+        except TransactionError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps(result)
+
+
+class MarketTickerHandler(MarketHandler):
+    @scoped(["market"])
+    async def get(self, market_name):
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+        give_item, give_payload, take_item, take_payload = self.get_pair()
+        market = await self.get_market(market_name)
+
+        async def ticker():
+            last_price, day = await self.application.transactions.get_ticker(
+                gamespace_id, market.market_id, give_item, give_payload, take_item, take_payload)
+            bid, ask = await self.application.orders.best_prices(
+                gamespace_id, market.market_id, give_item, give_payload, take_item, take_payload)
+
+            return {
+                "last_price": last_price,
+                "bid": bid,
+                "ask": ask,
+                "open_24h": day.open if day else None,
+                "high_24h": day.high if day else None,
+                "low_24h": day.low if day else None,
+                "give_volume_24h": day.give_volume if day else 0,
+                "take_volume_24h": day.take_volume if day else 0,
+                "amount_24h": day.amount if day else 0,
+                "trades_24h": day.trades if day else 0
+            }
+
+        key = "ticker:{0}:{1}:{2}:{3}".format(
+            gamespace_id, market.market_id, ItemModel.item_hash(give_item, give_payload),
+            ItemModel.item_hash(take_item, take_payload))
+
+        try:
+            result = await self.application.market_data.get(key, self.application.ticker_cache_ttl, ticker)
+        except (TransactionError, OrderError) as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps(result)
+
+
+class MarketDepthHandler(MarketHandler):
+    @scoped(["market"])
+    async def get(self, market_name):
+        gamespace_id = self.token.get(AccessToken.GAMESPACE)
+        give_item, give_payload, take_item, take_payload = self.get_pair()
+
+        try:
+            limit = validate_value(self.get_argument("limit", "20"), "int")
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+        market = await self.get_market(market_name)
+
+        async def depth():
+            bids, asks = await self.application.orders.depth(
+                gamespace_id, market.market_id, give_item, give_payload, take_item, take_payload, limit=limit)
+
+            return {
+                side: [
+                    {
+                        "price": level.price,
+                        "give_amount": level.give_amount,
+                        "take_amount": level.take_amount,
+                        "available": level.available,
+                        "orders": level.orders
+                    }
+                    for level in levels
+                ]
+                for side, levels in (("bids", bids), ("asks", asks))
+            }
+
+        key = "depth:{0}:{1}:{2}:{3}:{4}".format(
+            gamespace_id, market.market_id, ItemModel.item_hash(give_item, give_payload),
+            ItemModel.item_hash(take_item, take_payload), limit)
+
+        try:
+            result = await self.application.market_data.get(key, self.application.depth_cache_ttl, depth)
         except OrderError as e:
             raise HTTPError(e.code, e.message)
 
+        self.dumps(result)
+
 
 class GetMarketHandler(MarketHandler):
     @scoped(["market"])
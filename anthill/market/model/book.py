@@ -0,0 +1,458 @@
+
+from .item import ItemModel
+
+from bisect import bisect_left, bisect_right, insort
+from heapq import merge
+
+import asyncio
+import logging
+import uuid
+
+
+def payload_contains(target, candidate):
+    """
+    Mirrors MySQL's JSON_CONTAINS(target, candidate) for the payloads orders carry
+    """
+    if isinstance(candidate, dict):
+        if not isinstance(target, dict):
+            return False
+        for key, value in candidate.items():
+            if key not in target or not payload_contains(target[key], value):
+                return False
+        return True
+
+    if isinstance(candidate, list):
+        if not isinstance(target, list):
+            return False
+        return all(any(payload_contains(t, value) for t in target) for value in candidate)
+
+    if isinstance(target, list):
+        return any(payload_contains(t, candidate) for t in target)
+
+    # JSON booleans are not numbers (while Python's are), so true is not 1
+    if isinstance(target, bool) or isinstance(candidate, bool):
+        return isinstance(target, bool) and isinstance(candidate, bool) and target == candidate
+
+    return target == candidate
+
+
+class OrderBook(object):
+    """
+    Resident orders of a single (give item, give payload, take item, take payload) pair.
+
+    Orders are kept sorted exactly like the matching query sorts them: by the take amount (cheapest first),
+    then by the give amount, then newest first (order_id is used in place of order_time since
+    it grows together with it).
+    """
+
+    def __init__(self, give_item, give_payload, take_item, take_payload):
+        self.give_item = give_item
+        self.give_payload = give_payload or {}
+        self.take_item = take_item
+        self.take_payload = take_payload or {}
+
+        # sorted list of (take_amount, give_amount, -order_id)
+        self.levels = []
+        # order_id -> [key, owner_id, available]
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, order_id, owner_id, give_amount, take_amount, available):
+        if order_id in self.orders:
+            self.remove(order_id)
+
+        key = (take_amount, give_amount, -order_id)
+        insort(self.levels, key)
+        self.orders[order_id] = [key, owner_id, available]
+
+    def remove(self, order_id):
+        entry = self.orders.pop(order_id, None)
+        if entry is None:
+            return
+
+        key = entry[0]
+        index = bisect_left(self.levels, key)
+        if index < len(self.levels) and self.levels[index] == key:
+            del self.levels[index]
+
+    def update(self, order_id, available):
+        entry = self.orders.get(order_id)
+        if entry is None:
+            return
+
+        if available <= 0:
+            self.remove(order_id)
+        else:
+            entry[2] = available
+
+    def match(self, max_take_amount, min_give_amount, exclude_owner):
+        """
+        Yields (key, order_id, available) of orders that take no more than max_take_amount and
+        give at least min_give_amount, in matching order.
+        """
+        end = bisect_right(self.levels, (max_take_amount, float("inf")))
+
+        for index in range(0, end):
+            key = self.levels[index]
+            take_amount, give_amount, order_id = key
+            if give_amount < min_give_amount:
+                continue
+            order_id = -order_id
+            _, owner_id, available = self.orders[order_id]
+            if owner_id == exclude_owner:
+                continue
+            yield key, order_id, available
+
+
+class OrderBooks(object):
+    """
+    In-memory order books of every market, used to find counter-orders without scanning the `orders` table.
+    The table stays the source of truth: books are rebuilt from it on startup, and every row
+    picked from a book is re-checked (and locked) by the database before being matched.
+
+    Every change made through add_order, update_order and the remove_* methods is also written into
+    the journal, so it can be shared with the other nodes (see OrderBooksFeed), which apply it as is.
+    Books should only be used while `synced`, otherwise they may be missing orders.
+    """
+
+    def __init__(self):
+        # (gamespace_id, market_id, give_hash, take_hash) -> OrderBook
+        self.books = {}
+        # (gamespace_id, market_id, give_item, take_item) -> set of book keys
+        self.pairs = {}
+        # order_id -> book key
+        self.index = {}
+        # changes not shared yet, as lists of the operation name and its arguments
+        self.journal = []
+        # changes made while the books are being reloaded, to be made again once they are
+        self.replay = None
+        # called once something is written into the journal
+        self.changed = None
+        self.synced = False
+
+    def __record__(self, *op):
+        op = list(op)
+        self.journal.append(op)
+        if self.replay is not None:
+            self.replay.append(op)
+        if self.changed is not None:
+            self.changed()
+
+    def drain(self):
+        """
+        Returns the journal and starts a new one
+        """
+        journal, self.journal = self.journal, []
+        return journal
+
+    def apply(self, ops):
+        """
+        Makes the changes journaled by another node, without journaling them again
+        """
+        for op in ops:
+            name, args = op[0], op[1:]
+            if name == "add":
+                self.__add_order__(*args)
+            elif name == "update":
+                self.__update_order__(*args)
+            elif name == "remove":
+                self.__remove_order__(*args)
+            elif name == "remove_owners":
+                self.__remove_owners__(*args)
+            elif name == "remove_market":
+                self.__remove_market__(*args)
+            else:
+                logging.warning("Unknown order book change: {0}".format(name))
+
+    def reset(self, orders):
+        """
+        Replaces the contents of the books with orders, a list of (gamespace_id, order)
+        """
+        self.books = {}
+        self.pairs = {}
+        self.index = {}
+
+        for gamespace_id, order in orders:
+            self.__add_order__(
+                gamespace_id, order.market_id, order.order_id, order.owner_id,
+                order.give_item, order.give_payload, order.give_amount,
+                order.take_item, order.take_payload, order.take_amount, order.available)
+
+    def __book__(self, gamespace_id, market_id, give_item, give_payload, take_item, take_payload):
+        key = (
+            int(gamespace_id), int(market_id),
+            ItemModel.item_hash(give_item, give_payload or {}),
+            ItemModel.item_hash(take_item, take_payload or {}))
+
+        book = self.books.get(key)
+        if book is None:
+            book = OrderBook(give_item, give_payload, take_item, take_payload)
+            self.books[key] = book
+            self.pairs.setdefault((key[0], key[1], give_item, take_item), set()).add(key)
+
+        return key, book
+
+    def __drop_book__(self, key):
+        book = self.books.pop(key, None)
+        if book is None:
+            return
+
+        pair = (key[0], key[1], book.give_item, book.take_item)
+        keys = self.pairs.get(pair)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.pairs[pair]
+
+    def add_order(self, gamespace_id, order):
+        args = (
+            int(gamespace_id), int(order.market_id), int(order.order_id), int(order.owner_id),
+            order.give_item, order.give_payload or {}, order.give_amount,
+            order.take_item, order.take_payload or {}, order.take_amount, order.available)
+
+        self.__record__("add", *args)
+        self.__add_order__(*args)
+
+    def update_order(self, order_id, available):
+        self.__record__("update", int(order_id), available)
+        self.__update_order__(order_id, available)
+
+    def remove_order(self, order_id):
+        self.__record__("remove", int(order_id))
+        self.__remove_order__(order_id)
+
+    def remove_owners(self, gamespace_id, owners):
+        owners = list(map(int, owners))
+        self.__record__("remove_owners", None if gamespace_id is None else int(gamespace_id), owners)
+        self.__remove_owners__(gamespace_id, owners)
+
+    def remove_market(self, gamespace_id, market_id):
+        self.__record__("remove_market", int(gamespace_id), int(market_id))
+        self.__remove_market__(gamespace_id, market_id)
+
+    def __add_order__(self, gamespace_id, market_id, order_id, owner_id, give_item, give_payload, give_amount,
+                take_item, take_payload, take_amount, available):
+        order_id = int(order_id)
+
+        if available <= 0:
+            self.__remove_order__(order_id)
+            return
+
+        key, book = self.__book__(gamespace_id, market_id, give_item, give_payload, take_item, take_payload)
+
+        existing = self.index.get(order_id)
+        if existing is not None and existing != key:
+            self.__remove_order__(order_id)
+
+        book.add(order_id, int(owner_id), give_amount, take_amount, available)
+        self.index[order_id] = key
+
+    def __update_order__(self, order_id, available):
+        order_id = int(order_id)
+        key = self.index.get(order_id)
+        if key is None:
+            return
+
+        if available <= 0:
+            self.__remove_order__(order_id)
+        else:
+            self.books[key].update(order_id, available)
+
+    def __remove_order__(self, order_id):
+        order_id = int(order_id)
+        key = self.index.pop(order_id, None)
+        if key is None:
+            return
+
+        book = self.books[key]
+        book.remove(order_id)
+        if not book:
+            self.__drop_book__(key)
+
+    def __remove_owners__(self, gamespace_id, owners):
+        owners = set(map(int, owners))
+        for key, book in list(self.books.items()):
+            if gamespace_id is not None and key[0] != int(gamespace_id):
+                continue
+            for order_id, entry in list(book.orders.items()):
+                if entry[1] in owners:
+                    self.__remove_order__(order_id)
+
+    def __remove_market__(self, gamespace_id, market_id):
+        for key in [key for key in self.books if key[0] == int(gamespace_id) and key[1] == int(market_id)]:
+            for order_id in list(self.books[key].orders):
+                self.index.pop(order_id, None)
+            self.__drop_book__(key)
+
+    def candidates(self, gamespace_id, fulfill):
+        """
+        Returns ids of the counter-orders that may match the given order, best first,
+        and whether they are enough to fulfill the order completely.
+        Only as many orders as needed to fulfill the order completely are returned.
+        """
+        pair = (int(gamespace_id), int(fulfill.market_id), fulfill.take_item, fulfill.give_item)
+        keys = self.pairs.get(pair)
+        if not keys:
+            return [], False
+
+        give_payload = fulfill.give_payload or {}
+        take_payload = fulfill.take_payload or {}
+        owner_id = int(fulfill.owner_id)
+        max_take_amount = fulfill.give_amount
+        min_give_amount = fulfill.take_amount
+
+        books = [
+            self.books[key]
+            for key in keys
+            if payload_contains(give_payload, self.books[key].take_payload) and
+            payload_contains(self.books[key].give_payload, take_payload)
+        ]
+
+        needed = fulfill.available
+        result = []
+
+        for key, order_id, available in merge(*[
+                book.match(max_take_amount, min_give_amount, owner_id) for book in books]):
+            result.append(order_id)
+            needed -= available
+            if needed <= 0:
+                break
+
+        return result, needed <= 0
+
+    def levels(self, gamespace_id, market_id, give_hash, take_hash):
+        """
+        Returns orders of a pair aggregated by (give_amount, take_amount) as a dict of
+        (give_amount, take_amount) -> [available, orders]
+        """
+        book = self.books.get((int(gamespace_id), int(market_id), give_hash, take_hash))
+        if book is None:
+            return {}
+
+        levels = {}
+        for key, owner_id, available in book.orders.values():
+            take_amount, give_amount, order_id = key
+            level = levels.get((give_amount, take_amount))
+            if level is None:
+                levels[(give_amount, take_amount)] = [available, 1]
+            else:
+                level[0] += available
+                level[1] += 1
+
+        return levels
+
+
+class OrderBooksFeed(object):
+    """
+    Keeps the order books of every node in sync.
+
+    A node only sees the orders placed, matched or cancelled through it, so the changes it makes to its books
+    are published over Redis once the transactions behind them are committed, and the other nodes apply them.
+    Redis delivers messages in the order they were published, so the books of every node converge.
+
+    The books are (re)loaded from the database every time the node subscribes, since messages published
+    while the node was not subscribed are lost. Until that's done, the books are not `synced`.
+    """
+
+    CHANNEL = "markets:order_books"
+    RESUBSCRIBE_DELAY = 5
+    REPUBLISH_DELAY = 1
+
+    def __init__(self, app, books, load):
+        """
+        :param load: a coroutine function returning every resident order as a list of (gamespace_id, order),
+                     or None if it has failed
+        """
+        self.app = app
+        self.books = books
+        self.load = load
+        self.node = uuid.uuid4().hex
+        self.pending = asyncio.Event()
+        self.publisher = None
+        self.listener = None
+
+        books.changed = self.pending.set
+
+    def start(self):
+        if self.listener is None:
+            self.listener = asyncio.ensure_future(self.__listen__())
+        if self.publisher is None:
+            self.publisher = asyncio.ensure_future(self.__publish__())
+
+    async def stop(self):
+        for worker in (self.listener, self.publisher):
+            if worker is not None:
+                worker.cancel()
+
+        self.listener = None
+        self.publisher = None
+        self.books.synced = False
+
+    async def __resync__(self):
+        self.books.synced = False
+        # the changes this node makes in the meantime are lost with the old contents, so they are made again
+        self.books.replay = []
+
+        try:
+            orders = await self.load()
+            if orders is None:
+                raise RuntimeError("Failed to load order books")
+
+            self.books.reset(orders)
+            self.books.apply(self.books.replay)
+        finally:
+            self.books.replay = None
+
+        self.books.synced = True
+
+        logging.info("Loaded {0} order(s) into {1} order book(s)".format(
+            len(self.books.index), len(self.books.books)))
+
+    async def __listen__(self):
+        while True:
+            try:
+                async with self.app.cache.acquire() as kv:
+                    channel, = await kv.subscribe(OrderBooksFeed.CHANNEL)
+                    try:
+                        # the changes published while loading wait in the channel, and are applied after
+                        await self.__resync__()
+
+                        while await channel.wait_message():
+                            message = await channel.get_json()
+                            if message["node"] != self.node:
+                                self.books.apply(message["ops"])
+                    finally:
+                        self.books.synced = False
+                        await kv.unsubscribe(OrderBooksFeed.CHANNEL)
+            except asyncio.CancelledError:
+                return
+            except Exception:
+                logging.exception("Order books listener has failed, resubscribing")
+                self.books.synced = False
+                await asyncio.sleep(OrderBooksFeed.RESUBSCRIBE_DELAY)
+
+    async def __publish__(self):
+        while True:
+            await self.pending.wait()
+            self.pending.clear()
+
+            ops = self.books.drain()
+            if not ops:
+                continue
+
+            try:
+                async with self.app.cache.acquire() as kv:
+                    await kv.publish_json(OrderBooksFeed.CHANNEL, {
+                        "node": self.node,
+                        "ops": ops
+                    })
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Failed to publish order book changes, retrying")
+                # put them back in front of the ones made since, so the order is kept
+                self.books.journal[:0] = ops
+                await asyncio.sleep(OrderBooksFeed.REPUBLISH_DELAY)
+                self.pending.set()
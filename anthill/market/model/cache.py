@@ -0,0 +1,139 @@
+
+from collections import OrderedDict
+import asyncio
+import logging
+import time
+import ujson
+
+
+class LocalCache(object):
+    """
+    Process-local cache with both a time to live and a maximum size, least recently used entries
+    are evicted first.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        for key in [key for key, (expires, value) in self.entries.items() if predicate(key, value)]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+class SharedCache(object):
+    """
+    Short-lived JSON values shared by every node through Redis.
+    A missing value is computed once at a time per key: callers within the process wait for the same
+    computation, and a short lock makes the other nodes wait for the value to appear instead of
+    computing it as well.
+    """
+
+    LOCK_TIMEOUT = 5000
+    WAIT_TIMEOUT = 1.0
+    WAIT_STEP = 0.05
+
+    def __init__(self, app, prefix):
+        self.app = app
+        self.prefix = prefix
+        self.inflight = {}
+
+    async def get(self, key, ttl, compute):
+        """
+        Returns the cached value of the key, or caches what compute() returns for ttl seconds
+        """
+        key = self.prefix + key
+
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.__get__(key, ttl, compute))
+            future.add_done_callback(lambda f: self.inflight.pop(key, None))
+            self.inflight[key] = future
+
+        # a caller that goes away should not cancel the computation others wait for
+        return await asyncio.shield(future)
+
+    async def __read__(self, key):
+        async with self.app.cache.acquire() as kv:
+            cached = await kv.get(key, encoding="utf-8")
+        return None if cached is None else ujson.loads(cached)
+
+    async def __get__(self, key, ttl, compute):
+        lock = key + ":lock"
+
+        try:
+            cached = await self.__read__(key)
+            if cached is not None:
+                return cached
+
+            async with self.app.cache.acquire() as kv:
+                locked = await kv.set(lock, "1", pexpire=SharedCache.LOCK_TIMEOUT, exist=kv.SET_IF_NOT_EXIST)
+
+            if not locked:
+                waited = 0
+                while waited < SharedCache.WAIT_TIMEOUT:
+                    await asyncio.sleep(SharedCache.WAIT_STEP)
+                    waited += SharedCache.WAIT_STEP
+
+                    cached = await self.__read__(key)
+                    if cached is not None:
+                        return cached
+        except Exception:
+            logging.exception("Failed to read shared cache")
+            return await compute()
+
+        try:
+            value = await compute()
+        except Exception:
+            if locked:
+                await self.__unlock__(lock)
+            raise
+
+        try:
+            async with self.app.cache.acquire() as kv:
+                tr = kv.multi_exec()
+                tr.set(key, ujson.dumps(value), expire=ttl)
+                if locked:
+                    tr.delete(lock)
+                await tr.execute()
+        except Exception:
+            logging.exception("Failed to write shared cache")
+
+        return value
+
+    async def __unlock__(self, lock):
+        try:
+            async with self.app.cache.acquire() as kv:
+                await kv.delete(lock)
+        except Exception:
+            logging.exception("Failed to release shared cache lock")
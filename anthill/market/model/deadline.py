@@ -0,0 +1,80 @@
+
+from tornado.ioloop import IOLoop
+
+from datetime import datetime, timedelta
+import heapq
+
+
+class DeadlineScheduler(object):
+    """
+    Keeps the deadlines of the orders placed through this node in a heap, and calls back
+    with the ids of the orders due as soon as their deadline passes, using a single timeout for the nearest one.
+    Orders of the nodes that are gone are not tracked by anyone, the database is swept for them instead.
+    """
+
+    # fire a bit later so the database (which decides in the end) agrees the order is due
+    GRACE = timedelta(seconds=1)
+
+    def __init__(self, callback):
+        self.callback = callback
+        # heap of (deadline, order_id), may contain stale entries
+        self.heap = []
+        # order_id -> deadline
+        self.deadlines = {}
+        self.timeout = None
+        self.timeout_deadline = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, order_id, deadline):
+        order_id = str(order_id)
+
+        self.deadlines[order_id] = deadline
+        heapq.heappush(self.heap, (deadline, order_id))
+
+        if self.timeout_deadline is None or deadline < self.timeout_deadline:
+            self.__rearm__()
+
+    def cancel(self, order_id):
+        # the heap entry is skipped once it comes up
+        self.deadlines.pop(str(order_id), None)
+
+    def stop(self):
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+        self.timeout = None
+        self.timeout_deadline = None
+
+    def __rearm__(self):
+        self.stop()
+
+        while self.heap:
+            deadline, order_id = self.heap[0]
+            if self.deadlines.get(order_id) == deadline:
+                break
+            heapq.heappop(self.heap)
+        else:
+            return
+
+        delay = (deadline + DeadlineScheduler.GRACE - datetime.utcnow()).total_seconds()
+        self.timeout_deadline = deadline
+        self.timeout = IOLoop.current().call_later(max(delay, 0), self.__fire__)
+
+    def __fire__(self):
+        self.timeout = None
+        self.timeout_deadline = None
+
+        now = datetime.utcnow() - DeadlineScheduler.GRACE
+        due = []
+
+        while self.heap and self.heap[0][0] <= now:
+            deadline, order_id = heapq.heappop(self.heap)
+            if self.deadlines.get(order_id) == deadline:
+                del self.deadlines[order_id]
+                due.append(order_id)
+
+        self.__rearm__()
+
+        if due:
+            self.callback(due)
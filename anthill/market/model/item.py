@@ -1,18 +1,24 @@
 
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import PeriodicCallback, IOLoop
 
 from anthill.common.model import Model
 from anthill.common.database import DatabaseError, format_conditions_json
 from anthill.common.validate import validate, validate_value, ValidationError
 from anthill.common import to_int
 
+from .lease import Lease
 
+import asyncio
 import hashlib
 import logging
+import time
 import ujson
+import uuid
 
 
 class ItemAdapter(object):
+    __slots__ = ("item_id", "owner_id", "market_id", "name", "amount", "payload", "hash")
+
     def __init__(self, data):
         self.item_id = str(data.get("item_id"))
         self.owner_id = str(data.get("owner_id"))
@@ -36,6 +42,53 @@ class ItemFromUserAdapter(object):
             raise ItemError(400, "Item {0}'s field 'payload' is malformed".format(self.name))
 
 
+class ItemDeltas(object):
+    """
+    Collects item amount changes made within a transaction, so the same item of the same owner
+    is written once no matter how many times it has been changed.
+    """
+
+    def __init__(self):
+        # (gamespace_id, owner_id, market_id, item_hash) -> [item_name, item_payload, amount]
+        self.deltas = {}
+        # (gamespace_id, owner_id, market_id) of every inventory changed, flushed or not
+        self.touched = set()
+
+    def __bool__(self):
+        return bool(self.deltas)
+
+    def add(self, gamespace_id, owner_id, market_id, item_name, item_payload, amount, item_hash=None):
+        if not amount:
+            return
+
+        if item_hash is None:
+            item_hash = ItemModel.item_hash(item_name, item_payload or {})
+
+        key = (int(gamespace_id), int(owner_id), int(market_id), item_hash)
+        existing = self.deltas.get(key)
+        self.touched.add(key[:3])
+
+        if existing is None:
+            self.deltas[key] = [item_name, item_payload, amount]
+        else:
+            existing[2] += amount
+
+    def owners(self):
+        return self.touched
+
+    async def flush(self, items, db=None):
+        """
+        Writes every collected change with a single statement
+        """
+        credits = [
+            (gamespace_id, owner_id, market_id, item_name, item_payload, item_hash, amount)
+            for (gamespace_id, owner_id, market_id, item_hash), (item_name, item_payload, amount)
+            in self.deltas.items()
+        ]
+        self.deltas = {}
+        await items.credit_items(credits, db=db)
+
+
 class ItemError(Exception):
     def __init__(self, code, message):
         self.code = code
@@ -51,19 +104,62 @@ class NoItemError(Exception):
 
 class ItemModel(Model):
 
-    def __init__(self, app, db):
+    # marks an inventory as cached even if it has no items
+    CACHED_MARKER = "@"
+    # holds the token of the reader about to cache an inventory, see __inventory__
+    FILLING_MARKER = "!"
+    # how long a reader may take to read an inventory from the database and cache it
+    FILLING_TTL = 30
+
+    # caches the inventory unless it has been invalidated since the reader has put its token
+    FILL = """
+        if redis.call("hget", KEYS[1], ARGV[1]) ~= ARGV[2] then
+            return 0
+        end
+        redis.call("del", KEYS[1])
+        for i = 4, #ARGV, 2 do
+            redis.call("hset", KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+        redis.call("expire", KEYS[1], ARGV[3])
+        return 1
+    """
+
+    def __init__(self, app, db, cache_ttl=300, cleanup_interval=3600, cleanup_batch_size=1000, cleanup_rate=10,
+                 lease_ttl=15):
         self.app = app
         self.db = db
+        self.cache_ttl = cache_ttl
+        self.cleanup_batch_size = cleanup_batch_size
+        self.cleanup_rate = cleanup_rate
+        self.cleanup_cb = PeriodicCallback(self.__check_zero_items__, callback_time=cleanup_interval * 1000)
+        self.cleanup_lease = Lease(app, "market:items_cleanup", ttl=lease_ttl)
+        self.cleaning = False
+
+    async def started(self, application):
+        await super().started(application)
+        await self.app.migrations.migrate(self, application)
+        self.cleanup_lease.start()
+        self.cleanup_cb.start()
+
+    async def stopped(self):
+        self.cleanup_cb.stop()
+        await self.cleanup_lease.stop()
+        await super().stopped()
 
     def get_setup_tables(self):
         return ["items"]
 
-    def get_setup_events(self):
-        return ["delete_zero_items"]
-
     def get_setup_db(self):
         return self.db
 
+    def get_migrations(self):
+        return [
+            "items_drop_zero_items_event"
+        ]
+
+    async def setup_table_items(self):
+        await self.app.migrations.baseline(self.get_migrations())
+
     def has_delete_account_event(self):
         return True
 
@@ -84,6 +180,208 @@ class ItemModel(Model):
         except DatabaseError as e:
             raise ItemError(500, "Failed to delete user orders: " + e.args[1])
 
+        await self.invalidate_owners_inventories(gamespace if gamespace_only else None, accounts)
+
+    def __check_zero_items__(self):
+        if not self.cleanup_lease.held:
+            return
+        if self.cleaning:
+            logging.warning("Previous zero items cleanup is still running, skipping")
+            return
+        IOLoop.current().add_callback(self.delete_zero_items)
+
+    async def delete_zero_items(self):
+        """
+        Deletes the items left with nothing. Items are deleted as soon as they drop to zero,
+        this is the fallback for the rows left before that (or by anything else).
+        The table is walked by the primary key in chunks of `cleanup_batch_size` rows,
+        at most `cleanup_rate` chunks per second, and only the empty rows found are locked.
+        """
+        if self.cleaning:
+            return
+
+        self.cleaning = True
+
+        scanned = 0
+        deleted = 0
+        last_item_id = 0
+
+        try:
+            while True:
+                chunk_started = time.monotonic()
+
+                try:
+                    rows = await self.db.query(
+                        """
+                            SELECT `item_id`, `item_amount`
+                            FROM `items`
+                            WHERE `item_id`>%s
+                            ORDER BY `item_id`
+                            LIMIT %s;
+                        """, last_item_id, self.cleanup_batch_size)
+
+                    if not rows:
+                        break
+
+                    last_item_id = rows[-1]["item_id"]
+                    scanned += len(rows)
+
+                    empty = [row["item_id"] for row in rows if row["item_amount"] == 0]
+
+                    if empty:
+                        # the amount is checked again, the item could have been credited since
+                        deleted += await self.db.execute(
+                            """
+                                DELETE FROM `items`
+                                WHERE `item_id` IN %s AND `item_amount`=0;
+                            """, empty)
+                except DatabaseError as e:
+                    logging.error("Failed to delete zero items: " + e.args[1])
+                    break
+
+                await asyncio.sleep(max(0.0, 1.0 / self.cleanup_rate - (time.monotonic() - chunk_started)))
+
+            if deleted:
+                logging.info("Deleted {0} zero item(s)".format(deleted))
+
+            self.app.monitor_action("items.cleanup", {"scanned": scanned, "deleted": deleted})
+        finally:
+            self.cleaning = False
+
+    async def __delete_emptied__(self, gamespace_id, owner_id, market_id, hashes, db=None):
+        """
+        Deletes the given items of an owner if nothing is left of them
+        """
+        await (db or self.db).execute(
+            """
+                DELETE FROM `items`
+                WHERE `gamespace_id`=%s AND `owner_id`=%s AND `market_id`=%s AND `item_hash` IN %s
+                AND `item_amount`=0;
+            """, gamespace_id, owner_id, market_id, hashes)
+
+    @staticmethod
+    def __inventory_key__(gamespace_id, owner_id, market_id):
+        return "items:{0}:{1}:{2}".format(gamespace_id, owner_id, market_id)
+
+    async def __inventory__(self, gamespace_id, owner_id, market_id):
+        """
+        Returns every item row of an inventory as a dict of item_hash -> row,
+        served from the cache whenever possible.
+
+        Before reading the database, the reader puts its token into the cached inventory, and caches what it
+        has read only if the token is still there. Invalidation drops the token along with the rest, so rows
+        read before a change is committed are never cached after it has been invalidated.
+        """
+        key = ItemModel.__inventory_key__(gamespace_id, owner_id, market_id)
+        token = None
+
+        if self.cache_ttl:
+            try:
+                async with self.app.cache.acquire() as kv:
+                    cached = await kv.hgetall(key, encoding="utf-8")
+
+                    if ItemModel.CACHED_MARKER not in cached:
+                        token = uuid.uuid4().hex
+                        tr = kv.multi_exec()
+                        tr.hset(key, ItemModel.FILLING_MARKER, token)
+                        tr.expire(key, ItemModel.FILLING_TTL)
+                        await tr.execute()
+            except Exception:
+                logging.exception("Failed to read cached inventory")
+                cached = None
+                token = None
+
+            if cached and ItemModel.CACHED_MARKER in cached:
+                return {
+                    item_hash: ujson.loads(row)
+                    for item_hash, row in cached.items()
+                    if item_hash not in (ItemModel.CACHED_MARKER, ItemModel.FILLING_MARKER)
+                }
+
+        try:
+            data = await self.db.query(
+                """
+                    SELECT *
+                    FROM `items`
+                    WHERE `owner_id`=%s AND `gamespace_id`=%s AND `market_id`=%s;
+                """, owner_id, gamespace_id, market_id
+            )
+        except DatabaseError as e:
+            raise ItemError(500, "Failed to gather order info: " + e.args[1])
+
+        inventory = {row["item_hash"]: row for row in data}
+
+        if token is not None:
+            fields = [ItemModel.CACHED_MARKER, "1"]
+            for item_hash, row in inventory.items():
+                fields.extend([item_hash, ujson.dumps(row)])
+
+            try:
+                async with self.app.cache.acquire() as kv:
+                    await kv.eval(
+                        ItemModel.FILL, keys=[key],
+                        args=[ItemModel.FILLING_MARKER, token, self.cache_ttl] + fields)
+            except Exception:
+                logging.exception("Failed to cache inventory")
+
+        return inventory
+
+    async def invalidate_inventories(self, inventories):
+        """
+        Drops cached inventories, should be called after every change to the items is committed.
+        :param inventories: an iterable of (gamespace_id, owner_id, market_id)
+        """
+        if not self.cache_ttl:
+            return
+
+        keys = [
+            ItemModel.__inventory_key__(gamespace_id, owner_id, market_id)
+            for gamespace_id, owner_id, market_id in inventories
+        ]
+
+        if not keys:
+            return
+
+        try:
+            async with self.app.cache.acquire() as kv:
+                await kv.delete(*keys)
+        except Exception:
+            logging.exception("Failed to invalidate cached inventories")
+
+    async def invalidate_owners_inventories(self, gamespace_id, owners):
+        """
+        Drops cached inventories of every owner listed, in every market, with a single scan
+        :param gamespace_id: a gamespace to look in, or None for every gamespace
+        """
+        if not self.cache_ttl or not owners:
+            return
+
+        owners = set(str(owner_id) for owner_id in owners)
+        pattern = ItemModel.__inventory_key__("*" if gamespace_id is None else gamespace_id, "*", "*")
+
+        try:
+            async with self.app.cache.acquire() as kv:
+                keys = [
+                    key async for key in kv.iscan(match=pattern)
+                    if (key.decode() if isinstance(key, bytes) else key).split(":")[2] in owners
+                ]
+                if keys:
+                    await kv.delete(*keys)
+        except Exception:
+            logging.exception("Failed to invalidate cached inventories")
+
+    async def invalidate_inventories_matching(self, pattern):
+        if not self.cache_ttl:
+            return
+
+        try:
+            async with self.app.cache.acquire() as kv:
+                keys = [key async for key in kv.iscan(match=pattern)]
+                if keys:
+                    await kv.delete(*keys)
+        except Exception:
+            logging.exception("Failed to invalidate cached inventories")
+
     @validate(gamespace_id="int", item_id="int")
     async def get_item(self, gamespace_id, item_id, db=None):
         try:
@@ -104,6 +402,10 @@ class ItemModel(Model):
 
     @validate(gamespace_id="int", owner_id="int", market_id="int")
     async def list_items(self, gamespace_id, owner_id, market_id, db=None):
+        if db is None:
+            inventory = await self.__inventory__(gamespace_id, owner_id, market_id)
+            return [ItemAdapter(row) for row in inventory.values() if row["item_amount"] != 0]
+
         try:
             data = await (db or self.db).query(
                 """
@@ -122,17 +424,21 @@ class ItemModel(Model):
 
         item_hash = ItemModel.item_hash(item_name, item_payload or {})
 
-        try:
-            data = await (db or self.db).get(
-                """
-                    SELECT *
-                    FROM `items`
-                    WHERE `owner_id`=%s AND `gamespace_id`=%s AND `market_id`=%s AND `item_hash`=%s
-                    LIMIT 1;
-                """, owner_id, gamespace_id, market_id, item_hash
-            )
-        except DatabaseError as e:
-            raise ItemError(500, "Failed to gather order info: " + e.args[1])
+        if db is None:
+            inventory = await self.__inventory__(gamespace_id, owner_id, market_id)
+            data = inventory.get(item_hash)
+        else:
+            try:
+                data = await db.get(
+                    """
+                        SELECT *
+                        FROM `items`
+                        WHERE `owner_id`=%s AND `gamespace_id`=%s AND `market_id`=%s AND `item_hash`=%s
+                        LIMIT 1;
+                    """, owner_id, gamespace_id, market_id, item_hash
+                )
+            except DatabaseError as e:
+                raise ItemError(500, "Failed to gather order info: " + e.args[1])
 
         if not data:
             raise NoItemError()
@@ -161,9 +467,15 @@ class ItemModel(Model):
 
                 """, item_amount, gamespace_id, owner_id, market_id, item_hash, item_amount
             )
+
+            if updated:
+                await self.__delete_emptied__(gamespace_id, owner_id, market_id, [item_hash], db=db)
         except DatabaseError as e:
             raise ItemError(500, "Failed to decrease item amount: " + e.args[1])
 
+        if updated and db is None:
+            await self.invalidate_inventories([(gamespace_id, owner_id, market_id)])
+
         if updated:
             logging.info("User {0} gc {1} mk {2} subtracted {3} of {4}({5})".format(
                 owner_id, gamespace_id, market_id, item_amount, item_name, ujson.dumps(item_payload)))
@@ -190,20 +502,110 @@ class ItemModel(Model):
                 """, gamespace_id, owner_id, market_id, item_name, item_amount, ujson.dumps(item_payload or {}),
                 item_hash, item_amount
             )
+
+            if item_amount < 0:
+                await self.__delete_emptied__(gamespace_id, owner_id, market_id, [item_hash], db=db)
         except DatabaseError as e:
             raise ItemError(500, "Failed to update item amount: " + e.args[1])
         else:
+            if db is None:
+                await self.invalidate_inventories([(gamespace_id, owner_id, market_id)])
             logging.info("User {0} gc {1} mk {2} updated {3} of {4}({5})".format(
                 owner_id, gamespace_id, market_id, item_amount, item_name, ujson.dumps(item_payload)))
 
+    async def credit_items(self, credits, db=None):
+        """
+        Adds amounts to many items (possibly of different owners) with a single statement.
+        :param credits: a list of (gamespace_id, owner_id, market_id, item_name, item_payload, item_hash, amount)
+        """
+        credits = [credit for credit in credits if credit[6] != 0]
+        if not credits:
+            return
+
+        # always touch the rows in the same order so concurrent credits cannot deadlock each other
+        credits.sort(key=lambda credit: (credit[0], credit[1], credit[2], credit[5]))
+
+        values = []
+        for gamespace_id, owner_id, market_id, item_name, item_payload, item_hash, amount in credits:
+            values.extend([gamespace_id, owner_id, market_id, item_name, amount,
+                           ujson.dumps(item_payload or {}), item_hash])
+
+        try:
+            await (db or self.db).execute(
+                """
+                    INSERT INTO `items`
+                    (`gamespace_id`, `owner_id`, `market_id`, `item_name`, `item_amount`, `item_payload`, `item_hash`)
+                    VALUES {0}
+                    ON DUPLICATE KEY UPDATE `item_amount` = `item_amount` + VALUES(`item_amount`);
+                """.format(", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(credits))), *values
+            )
+        except DatabaseError as e:
+            raise ItemError(500, "Failed to update item amounts: " + e.args[1])
+
+        if db is None:
+            await self.invalidate_inventories(set(credit[:3] for credit in credits))
+
+        logging.info("Credited {0} item(s): {1}".format(len(credits), ", ".join(
+            "user {0} gc {1} mk {2} {3} of {4}({5})".format(
+                owner_id, gamespace_id, market_id, amount, item_name, ujson.dumps(item_payload))
+            for gamespace_id, owner_id, market_id, item_name, item_payload, item_hash, amount in credits)))
+
+    async def debit_items(self, gamespace_id, owner_id, market_id, debits, db=None):
+        """
+        Subtracts amounts from many items of a single owner with a single statement.
+        :param debits: a dict of item_hash -> amount to subtract
+        :returns: True if every item has had enough to subtract, otherwise nothing is guaranteed
+            and the transaction should be rolled back
+        """
+        if not debits:
+            return True
+
+        hashes = sorted(debits.keys())
+        case = " ".join(["WHEN %s THEN %s"] * len(hashes))
+
+        values = []
+        for item_hash in hashes:
+            values.extend([item_hash, debits[item_hash]])
+
+        try:
+            updated = await (db or self.db).execute(
+                """
+                    UPDATE `items`
+                    SET `item_amount` = `item_amount` - (CASE `item_hash` {0} END)
+                    WHERE `gamespace_id`=%s AND `owner_id`=%s AND `market_id`=%s AND `item_hash` IN %s
+                    AND `item_amount` >= (CASE `item_hash` {0} END);
+                """.format(case), *(values + [gamespace_id, owner_id, market_id, hashes] + values)
+            )
+
+            if updated:
+                await self.__delete_emptied__(gamespace_id, owner_id, market_id, hashes, db=db)
+        except DatabaseError as e:
+            raise ItemError(500, "Failed to decrease item amounts: " + e.args[1])
+
+        if db is None:
+            await self.invalidate_inventories([(gamespace_id, owner_id, market_id)])
+
+        logging.info("User {0} gc {1} mk {2} subtracted {3} of {4} item(s)".format(
+            owner_id, gamespace_id, market_id, updated, len(hashes)))
+
+        return updated == len(hashes)
+
     @validate(gamespace_id="int", owner_id="int", market_id="int", items="json_list")
     async def update_items(self, gamespace_id, owner_id, market_id, items):
         async with self.db.acquire(auto_commit=False) as db:
             try:
                 items = list(map(ItemFromUserAdapter, items))
-                hashes = set()
-                for item in items:
-                    hashes.add(ItemModel.item_hash(item.name, item.payload or {}))
+
+                items = [(item, ItemModel.item_hash(item.name, item.payload or {})) for item in items]
+
+                # the same item could be mentioned more than once, so the amounts are summed up per hash
+                hashed = {}
+                for item, item_hash in items:
+                    existing = hashed.get(item_hash)
+                    if existing is None:
+                        hashed[item_hash] = [item, item.update_amount]
+                    else:
+                        existing[1] += item.update_amount
 
                 existing_hashed_items = {}
                 try:
@@ -213,7 +615,7 @@ class ItemModel(Model):
                             FROM `items`
                             WHERE `owner_id`=%s AND `gamespace_id`=%s AND `market_id`=%s AND `item_hash` IN %s
                             FOR UPDATE;
-                        """, owner_id, gamespace_id, market_id, list(hashes)
+                        """, owner_id, gamespace_id, market_id, sorted(hashed.keys())
                     )
                 except DatabaseError as e:
                     raise ItemError(500, "Failed to obtain items: " + e.args[1])
@@ -222,28 +624,41 @@ class ItemModel(Model):
                     item_a = ItemAdapter(hh)
                     existing_hashed_items[item_a.hash] = item_a
 
-                # check negative balances first
-                for item in items:
+                # check negative balances first, every one of them as if the updates were made one by one
+                balances = {
+                    item_hash: existing_hashed_items[item_hash].amount if item_hash in existing_hashed_items else 0
+                    for item_hash in hashed
+                }
+
+                for item, item_hash in items:
                     if item.update_amount < 0:
-                        item_hash = ItemModel.item_hash(item.name, item.payload or {})
                         if item_hash not in existing_hashed_items:
                             raise ItemError(409, "Not enough items '{0}".format(item.name))
-                        if existing_hashed_items[item_hash].amount < -item.update_amount:
+                        if existing_hashed_items[item_hash].amount < -item.update_amount or \
+                                balances[item_hash] < -item.update_amount:
                             raise ItemError(409, "Not enough items '{0}".format(item.name))
+                    balances[item_hash] += item.update_amount
 
-                for item in items:
-                    if item.update_amount < 0:
-                        if not await self.subtract_item(
-                                gamespace_id, owner_id, market_id, item.name,
-                                -item.update_amount, item.payload, db=db):
-                            raise ItemError(409, "Not enough items '{0}".format(item.name))
-                    elif item.update_amount > 0:
-                        await self.update_item(
-                            gamespace_id, owner_id, market_id,
-                            item.name, item.update_amount, item.payload, db=db)
+                # while the changes of the same item are written at once
+                debits = {}
+                credits = []
+
+                for item_hash, (item, update_amount) in hashed.items():
+                    if update_amount < 0:
+                        debits[item_hash] = -update_amount
+                    elif update_amount > 0:
+                        credits.append((gamespace_id, owner_id, market_id, item.name,
+                                        item.payload, item_hash, update_amount))
+
+                if not await self.debit_items(gamespace_id, owner_id, market_id, debits, db=db):
+                    raise ItemError(409, "Not enough items")
+
+                await self.credit_items(credits, db=db)
 
             except Exception:
                 await db.rollback()
                 raise
             else:
                 await db.commit()
+
+        await self.invalidate_inventories([(gamespace_id, owner_id, market_id)])
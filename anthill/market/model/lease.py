@@ -0,0 +1,115 @@
+
+import asyncio
+import logging
+import time
+import uuid
+
+
+class Lease(object):
+    """
+    Leadership over a background job, shared by every node through Redis.
+
+    Every node tries to take the lease key if nobody holds it, the one that succeeds is the leader until
+    it stops renewing the key. The leader renews it every third of `ttl`, so once the leader dies (or loses
+    its connection to Redis) the lease lapses within `ttl` seconds and another node takes over.
+    A leader that fails to renew in time steps down on its own, so two nodes never consider themselves
+    leaders for longer than the clock drift between them.
+    """
+
+    # takes the lease if it is free, renews it if it is ours already
+    KEEP = """
+        local holder = redis.call("get", KEYS[1])
+        if holder == ARGV[1] then
+            return redis.call("pexpire", KEYS[1], ARGV[2])
+        end
+        if not holder then
+            redis.call("set", KEYS[1], ARGV[1], "PX", ARGV[2])
+            return 1
+        end
+        return 0
+    """
+
+    RELEASE = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, app, name, ttl=15, on_acquired=None):
+        self.app = app
+        self.key = "lease:" + name
+        self.ttl = ttl
+        self.on_acquired = on_acquired
+        self.token = uuid.uuid4().hex
+        self.expires = 0
+        self.worker = None
+
+    @property
+    def held(self):
+        return time.monotonic() < self.expires
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.__work__())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+
+        self.worker.cancel()
+        self.worker = None
+
+        if not self.held:
+            return
+
+        self.expires = 0
+
+        # let the others take over right away instead of waiting for the lease to lapse
+        try:
+            async with self.app.cache.acquire() as kv:
+                await kv.eval(Lease.RELEASE, keys=[self.key], args=[self.token])
+        except Exception:
+            logging.exception("Failed to release lease '{0}'".format(self.key))
+
+    async def __keep__(self):
+        """
+        Takes or renews the lease, returns True if it has been taken just now
+        """
+        # counted from before the request, so the lease is never assumed to last longer than it does
+        started = time.monotonic()
+        held = self.held
+
+        async with self.app.cache.acquire() as kv:
+            renewed = await kv.eval(Lease.KEEP, keys=[self.key], args=[self.token, int(self.ttl * 1000)])
+
+        if renewed:
+            self.expires = started + self.ttl
+            return not held
+
+        if held:
+            logging.warning("Lease '{0}' has been lost".format(self.key))
+
+        self.expires = 0
+        return False
+
+    async def __work__(self):
+        while True:
+            try:
+                acquired = await self.__keep__()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Failed to keep lease '{0}'".format(self.key))
+            else:
+                if acquired:
+                    logging.info("Lease '{0}' has been acquired".format(self.key))
+                    self.app.monitor_action("leases", {"acquired": 1}, lease=self.key)
+
+                    if self.on_acquired is not None:
+                        try:
+                            await self.on_acquired()
+                        except Exception:
+                            logging.exception("Failed to take over lease '{0}'".format(self.key))
+
+            await asyncio.sleep(self.ttl / 3.0)
@@ -6,13 +6,18 @@ from anthill.common.database import DatabaseError, format_conditions_json
 from anthill.common.validate import validate
 from anthill.common import to_int
 
+from .cache import LocalCache
+from .order import OrderError
 
+import asyncio
 import hashlib
 import logging
 import ujson
 
 
 class MarketAdapter(object):
+    __slots__ = ("market_id", "name", "settings")
+
     def __init__(self, data):
         self.market_id = str(data.get("market_id"))
         self.name = str(data.get("market_name"))
@@ -34,13 +39,82 @@ class NoMarketError(Exception):
 
 class MarketModel(Model):
 
-    def __init__(self, app, db):
+    INVALIDATE_CHANNEL = "markets:invalidate"
+    # market setting listing the payload keys orders are often queried by
+    INDEXED_PAYLOAD_KEYS = "indexed_payload_keys"
+
+    def __init__(self, app, db, cache_ttl=60, cache_size=1000):
         self.app = app
         self.db = db
+        self.markets_cache = LocalCache(cache_ttl, cache_size)
+        self.invalidate_listener = None
+
+    async def started(self, application):
+        await super().started(application)
+        self.invalidate_listener = asyncio.ensure_future(self.__listen_invalidations__())
+
+    async def stopped(self):
+        if self.invalidate_listener is not None:
+            self.invalidate_listener.cancel()
+            self.invalidate_listener = None
+        await super().stopped()
+
+    async def __listen_invalidations__(self):
+        while True:
+            try:
+                async with self.app.cache.acquire() as kv:
+                    channel, = await kv.subscribe(MarketModel.INVALIDATE_CHANNEL)
+                    try:
+                        while await channel.wait_message():
+                            message = await channel.get_json()
+                            self.__forget_market__(message["gamespace_id"], message["market_id"])
+                    finally:
+                        await kv.unsubscribe(MarketModel.INVALIDATE_CHANNEL)
+            except asyncio.CancelledError:
+                return
+            except Exception:
+                logging.exception("Market invalidation listener has failed, resubscribing")
+                # nothing guarantees we have not missed something while being disconnected
+                self.markets_cache.clear()
+                await asyncio.sleep(5)
+
+    def __forget_market__(self, gamespace_id, market_id):
+        gamespace_id = int(gamespace_id)
+        market_id = str(market_id)
+        self.markets_cache.delete_where(
+            lambda key, market: key[0] == gamespace_id and market.market_id == market_id)
+
+    def __remember_market__(self, gamespace_id, market):
+        self.markets_cache.set((int(gamespace_id), "name", market.name), market)
+        self.markets_cache.set((int(gamespace_id), "id", market.market_id), market)
+
+    async def __invalidate_market__(self, gamespace_id, market_id):
+        self.__forget_market__(gamespace_id, market_id)
+
+        try:
+            async with self.app.cache.acquire() as kv:
+                await kv.publish_json(MarketModel.INVALIDATE_CHANNEL, {
+                    "gamespace_id": int(gamespace_id),
+                    "market_id": int(market_id)
+                })
+        except Exception:
+            logging.exception("Failed to broadcast market invalidation")
 
     def get_setup_tables(self):
         return ["markets"]
 
+    async def __index_payload_keys__(self, market_settings):
+        keys = market_settings.get(MarketModel.INDEXED_PAYLOAD_KEYS, [])
+
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            raise MarketError(400, "Market setting '{0}' should be a list of strings".format(
+                MarketModel.INDEXED_PAYLOAD_KEYS))
+
+        try:
+            await self.app.orders.index_payload_keys(keys)
+        except OrderError as e:
+            raise MarketError(e.code, e.message)
+
     def get_setup_db(self):
         return self.db
 
@@ -49,6 +123,11 @@ class MarketModel(Model):
 
     @validate(gamespace_id="int", market_name="str_name")
     async def find_market(self, gamespace_id, market_name, db=None):
+        if db is None:
+            cached = self.markets_cache.get((gamespace_id, "name", market_name))
+            if cached is not None:
+                return cached
+
         try:
             data = await (db or self.db).get(
                 """
@@ -63,10 +142,17 @@ class MarketModel(Model):
         if not data:
             raise NoMarketError()
 
-        return MarketAdapter(data)
+        market = MarketAdapter(data)
+        self.__remember_market__(gamespace_id, market)
+        return market
 
     @validate(gamespace_id="int", market_id="int")
     async def get_market(self, gamespace_id, market_id, db=None):
+        if db is None:
+            cached = self.markets_cache.get((gamespace_id, "id", str(market_id)))
+            if cached is not None:
+                return cached
+
         try:
             data = await (db or self.db).get(
                 """
@@ -81,10 +167,14 @@ class MarketModel(Model):
         if not data:
             raise NoMarketError()
 
-        return MarketAdapter(data)
+        market = MarketAdapter(data)
+        self.__remember_market__(gamespace_id, market)
+        return market
 
     @validate(gamespace_id="int", market_name="str_name", market_settings="json_dict")
     async def new_market(self, gamespace_id, market_name, market_settings, db=None):
+        await self.__index_payload_keys__(market_settings)
+
         try:
             market_id = await (db or self.db).insert(
                 """
@@ -100,6 +190,7 @@ class MarketModel(Model):
 
     @validate(gamespace_id="int", market_id="int", market_name="str_name", market_settings="json_dict")
     async def update_market(self, gamespace_id, market_id, market_name, market_settings, db=None):
+        await self.__index_payload_keys__(market_settings)
 
         try:
             await (db or self.db).execute(
@@ -112,6 +203,8 @@ class MarketModel(Model):
         except DatabaseError as e:
             raise MarketError(500, "Failed to gather market info: " + e.args[1])
 
+        await self.__invalidate_market__(gamespace_id, market_id)
+
     @validate(gamespace_id="int", market_id="int")
     async def delete_market(self, gamespace_id, market_id):
 
@@ -141,6 +234,13 @@ class MarketModel(Model):
             else:
                 await db.commit()
 
+        await self.__invalidate_market__(gamespace_id, market_id)
+        await self.app.items.invalidate_inventories_matching("items:{0}:*:{1}".format(gamespace_id, market_id))
+
+        books = self.app.orders.books
+        if books is not None:
+            books.remove_market(gamespace_id, market_id)
+
     @validate(gamespace_id="int")
     async def list_markets(self, gamespace_id, db=None):
         try:
@@ -0,0 +1,145 @@
+
+import asyncio
+import logging
+import time
+import uuid
+
+
+class PairLock(object):
+    """
+    Holds the matching of a single pair, see MatchingQueues.lock
+    """
+
+    def __init__(self, queues, key):
+        self.queues = queues
+        self.key = key
+        self.token = None
+
+    async def __aenter__(self):
+        await self.queues.__acquire__(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.queues.__release__(self)
+
+
+class MatchingQueues(object):
+    """
+    Serializes matching per (gamespace, market, pair of items).
+
+    Matching orders of the same pair lock overlapping ranges of `orders`, so running them at once
+    only makes them wait for (or deadlock on) each other's row locks. Instead, each pair gets a queue:
+    matches of a pair run one after another in the order they came in, matches of different pairs
+    run in parallel. Both directions of a pair (gold for silver and silver for gold) share the queue,
+    since these are the orders that match each other.
+
+    With `distributed` enabled, the queue of a pair is also held across the nodes with a short Redis lock.
+    The database locks stay the source of truth, so if the Redis lock cannot be taken within
+    `lock_timeout` seconds the match goes on without it.
+    """
+
+    RELEASE = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        end
+        return 0
+    """
+
+    LOCK_STEP = 0.01
+    LOCK_STEP_MAX = 0.2
+
+    def __init__(self, app, distributed=False, lock_timeout=5):
+        self.app = app
+        self.distributed = distributed
+        self.lock_timeout = lock_timeout
+        # pair key -> [asyncio.Lock, amount of matches holding or waiting for it]
+        self.queues = {}
+
+    @staticmethod
+    def pair_key(gamespace_id, market_id, give_item, take_item):
+        first, second = sorted([give_item, take_item])
+        return "{0}:{1}:{2}:{3}".format(gamespace_id, market_id, first, second)
+
+    def lock(self, gamespace_id, market_id, give_item, take_item):
+        """
+        Returns an async context manager that holds the queue of the pair while matching
+        """
+        return PairLock(self, MatchingQueues.pair_key(gamespace_id, market_id, give_item, take_item))
+
+    def __len__(self):
+        return len(self.queues)
+
+    async def __acquire__(self, pair_lock):
+        queue = self.queues.get(pair_lock.key)
+        if queue is None:
+            queue = [asyncio.Lock(), 0]
+            self.queues[pair_lock.key] = queue
+
+        queue[1] += 1
+
+        try:
+            await queue[0].acquire()
+        except BaseException:
+            self.__leave__(pair_lock.key, queue)
+            raise
+
+        if self.distributed:
+            try:
+                pair_lock.token = await self.__lock_shared__(pair_lock.key)
+            except BaseException:
+                queue[0].release()
+                self.__leave__(pair_lock.key, queue)
+                raise
+
+    async def __release__(self, pair_lock):
+        queue = self.queues[pair_lock.key]
+
+        try:
+            if pair_lock.token is not None:
+                await self.__unlock_shared__(pair_lock.key, pair_lock.token)
+                pair_lock.token = None
+        finally:
+            queue[0].release()
+            self.__leave__(pair_lock.key, queue)
+
+    def __leave__(self, key, queue):
+        queue[1] -= 1
+        if queue[1] <= 0:
+            self.queues.pop(key, None)
+
+    async def __lock_shared__(self, key):
+        lock = "matching:" + key
+        token = uuid.uuid4().hex
+        started = time.monotonic()
+        step = MatchingQueues.LOCK_STEP
+
+        try:
+            while True:
+                async with self.app.cache.acquire() as kv:
+                    locked = await kv.set(lock, token, pexpire=int(self.lock_timeout * 1000),
+                                          exist=kv.SET_IF_NOT_EXIST)
+
+                if locked:
+                    return token
+
+                if time.monotonic() - started >= self.lock_timeout:
+                    break
+
+                await asyncio.sleep(step)
+                step = min(step * 2, MatchingQueues.LOCK_STEP_MAX)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Failed to lock matching of '{0}'".format(key))
+            return None
+
+        logging.warning("Timed out waiting for matching of '{0}', going on without the lock".format(key))
+        self.app.monitor_action("matching.lock", {"timeouts": 1})
+        return None
+
+    async def __unlock_shared__(self, key, token):
+        try:
+            async with self.app.cache.acquire() as kv:
+                await kv.eval(MatchingQueues.RELEASE, keys=["matching:" + key], args=[token])
+        except Exception:
+            logging.exception("Failed to unlock matching of '{0}'".format(key))
@@ -0,0 +1,125 @@
+
+from anthill.common.model import Model
+from anthill.common.database import DatabaseError
+
+import logging
+
+
+class MigrationError(Exception):
+    pass
+
+
+class MigrationModel(Model):
+    """
+    Keeps track of the schema changes applied to the tables of other models.
+
+    A model lists its migrations in get_migrations(), in the order they should be applied. A migration
+    is either a `migration_<name>(db)` coroutine of the model, or a single statement in
+    `sql/migrations/<name>.sql`. Tables created from scratch already have the latest schema,
+    so their migrations are only recorded as applied (see baseline).
+
+    The models depend on the latest schema, so if migrations could not be applied, the exception
+    is raised further and the service does not start.
+    """
+
+    LOCK_NAME = "market_schema_migrations"
+    LOCK_TIMEOUT = 600
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+
+    def get_setup_tables(self):
+        return ["schema_migrations"]
+
+    def get_setup_db(self):
+        return self.db
+
+    def has_delete_account_event(self):
+        return False
+
+    async def __applied__(self, db):
+        migrations = await db.query(
+            """
+                SELECT `migration_name`
+                FROM `schema_migrations`;
+            """)
+
+        return set(migration["migration_name"] for migration in migrations)
+
+    async def __record__(self, db, names):
+        await db.execute(
+            """
+                INSERT IGNORE INTO `schema_migrations`
+                (`migration_name`)
+                VALUES {0};
+            """.format(", ".join(["(%s)"] * len(names))), *names)
+
+    async def baseline(self, names):
+        """
+        Marks migrations as applied without running them
+        """
+        if not names:
+            return
+
+        try:
+            await self.__record__(self.db, names)
+        except DatabaseError as e:
+            # otherwise they would be applied to the table that has them already on the next start
+            logging.error("Failed to record migrations: " + e.args[1])
+            raise
+
+    async def migrate(self, model, application):
+        """
+        Applies migrations of the model that were not applied yet. Nodes starting at the same time
+        wait for each other, so every migration is applied once.
+        """
+        names = model.get_migrations()
+        if not names:
+            return
+
+        async with self.db.acquire() as db:
+            try:
+                locked = await db.get(
+                    """
+                        SELECT GET_LOCK(%s, %s) AS `locked`;
+                    """, MigrationModel.LOCK_NAME, MigrationModel.LOCK_TIMEOUT)
+            except DatabaseError as e:
+                logging.error("Failed to lock migrations: " + e.args[1])
+                raise
+
+            if not locked or not locked["locked"]:
+                raise MigrationError("Timed out waiting for migrations of '{0}'".format(model.__class__.__name__))
+
+            try:
+                applied = await self.__applied__(db)
+
+                for name in names:
+                    if name in applied:
+                        continue
+
+                    logging.warning("Applying migration '{0}' ...".format(name))
+
+                    migration = getattr(model, "migration_" + name, None)
+
+                    if migration is not None:
+                        await migration(db)
+                    else:
+                        with open(application.module_path("sql/migrations/{0}.sql".format(name))) as f:
+                            await db.execute(f.read())
+
+                    await self.__record__(db, [name])
+                    logging.warning("Applied migration '{0}'".format(name))
+            except DatabaseError as e:
+                # the rest may depend on the one that has failed, and so do the models
+                logging.error("Failed to apply migrations of '{0}': {1}".format(
+                    model.__class__.__name__, e.args[1]))
+                raise
+            finally:
+                try:
+                    await db.get(
+                        """
+                            SELECT RELEASE_LOCK(%s);
+                        """, MigrationModel.LOCK_NAME)
+                except DatabaseError as e:
+                    logging.error("Failed to unlock migrations: " + e.args[1])
@@ -2,35 +2,95 @@ from tornado.ioloop import PeriodicCallback, IOLoop
 
 from anthill.common.model import Model
 from anthill.common.database import DatabaseError, format_conditions_json
-from anthill.common.validate import validate
+from anthill.common.validate import validate, validate_value, ValidationError
 from anthill.common.database import format_conditions_json
-from anthill.common.internal import Internal, InternalError
+from anthill.common.internal import Internal
 from anthill.common import to_int
 
-from .item import ItemFromUserAdapter, ItemError
+from .item import ItemFromUserAdapter, ItemError, ItemModel, ItemDeltas
+from .book import OrderBooks, OrderBooksFeed, payload_contains
+from .deadline import DeadlineScheduler
+from .lease import Lease
+from .matching import MatchingQueues
+from .retry import TransactionRunner
+from .outbox import MessageOutbox
 
 from datetime import datetime
+import asyncio
+import base64
+import binascii
+import hashlib
 import logging
+import re
 import ujson
+import uuid
 
 
 class OrderAdapter(object):
+    __slots__ = (
+        "order_id", "owner_id", "market_id", "give_item", "give_payload", "give_amount", "available",
+        "take_item", "take_payload", "take_amount", "give_hash", "take_hash", "payload", "time", "deadline")
+
     def __init__(self, data):
         self.order_id = str(data.get("order_id"))
         self.owner_id = str(data.get("owner_id"))
         self.market_id = str(data.get("market_id"))
         self.give_item = str(data.get("order_give_item"))
         self.give_payload = data.get("order_give_payload")
-        self.give_amount = str(data.get("order_give_amount"))
-        self.available = str(data.get("order_available"))
+        self.give_amount = int(data.get("order_give_amount"))
+        self.available = int(data.get("order_available"))
         self.take_item = str(data.get("order_take_item"))
         self.take_payload = data.get("order_take_payload")
-        self.take_amount = str(data.get("order_take_amount"))
+        self.take_amount = int(data.get("order_take_amount"))
+        self.give_hash = data.get("order_give_hash")
+        self.take_hash = data.get("order_take_hash")
         self.payload = data.get("order_payload")
         self.time = data.get("order_time")
         self.deadline = data.get("order_deadline")
 
 
+class PriceLevelAdapter(object):
+    """
+    Orders of the same give and take amounts. The price is in take items per one give item of the pair
+    the depth has been requested for, no matter which side the orders are on
+    """
+    __slots__ = ("give_amount", "take_amount", "price", "available", "orders")
+
+    def __init__(self, give_amount, take_amount, price, available, orders):
+        self.give_amount = int(give_amount)
+        self.take_amount = int(take_amount)
+        self.price = price
+        self.available = int(available)
+        self.orders = int(orders)
+
+
+class OrderFromUserAdapter(object):
+    """
+    An order to be placed, as sent by the user within a batch
+    """
+
+    def __init__(self, data):
+        try:
+            self.give_item = validate_value(data["give_item"], "str_name")
+            self.give_amount = validate_value(data.get("give_amount", 1), "int")
+            self.give_payload = validate_value(data.get("give_payload", {}), "json_dict")
+            self.take_item = validate_value(data["take_item"], "str_name")
+            self.take_amount = validate_value(data.get("take_amount", 1), "int")
+            self.take_payload = validate_value(data.get("take_payload", {}), "json_dict")
+            self.available = validate_value(data.get("orders_amount", 1), "int")
+            self.payload = validate_value(data.get("payload", {}), "json_dict")
+            self.deadline = validate_value(data["deadline"], "datetime")
+        except (ValidationError, KeyError, AttributeError, TypeError, ValueError):
+            raise OrderError(400, "Order's fields are missing or malformed")
+
+        for payload in (self.give_payload, self.take_payload):
+            if not all(isinstance(value, (str, int, float, bool)) for value in payload.values()):
+                raise OrderError(400, "Order's item payloads should only have primitive values")
+
+        self.give_hash = ItemModel.item_hash(self.give_item, self.give_payload)
+        self.take_hash = ItemModel.item_hash(self.take_item, self.take_payload)
+
+
 class OrderError(Exception):
     def __init__(self, code, message):
         self.code = code
@@ -70,10 +130,12 @@ class OrderQuery(object):
         self.owner = None
         self.give_item = None
         self.give_payload = None
+        self.give_payload_exact = False
         self.give_amount = None
         self.give_amount_comparison = None
         self.take_item = None
         self.take_payload = None
+        self.take_payload_exact = False
         self.take_amount = None
         self.take_amount_comparison = None
 
@@ -83,6 +145,16 @@ class OrderQuery(object):
         self.offset = 0
         self.limit = 0
 
+        # an opaque token returned as next_cursor by the previous page, replaces the offset
+        self.cursor = None
+        self.next_cursor = None
+
+        self.cache = None
+        self.count_ttl = 60
+
+        # payload keys having indexed columns
+        self.indexed_keys = set()
+
     def __values__(self):
         conditions = [
             "`gamespace_id`=%s",
@@ -102,10 +174,12 @@ class OrderQuery(object):
             conditions.append("`order_give_item`=%s")
             data.append(str(self.give_item))
 
-        if self.give_payload:
-            for condition, values in format_conditions_json('order_give_payload', self.give_payload):
-                conditions.append(condition)
-                data.extend(values)
+        if self.give_item and self.give_payload_exact:
+            # exact payload match, served by the hash index
+            conditions.append("`order_give_hash`=%s")
+            data.append(ItemModel.item_hash(self.give_item, self.give_payload or {}))
+        elif self.give_payload:
+            self.__payload_conditions__("give", self.give_payload, conditions, data)
 
         if self.give_amount and self.give_amount_comparison:
             if self.give_amount_comparison in OrderQuery.COMPARISONS:
@@ -116,10 +190,11 @@ class OrderQuery(object):
             conditions.append("`order_take_item`=%s")
             data.append(str(self.take_item))
 
-        if self.take_payload:
-            for condition, values in format_conditions_json('order_take_payload', self.give_payload):
-                conditions.append(condition)
-                data.extend(values)
+        if self.take_item and self.take_payload_exact:
+            conditions.append("`order_take_hash`=%s")
+            data.append(ItemModel.item_hash(self.take_item, self.take_payload or {}))
+        elif self.take_payload:
+            self.__payload_conditions__("take", self.take_payload, conditions, data)
 
         if self.take_amount and self.take_amount_comparison:
             if self.take_amount_comparison in OrderQuery.COMPARISONS:
@@ -128,34 +203,101 @@ class OrderQuery(object):
 
         return conditions, data
 
-    async def query(self, one=False, count=False):
+    def __payload_conditions__(self, side, payload, conditions, data):
+        """
+        Filters by the payload keys that have indexed columns are turned into plain equality conditions
+        on those columns, the rest are matched against the JSON payload itself
+        """
+        rest = {}
+
+        for key, value in payload.items():
+            # the columns only hold string values, as they are, so the rest are left to the JSON filter
+            if key in self.indexed_keys and isinstance(value, str):
+                conditions.append("`{0}`=%s".format(OrderModel.payload_column(side, key)))
+                data.append(value)
+            else:
+                rest[key] = value
+
+        if rest:
+            for condition, values in format_conditions_json("order_{0}_payload".format(side), rest):
+                conditions.append(condition)
+                data.extend(values)
+
+    def __sort__(self):
+        if self.sort_by in ["take_amount", "give_amount"]:
+            return "order_" + self.sort_by
+        return None
+
+    def __cursor_condition__(self):
+        """
+        Decodes the cursor of the previous page into a condition that continues right after its last row
+        """
+        try:
+            sort_by, sort_value, order_time, order_id = ujson.loads(
+                base64.urlsafe_b64decode(self.cursor.encode("ascii")).decode("utf-8"))
+            order_id = int(order_id)
+        except (ValueError, TypeError, UnicodeError, binascii.Error):
+            raise OrderQueryError(400, "Bad cursor")
+
+        sort = self.__sort__()
+
+        if sort_by != sort:
+            raise OrderQueryError(400, "The cursor does not belong to this sorting")
+
+        # rows are ordered by (sort key, order_time DESC, order_id DESC)
+        after = "(`order_time`<%s OR (`order_time`=%s AND `order_id`<%s))"
+        after_data = [order_time, order_time, order_id]
+
+        if sort is None:
+            return after, after_data
+
+        return "(`{0}`{1}%s OR (`{0}`=%s AND {2}))".format(sort, "<" if self.sort_desc else ">", after), \
+            [sort_value, sort_value] + after_data
+
+    def __next_cursor__(self, row):
+        sort = self.__sort__()
+        return base64.urlsafe_b64encode(ujson.dumps([
+            sort, row[sort] if sort else None, str(row["order_time"]), row["order_id"]
+        ]).encode("utf-8")).decode("ascii")
+
+    def __build__(self):
         conditions, data = self.__values__()
 
+        if self.cursor:
+            condition, values = self.__cursor_condition__()
+            conditions.append(condition)
+            data.extend(values)
+
         query = """
-            SELECT {0} * FROM `orders`
-            WHERE {1}
-        """.format(
-            "SQL_CALC_FOUND_ROWS" if count else "",
-            " AND ".join(conditions))
+            SELECT * FROM `orders`
+            WHERE {0}
+        """.format(" AND ".join(conditions))
 
-        if self.sort_by in ["take_amount", "give_amount"]:
-            sort = "`order_{0}` {1}, ".format(self.sort_by, "DESC" if self.sort_desc else "ASC")
-        else:
-            sort = ""
+        sort = self.__sort__()
 
         query += """
-            ORDER BY {0}`order_time` DESC
-        """.format(sort)
+            ORDER BY {0}`order_time` DESC, `order_id` DESC
+        """.format("`{0}` {1}, ".format(sort, "DESC" if self.sort_desc else "ASC") if sort else "")
 
         if self.limit:
-            query += """
-                LIMIT %s,%s
-            """
-            data.append(int(self.offset))
+            if self.cursor:
+                query += """
+                    LIMIT %s
+                """
+            else:
+                query += """
+                    LIMIT %s,%s
+                """
+                data.append(int(self.offset))
             data.append(int(self.limit))
 
         query += ";"
 
+        return query, data
+
+    async def query(self, one=False):
+        query, data = self.__build__()
+
         if one:
             try:
                 result = await self.db.get(query, *data)
@@ -172,62 +314,352 @@ class OrderQuery(object):
             except DatabaseError as e:
                 raise OrderQueryError(500, "Failed to query messages: " + e.args[1])
 
-            count_result = 0
+            if self.limit and len(result) >= int(self.limit):
+                self.next_cursor = self.__next_cursor__(result[-1])
+            else:
+                self.next_cursor = None
 
-            if count:
-                count_result = await self.db.get(
-                    """
-                        SELECT FOUND_ROWS() AS count;
-                    """)
-                count_result = count_result["count"]
+            return map(OrderAdapter, result)
+
+    async def stream(self, chunk_size=100):
+        """
+        Yields lists of at most chunk_size orders. Every chunk is a page of its own, read right after
+        the last row of the previous one (just like the next page is, see next_cursor), so no connection
+        is held while the caller deals with a chunk, and the whole result is never held in memory at once.
+        """
+        limit, cursor = self.limit, self.cursor
+        total = int(limit) if limit else None
+
+        self.next_cursor = None
 
-            items = map(OrderAdapter, result)
+        fetched = 0
+        last = None
 
-            if count:
-                return (items, count_result)
+        try:
+            while total is None or fetched < total:
+                self.limit = chunk_size if total is None else min(chunk_size, total - fetched)
+                query, data = self.__build__()
+
+                try:
+                    rows = await self.db.query(query, *data)
+                except DatabaseError as e:
+                    raise OrderQueryError(500, "Failed to query messages: " + e.args[1])
+
+                if not rows:
+                    break
+
+                fetched += len(rows)
+                last = rows[-1]
+
+                yield list(map(OrderAdapter, rows))
+
+                if len(rows) < self.limit:
+                    break
+
+                # the offset only applies to the first page
+                self.cursor = self.__next_cursor__(last)
+        finally:
+            self.limit, self.cursor = limit, cursor
+
+        if total and fetched >= total:
+            self.next_cursor = self.__next_cursor__(last)
+
+    async def count(self):
+        """
+        Returns an approximate amount of orders matching the query. The amount is cached for
+        count_ttl seconds, so it may lag behind the actual one.
+        """
+        conditions, data = self.__values__()
+
+        key = "orders:count:" + hashlib.sha256(ujson.dumps([conditions, data]).encode("utf-8")).hexdigest()
+
+        if self.cache is not None:
+            try:
+                async with self.cache.acquire() as kv:
+                    cached = await kv.get(key)
+            except Exception:
+                logging.exception("Failed to read cached orders count")
+                cached = None
+
+            if cached is not None:
+                return int(cached)
+
+        try:
+            result = await self.db.get(
+                """
+                    SELECT COUNT(*) AS `count` FROM `orders`
+                    WHERE {0};
+                """.format(" AND ".join(conditions)), *data)
+        except DatabaseError as e:
+            raise OrderQueryError(500, "Failed to count orders: " + e.args[1])
+
+        count = int(result["count"])
+
+        if self.cache is not None:
+            try:
+                async with self.cache.acquire() as kv:
+                    await kv.set(key, str(count), expire=self.count_ttl)
+            except Exception:
+                logging.exception("Failed to cache orders count")
 
-            return items
+        return count
 
 
 class OrderModel(Model):
 
     ORDER_COMPLETED = "order_completed"
     ORDER_CANCELLED = "order_cancelled"
+    ORDERS_CANCELLED = "orders_cancelled"
+
+    PAYLOAD_KEY_PATTERN = re.compile("^[A-Za-z0-9_]{1,32}$")
+    PAYLOAD_COLUMN_COLLATION = "utf8mb4_bin"
 
-    def __init__(self, app, db):
+    def __init__(self, app, db, order_book=False, expire_batch_size=500, expire_concurrency=4,
+                 expire_check_interval=300, outbox_batch_size=100, outbox_retries=5, outbox_poll_interval=5,
+                 lease_ttl=15, matching_distributed=False, matching_lock_timeout=5,
+                 transaction_retries=3, transaction_backoff=0.05, batch_limit=100, expire_orphan_grace=60):
         self.app = app
         self.db = db
         self.internal = Internal()
-        self.check_cb = PeriodicCallback(self.__check_due_orders__, callback_time=60000)
+        self.outbox = MessageOutbox(
+            app, db, self.internal, batch_size=outbox_batch_size, retries=outbox_retries,
+            poll_interval=outbox_poll_interval)
+        self.check_cb = PeriodicCallback(self.__check_due_orders__, callback_time=expire_check_interval * 1000)
+        self.books = OrderBooks() if order_book else None
+        self.books_feed = OrderBooksFeed(app, self.books, self.__load_books__) if order_book else None
+        self.matching = MatchingQueues(app, distributed=matching_distributed, lock_timeout=matching_lock_timeout)
+        self.runner = TransactionRunner(app, db, retries=transaction_retries, backoff=transaction_backoff)
+        self.batch_limit = batch_limit
+        self.expire_batch_size = expire_batch_size
+        self.expire_concurrency = expire_concurrency
+        self.expire_check_interval = expire_check_interval
+        self.expire_orphan_grace = expire_orphan_grace
+        self.expiring = False
+        # every node expires the orders it places (or prolongs) on time, the node holding the lease
+        # sweeps the ones nobody has expired within the grace (their nodes are gone), so each order
+        # has a single owner at a time
+        self.deadlines = DeadlineScheduler(self.__orders_due__)
+        self.expiry_lease = Lease(app, "market:orders_expiry", ttl=lease_ttl, on_acquired=self.__take_over_expiry__)
+        # payload keys having indexed columns, and the ones having columns at all
+        self.payload_keys = set()
+        self.payload_columns = set()
 
     async def started(self, application):
         await super().started(application)
+        await self.app.migrations.migrate(self, application)
+        await self.__load_payload_columns__()
+        await self.__upgrade_payload_columns__()
+        if self.books_feed is not None:
+            self.books_feed.start()
+        self.outbox.start()
+        self.expiry_lease.start()
         self.check_cb.start()
 
     async def stopped(self):
         self.check_cb.stop()
+        await self.expiry_lease.stop()
+        self.deadlines.stop()
+        if self.books_feed is not None:
+            await self.books_feed.stop()
+        await self.outbox.stop()
         await super().stopped()
 
     def get_setup_tables(self):
-        return ["orders"]
+        return ["orders", "order_events"]
 
     def get_setup_db(self):
         return self.db
 
+    def get_migrations(self):
+        return [
+            "orders_hashes",
+            "orders_composite_indexes",
+            "orders_batch",
+            "orders_ascending_indexes"
+        ]
+
+    async def setup_table_orders(self):
+        await self.app.migrations.baseline(self.get_migrations())
+
     def has_delete_account_event(self):
         return True
 
-    async def __send_message__(self, gamespace_id, recipient_class, recipient_key,
-                               account_id, message_type, payload):
+    async def migration_orders_hashes(self, db):
+        """
+        Adds payload hash columns to the `orders` tables created before they were introduced
+        """
+        columns = await db.query(
+            """
+                SHOW COLUMNS FROM `orders` LIKE 'order_give_hash';
+            """)
+
+        if not columns:
+            logging.warning("Adding payload hash columns to `orders` ...")
+            await db.execute(
+                """
+                    ALTER TABLE `orders`
+                    ADD COLUMN `order_give_hash` varchar(64) NOT NULL DEFAULT '' AFTER `order_take_amount`,
+                    ADD COLUMN `order_take_hash` varchar(64) NOT NULL DEFAULT '' AFTER `order_give_hash`,
+                    ADD KEY `orders_hashes_IDX` (`gamespace_id`,`market_id`,`order_give_hash`,
+                        `order_take_hash`,`order_take_amount`) USING BTREE;
+                """)
+
+        while True:
+            orders = await db.query(
+                """
+                    SELECT `order_id`, `order_give_item`, `order_give_payload`,
+                        `order_take_item`, `order_take_payload`
+                    FROM `orders`
+                    WHERE `order_give_hash`='' OR `order_take_hash`=''
+                    LIMIT 1000;
+                """)
+
+            if not orders:
+                break
+
+            for order in orders:
+                await db.execute(
+                    """
+                        UPDATE `orders`
+                        SET `order_give_hash`=%s, `order_take_hash`=%s
+                        WHERE `order_id`=%s;
+                    """,
+                    ItemModel.item_hash(order["order_give_item"], order["order_give_payload"] or {}),
+                    ItemModel.item_hash(order["order_take_item"], order["order_take_payload"] or {}),
+                    order["order_id"])
+
+            logging.warning("Updated payload hashes of {0} order(s)".format(len(orders)))
+
+    @staticmethod
+    def payload_column(side, key):
+        return "order_{0}_pk_{1}".format(side, key)
+
+    @staticmethod
+    def payload_column_definition(side, key):
+        """
+        Only string values make it into the column, compared exactly (case and trailing spaces included)
+        """
+        value = "JSON_EXTRACT(`order_{0}_payload`, '$.\"{1}\"')".format(side, key)
+
+        return "varchar(255) CHARACTER SET utf8mb4 COLLATE {0} GENERATED ALWAYS AS " \
+               "(IF(JSON_TYPE({1})='STRING', CAST(JSON_UNQUOTE({1}) AS CHAR(255)), NULL)) VIRTUAL".format(
+                   OrderModel.PAYLOAD_COLUMN_COLLATION, value)
+
+    async def __load_payload_columns__(self):
+        """
+        Finds out which payload keys have indexed columns. Columns defined the way they used to be
+        (holding every value as a string, case-insensitively) are not used, see __upgrade_payload_columns__
+        """
+        prefix = OrderModel.payload_column("give", "")
+
+        try:
+            columns = await self.db.query(
+                """
+                    SHOW FULL COLUMNS FROM `orders` LIKE %s;
+                """, prefix.replace("_", "\\_") + "%")
+        except DatabaseError as e:
+            logging.error("Failed to load payload columns: " + e.args[1])
+            return
+
+        self.payload_columns = set(column["Field"][len(prefix):] for column in columns)
+        self.payload_keys = set(
+            column["Field"][len(prefix):]
+            for column in columns
+            if column["Collation"] == OrderModel.PAYLOAD_COLUMN_COLLATION
+        )
+
+    async def __upgrade_payload_columns__(self):
+        outdated = sorted(self.payload_columns - self.payload_keys)
+        if not outdated:
+            return
+
+        try:
+            await self.index_payload_keys(outdated)
+        except OrderError as e:
+            logging.error("Failed to upgrade payload columns: " + e.message)
+
+    async def index_payload_keys(self, keys):
+        """
+        Makes sure the given payload keys have indexed generated columns on both sides of the orders,
+        so the order queries filtering by these keys do not have to scan the payloads
+        """
+        for key in keys:
+            if not OrderModel.PAYLOAD_KEY_PATTERN.match(key):
+                raise OrderError(400, "Bad payload key to index: {0}".format(key))
+
+        if all(key in self.payload_keys for key in keys):
+            return
+
+        # another node might have added some already
+        await self.__load_payload_columns__()
+
+        for key in keys:
+            if key in self.payload_keys:
+                continue
+
+            alters = []
+            for side in ("give", "take"):
+                column = OrderModel.payload_column(side, key)
+                definition = OrderModel.payload_column_definition(side, key)
+
+                if key in self.payload_columns:
+                    # defined the old way, the index is rebuilt along with the column
+                    alters.append("MODIFY COLUMN `{0}` {1}".format(column, definition))
+                else:
+                    alters.append("ADD COLUMN `{0}` {1}".format(column, definition))
+                    alters.append(
+                        "ADD KEY `orders_{0}_IDX` (`gamespace_id`,`market_id`,`order_{1}_item`,`{0}`)".format(
+                            column, side))
+
+            logging.warning("Adding indexed payload columns for key '{0}' to `orders` ...".format(key))
+
+            try:
+                await self.db.execute(
+                    """
+                        ALTER TABLE `orders` {0};
+                    """.format(", ".join(alters)))
+            except DatabaseError as e:
+                await self.__load_payload_columns__()
+                if key not in self.payload_keys:
+                    raise OrderError(500, "Failed to index payload key: " + e.args[1])
+            else:
+                self.payload_keys.add(key)
+
+    async def __load_books__(self):
+        """
+        Returns every resident order as a list of (gamespace_id, order), see OrderBooksFeed
+        """
         try:
-            await self.internal.request(
-                "message", "send_message",
-                gamespace=gamespace_id, sender=account_id,
-                recipient_class=recipient_class, recipient_key=recipient_key,
-                message_type=message_type, payload=payload, flags=['remove_delivered'],
-                authoritative=True)
-        except InternalError:
-            logging.exception("Could not deliver a message: {0}".format(message_type))
+            orders = await self.db.query(
+                """
+                    SELECT `order_id`, `gamespace_id`, `owner_id`, `market_id`,
+                        `order_give_item`, `order_give_payload`, `order_give_amount`, `order_available`,
+                        `order_take_item`, `order_take_payload`, `order_take_amount`
+                    FROM `orders`
+                    WHERE `order_available`!=0;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to load order books: " + e.args[1])
+            return None
+
+        return [(order["gamespace_id"], OrderAdapter(order)) for order in orders]
+
+    def __orders_due__(self, order_ids):
+        IOLoop.current().add_callback(self.__expire_due__, order_ids)
+
+    async def __expire_due__(self, order_ids):
+        chunks = [
+            order_ids[i:i + self.expire_batch_size]
+            for i in range(0, len(order_ids), self.expire_batch_size)
+        ]
+
+        expired = sum(await asyncio.gather(*[
+            self.__expire_worker__(chunks)
+            for _ in range(0, min(self.expire_concurrency, len(chunks)))
+        ]))
+
+        if expired:
+            self.app.monitor_action("orders.expiry", {"expired": expired})
 
     async def accounts_deleted(self, gamespace, accounts, gamespace_only):
         try:
@@ -246,6 +678,9 @@ class OrderModel(Model):
         except DatabaseError as e:
             raise OrderError(500, "Failed to delete user orders: " + e.args[1])
 
+        if self.books is not None:
+            self.books.remove_owners(gamespace if gamespace_only else None, accounts)
+
     @validate(gamespace_id="int", order_id="int")
     async def get_order(self, gamespace_id, order_id, db=None):
         try:
@@ -264,276 +699,865 @@ class OrderModel(Model):
 
         return OrderAdapter(data)
 
+    async def __take_over_expiry__(self):
+        self.__check_due_orders__()
+
     def __check_due_orders__(self):
+        if not self.expiry_lease.held:
+            return
+        if self.expiring:
+            logging.warning("Previous due orders check is still running, skipping")
+            return
         IOLoop.current().add_callback(self.delete_due_orders)
 
-    async def delete_due_orders(self):
-
-        logging.info("Deleting due orders ...")
-
+    async def __due_orders_backlog__(self):
         try:
-            orders = await self.db.query(
+            backlog = await self.db.get(
                 """
-                    SELECT `order_id`, `gamespace_id`
+                    SELECT COUNT(*) AS `count`
                     FROM `orders`
-                    WHERE NOW()>`order_deadline`;
-                """)
+                    WHERE `order_deadline`<NOW() - INTERVAL %s SECOND;
+                """, self.expire_orphan_grace)
         except DatabaseError:
-            logging.exception("Cannot delete due orders")
-            return
-
-        for order in orders:
-            order_id = order["order_id"]
-            gamespace_id = order["gamespace_id"]
-
+            logging.exception("Cannot count due orders")
+            return None
+
+        return backlog["count"]
+
+    async def __expire_orders__(self, order_ids):
+        """
+        Deletes a chunk of due orders in a single transaction, refunding what's left of them in bulk.
+        Orders that have been deleted or prolonged in the meantime are skipped.
+        :returns: a list of (gamespace_id, order) expired
+        """
+        async with self.db.acquire(auto_commit=False) as db:
             try:
-                await self.delete_order(gamespace_id, order_id)
-            except NoOrderError:
-                pass
-            except OrderError:
-                logging.exception("Cannot delete due order {0}/{1}".format(gamespace_id, order_id))
-            except ItemError:
-                logging.exception("Cannot delete due order {0}/{1}".format(gamespace_id, order_id))
-            else:
-                logging.info("Deleted due order: {0}/{1}".format(gamespace_id, order_id))
-
-        logging.info("Deleting done.")
-
-    @validate(gamespace_id="int", order_id="int")
-    async def delete_order(self, gamespace_id, order_id):
-        try:
-            async with self.db.acquire(auto_commit=False) as db:
-                order = await db.get(
+                rows = await db.query(
                     """
                         SELECT *
                         FROM `orders`
-                        WHERE `order_id`=%s AND `gamespace_id`=%s
+                        WHERE `order_id` IN %s AND `order_deadline`<NOW()
+                        ORDER BY `order_id`
                         FOR UPDATE;
-                    """, order_id, gamespace_id
-                )
+                    """, order_ids)
 
-                if not order:
-                    raise NoOrderError()
+                if not rows:
+                    await db.commit()
+                    return []
 
-                order = OrderAdapter(order)
+                expired = [(row["gamespace_id"], OrderAdapter(row)) for row in rows]
 
-                await self.app.items.update_item(
-                    gamespace_id, order.owner_id, order.market_id,
-                    order.give_item, int(order.give_amount) * int(order.available), order.give_payload,
-                    db=db)
+                await self.app.items.credit_items([
+                    (gamespace_id, order.owner_id, order.market_id, order.give_item, order.give_payload,
+                     order.give_hash or ItemModel.item_hash(order.give_item, order.give_payload or {}),
+                     order.give_amount * order.available)
+                    for gamespace_id, order in expired
+                ], db=db)
 
                 await db.execute(
                     """
                         DELETE
                         FROM `orders`
-                        WHERE `order_id`=%s AND `gamespace_id`=%s;
-                    """, order_id, gamespace_id)
-
+                        WHERE `order_id` IN %s;
+                    """, [order.order_id for gamespace_id, order in expired])
+
+                await self.outbox.add([
+                    self.__order_cancelled__(gamespace_id, order.market_id, order)
+                    for gamespace_id, order in expired
+                ], db)
+            except (DatabaseError, ItemError):
+                await db.rollback()
+                raise
+            else:
                 await db.commit()
+
+        self.outbox.wake()
+
+        await self.app.items.invalidate_inventories(set(
+            (gamespace_id, order.owner_id, order.market_id)
+            for gamespace_id, order in expired
+        ))
+
+        for gamespace_id, order in expired:
+            self.deadlines.cancel(order.order_id)
+            if self.books is not None:
+                self.books.remove_order(order.order_id)
+
+        return expired
+
+    async def __expire_worker__(self, chunks):
+        expired = 0
+        while chunks:
+            order_ids = chunks.pop()
+            try:
+                expired += len(await self.__expire_orders__(order_ids))
+            except DatabaseError as e:
+                logging.error("Cannot delete due orders: " + e.args[1])
+            except ItemError as e:
+                logging.error("Cannot delete due orders: " + e.message)
+        return expired
+
+    async def delete_due_orders(self):
+        """
+        Deletes every order past its deadline by more than `expire_orphan_grace`. Orders are expired
+        as soon as they are due by the deadline scheduler of the node that has placed them,
+        this is the fallback for the orders of the nodes that are gone (or have missed them).
+        Due orders are picked up by the deadline index in rounds,
+        each round is split into chunks of `expire_batch_size` orders processed by up to
+        `expire_concurrency` transactions at once.
+        """
+        if self.expiring:
+            return
+
+        self.expiring = True
+
+        try:
+            backlog = await self.__due_orders_backlog__()
+            if backlog is None:
+                return
+
+            self.app.monitor_action("orders.expiry", {"backlog": backlog})
+
+            if not backlog:
+                return
+
+            logging.info("Deleting {0} due order(s) ...".format(backlog))
+
+            total = 0
+
+            while True:
+                try:
+                    due = await self.db.query(
+                        """
+                            SELECT `order_id`
+                            FROM `orders`
+                            WHERE `order_deadline`<NOW() - INTERVAL %s SECOND
+                            ORDER BY `order_deadline`
+                            LIMIT %s;
+                        """, self.expire_orphan_grace, self.expire_batch_size * self.expire_concurrency)
+                except DatabaseError as e:
+                    logging.error("Cannot delete due orders: " + e.args[1])
+                    break
+
+                if not due:
+                    break
+
+                order_ids = [order["order_id"] for order in due]
+                chunks = [
+                    order_ids[i:i + self.expire_batch_size]
+                    for i in range(0, len(order_ids), self.expire_batch_size)
+                ]
+
+                expired = sum(await asyncio.gather(*[
+                    self.__expire_worker__(chunks)
+                    for _ in range(0, min(self.expire_concurrency, len(chunks)))
+                ]))
+
+                total += expired
+                self.app.monitor_action("orders.expiry", {"expired": expired})
+
+                if not expired:
+                    # nothing could be deleted this round, do not spin on the same orders
+                    break
+
+            logging.info("Deleted {0} due order(s)".format(total))
+        finally:
+            self.expiring = False
+
+    @validate(gamespace_id="int", order_id="int", market_id="int", owner_id="int")
+    async def delete_order(self, gamespace_id, order_id, market_id=None, owner_id=None):
+        """
+        Cancels the order and refunds what's left of it.
+        If market_id or owner_id are passed, the order has to belong to them.
+        """
+        async def cancel(db):
+            order = await db.get(
+                """
+                    SELECT *
+                    FROM `orders`
+                    WHERE `order_id`=%s AND `gamespace_id`=%s
+                    FOR UPDATE;
+                """, order_id, gamespace_id
+            )
+
+            if not order:
+                raise NoOrderError()
+
+            order = OrderAdapter(order)
+
+            if market_id is not None and order.market_id != str(market_id):
+                raise OrderError(409, "The order does not belong to the market")
+
+            if owner_id is not None and order.owner_id != str(owner_id):
+                raise OrderError(409, "The order has not been created by you.")
+
+            await self.app.items.update_item(
+                gamespace_id, order.owner_id, order.market_id,
+                order.give_item, order.give_amount * order.available, order.give_payload,
+                db=db)
+
+            await db.execute(
+                """
+                    DELETE
+                    FROM `orders`
+                    WHERE `order_id`=%s AND `gamespace_id`=%s;
+                """, order_id, gamespace_id)
+
+            await self.outbox.add([self.__order_cancelled__(gamespace_id, order.market_id, order)], db)
+            return order
+
+        try:
+            order = await self.runner.run("delete_order", cancel)
         except DatabaseError as e:
             raise OrderError(500, "Failed to gather order info: " + e.args[1])
         else:
-            await self.__order_cancelled__(gamespace_id, order.market_id, order)
+            self.outbox.wake()
+            await self.app.items.invalidate_inventories([(gamespace_id, order.owner_id, order.market_id)])
+            self.deadlines.cancel(order_id)
+            if self.books is not None:
+                self.books.remove_order(order_id)
+
+    @validate(gamespace_id="int", market_id="int", owner_id="int", order_ids="json_list_of_ints",
+              give_item="str_name", take_item="str_name")
+    async def delete_orders(self, gamespace_id, market_id, owner_id=None, order_ids=None,
+                            give_item=None, take_item=None):
+        """
+        Cancels many orders of the market at once: either the orders listed (of the owner, if passed),
+        or every order of the owner (optionally, of a single give and take item pair).
+        The orders are locked with a single query, what's left of them is refunded with a single
+        statement and they are deleted with another one. Each owner gets a single notification.
+        :returns: a list of the orders cancelled
+        """
+        if order_ids is None and owner_id is None:
+            raise OrderError(400, "Either orders or the owner should be specified")
+
+        if order_ids is not None:
+            if not order_ids:
+                return []
+
+            if len(order_ids) > self.batch_limit:
+                raise OrderError(400, "Cannot cancel more than {0} orders at once".format(self.batch_limit))
+
+        conditions = ["`gamespace_id`=%s", "`market_id`=%s"]
+        data = [gamespace_id, market_id]
+
+        if owner_id is not None:
+            conditions.append("`owner_id`=%s")
+            data.append(owner_id)
+
+        if order_ids is not None:
+            conditions.append("`order_id` IN %s")
+            data.append(sorted(set(order_ids)))
+
+        if give_item is not None:
+            conditions.append("`order_give_item`=%s")
+            data.append(give_item)
+
+        if take_item is not None:
+            conditions.append("`order_take_item`=%s")
+            data.append(take_item)
+
+        async def cancel(db):
+            rows = await db.query(
+                """
+                    SELECT *
+                    FROM `orders`
+                    WHERE {0}
+                    ORDER BY `order_id`
+                    FOR UPDATE;
+                """.format(" AND ".join(conditions)), *data)
+
+            if not rows:
+                return [], set()
+
+            cancelled = list(map(OrderAdapter, rows))
+
+            # orders giving the same item are refunded with a single upsert
+            deltas = ItemDeltas()
+            for order in cancelled:
+                deltas.add(
+                    gamespace_id, order.owner_id, order.market_id, order.give_item, order.give_payload,
+                    order.give_amount * order.available, item_hash=order.give_hash or None)
+
+            owners = deltas.owners()
+            await deltas.flush(self.app.items, db=db)
+
+            await db.execute(
+                """
+                    DELETE
+                    FROM `orders`
+                    WHERE `order_id` IN %s;
+                """, [order.order_id for order in cancelled])
+
+            await self.outbox.add(self.__orders_cancelled__(gamespace_id, market_id, cancelled), db)
+            return cancelled, owners
+
+        try:
+            cancelled, owners = await self.runner.run("delete_orders", cancel)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to cancel orders: " + e.args[1])
+        except ItemError as e:
+            raise OrderError(e.code, e.message)
+
+        if not cancelled:
+            return []
+
+        self.outbox.wake()
+        await self.app.items.invalidate_inventories(owners)
+
+        for order in cancelled:
+            self.deadlines.cancel(order.order_id)
+            if self.books is not None:
+                self.books.remove_order(order.order_id)
+
+        return cancelled
+
+    @validate(gamespace_id="int", market_id="int", give_item="str_name", give_payload="json_dict",
+              take_item="str_name", take_payload="json_dict")
+    async def best_prices(self, gamespace_id, market_id, give_item, give_payload, take_item, take_payload, db=None):
+        """
+        Returns the best bid and ask for the pair (either can be None), both in take items per one give item:
+        the bid is the most anyone is ready to give for the give item, the ask is the least the give item
+        is sold for.
+        """
+        give_hash = ItemModel.item_hash(give_item, give_payload or {})
+        take_hash = ItemModel.item_hash(take_item, take_payload or {})
+
+        try:
+            prices = await (db or self.db).get(
+                """
+                    SELECT
+                        (SELECT MAX(`order_give_amount` / `order_take_amount`)
+                            FROM `orders`
+                            WHERE `gamespace_id`=%s AND `market_id`=%s AND `order_give_hash`=%s AND
+                            `order_take_hash`=%s AND `order_available`!=0) AS `bid`,
+                        (SELECT MIN(`order_take_amount` / `order_give_amount`)
+                            FROM `orders`
+                            WHERE `gamespace_id`=%s AND `market_id`=%s AND `order_give_hash`=%s AND
+                            `order_take_hash`=%s AND `order_available`!=0) AS `ask`;
+                """, gamespace_id, market_id, take_hash, give_hash,
+                gamespace_id, market_id, give_hash, take_hash)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to gather order info: " + e.args[1])
+
+        bid = prices["bid"]
+        ask = prices["ask"]
+
+        return (None if bid is None else float(bid)), (None if ask is None else float(ask))
+
+    async def __price_levels__(self, gamespace_id, market_id, give_hash, take_hash, bids, limit, db=None):
+        """
+        Aggregates orders giving give_hash for take_hash by price, best first.
+        Bids are the orders of the opposite side of the pair asked for, so their price is flipped
+        """
+        if self.books is not None and self.books.synced:
+            levels = [
+                PriceLevelAdapter(
+                    give_amount, take_amount,
+                    give_amount / take_amount if bids else take_amount / give_amount,
+                    available, orders)
+                for (give_amount, take_amount), (available, orders) in
+                self.books.levels(gamespace_id, market_id, give_hash, take_hash).items()
+            ]
+            levels.sort(key=lambda level: level.price, reverse=bids)
+            return levels[:limit]
+
+        try:
+            data = await (db or self.db).query(
+                """
+                    SELECT `order_give_amount`, `order_take_amount`,
+                        SUM(`order_available`) AS `available`, COUNT(*) AS `orders`
+                    FROM `orders`
+                    WHERE `gamespace_id`=%s AND `market_id`=%s AND `order_give_hash`=%s AND
+                    `order_take_hash`=%s AND `order_available`!=0
+                    GROUP BY `order_take_amount`, `order_give_amount`
+                    ORDER BY {0}
+                    LIMIT %s;
+                """.format(
+                    "`order_give_amount` / `order_take_amount` DESC" if bids else
+                    "`order_take_amount` / `order_give_amount`"),
+                gamespace_id, market_id, give_hash, take_hash, limit)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to gather order info: " + e.args[1])
+
+        return [
+            PriceLevelAdapter(
+                row["order_give_amount"], row["order_take_amount"],
+                row["order_give_amount"] / row["order_take_amount"] if bids else
+                row["order_take_amount"] / row["order_give_amount"],
+                row["available"], row["orders"])
+            for row in data
+        ]
+
+    @validate(gamespace_id="int", market_id="int", give_item="str_name", give_payload="json_dict",
+              take_item="str_name", take_payload="json_dict", limit="int")
+    async def depth(self, gamespace_id, market_id, give_item, give_payload, take_item, take_payload,
+                    limit=20, db=None):
+        """
+        Returns (bids, asks) of the pair aggregated by price level, best first: asks are the orders
+        selling the give item for the take item, bids are the orders buying it.
+        """
+        if limit <= 0 or limit > 100:
+            raise OrderError(400, "Bad limit")
+
+        give_hash = ItemModel.item_hash(give_item, give_payload or {})
+        take_hash = ItemModel.item_hash(take_item, take_payload or {})
+
+        bids = await self.__price_levels__(gamespace_id, market_id, take_hash, give_hash, True, limit, db=db)
+        asks = await self.__price_levels__(gamespace_id, market_id, give_hash, take_hash, False, limit, db=db)
+
+        return bids, asks
 
     def orders_query(self, gamespace, marker_id=None):
-        return OrderQuery(gamespace, self.db, marker_id)
+        query = OrderQuery(gamespace, self.db, marker_id)
+        query.cache = self.app.cache
+        query.indexed_keys = self.payload_keys
+        return query
 
-    async def __order_completed__(self, gamespace_id, market_id, order,
-                                  give_amount, complete_amount, left_amount):
+    def __order_completed__(self, gamespace_id, market_id, order,
+                            give_amount, complete_amount, left_amount):
         logging.info("Order completed {0} time(s): {1}".format(complete_amount, order.order_id))
-        await self.__send_message__(
-            gamespace_id, "user", str(order.owner_id), str(order.owner_id), OrderModel.ORDER_COMPLETED, {
+        return (
+            gamespace_id, str(order.owner_id), "user", str(order.owner_id), OrderModel.ORDER_COMPLETED, {
                 "order_id": order.order_id,
                 "give_item": order.give_item,
                 "give_amount": int(give_amount),
                 "give_payload": order.give_payload,
                 "take_item": order.take_item,
-                "take_amount": int(order.take_amount),
+                "take_amount": order.take_amount,
                 "take_payload": order.take_payload,
                 "amount_completed": int(complete_amount),
                 "amount_left": int(left_amount),
                 "payload": order.payload
             })
 
-    async def __order_cancelled__(self, gamespace_id, market_id, order):
+    def __order_cancelled__(self, gamespace_id, market_id, order):
         logging.info("Order cancelled: {0}".format(order.order_id))
-        await self.__send_message__(
-            gamespace_id, "user", str(order.owner_id), str(order.owner_id), OrderModel.ORDER_CANCELLED, {
+        return (
+            gamespace_id, str(order.owner_id), "user", str(order.owner_id), OrderModel.ORDER_CANCELLED, {
                 "order_id": order.order_id,
                 "give_item": order.give_item,
-                "give_amount": int(order.give_amount),
+                "give_amount": order.give_amount,
                 "give_payload": order.give_payload,
                 "take_item": order.take_item,
-                "take_amount": int(order.take_amount),
+                "take_amount": order.take_amount,
                 "take_payload": order.take_payload,
-                "were_available": int(order.available),
+                "were_available": order.available,
                 "payload": order.payload
             })
 
+    def __orders_cancelled__(self, gamespace_id, market_id, orders):
+        """
+        Returns a single message per owner listing every order of the owner cancelled
+        """
+        by_owner = {}
+        for order in orders:
+            by_owner.setdefault(str(order.owner_id), []).append(order)
+
+        logging.info("Orders cancelled: {0}".format(", ".join(order.order_id for order in orders)))
+
+        return [
+            (gamespace_id, owner_id, "user", owner_id, OrderModel.ORDERS_CANCELLED, {
+                "market_id": str(market_id),
+                "orders": [
+                    {
+                        "order_id": order.order_id,
+                        "give_item": order.give_item,
+                        "give_amount": order.give_amount,
+                        "give_payload": order.give_payload,
+                        "take_item": order.take_item,
+                        "take_amount": order.take_amount,
+                        "take_payload": order.take_payload,
+                        "were_available": order.available,
+                        "payload": order.payload
+                    }
+                    for order in owner_orders
+                ]
+            })
+            for owner_id, owner_orders in by_owner.items()
+        ]
+
+    async def __order_pair__(self, gamespace_id, order_id):
+        try:
+            pair = await self.db.get(
+                """
+                    SELECT `order_give_item`, `order_take_item`
+                    FROM `orders`
+                    WHERE `order_id`=%s AND `gamespace_id`=%s;
+                """, order_id, gamespace_id)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to gather order info: " + e.args[1])
+
+        if pair is None:
+            return None
+
+        return pair["order_give_item"], pair["order_take_item"]
+
     @validate(order_id="int", gamespace_id="int", owner_id="int", market_id="int")
     async def fulfill_order(self, order_id, gamespace_id, owner_id, market_id):
+        """
+        Matches the order against the counter-orders, matches of the same pair are run one at a time
+        """
+        pair = await self.__order_pair__(gamespace_id, order_id)
+        if pair is None:
+            return
+
+        async with self.matching.lock(gamespace_id, market_id, *pair):
+            return await self.__fulfill_order__(order_id, gamespace_id, owner_id, market_id)
+
+    async def __fulfill_order__(self, order_id, gamespace_id, owner_id, market_id):
 
+        async def match(db):
+            return await self.__match__(db, order_id, gamespace_id, owner_id, market_id)
+
+        result = await self.runner.run("fulfill_order", match)
+
+        if result is None:
+            return
+
+        await self.__matched__(result)
+        return result[0] == 0
+
+    async def __matched__(self, result):
+        """
+        Applies what __match__ has done to everything but the database, once it is committed
+        """
+        orders_to_fulfill, updated_orders, owners, stale = result
+
+        self.outbox.wake()
+        await self.app.items.invalidate_inventories(owners)
+
+        if self.books is not None:
+            for gamespace_id, stale_order_id, stale_order in stale:
+                if stale_order is None:
+                    self.books.remove_order(stale_order_id)
+                else:
+                    self.books.add_order(gamespace_id, stale_order)
+
+        for updated_order_id, available in updated_orders:
+            if available <= 0:
+                self.deadlines.cancel(updated_order_id)
+            if self.books is not None:
+                self.books.update_order(updated_order_id, available)
+
+    async def __match__(self, db, order_id, gamespace_id, owner_id, market_id):
+        """
+        Matches the order against the counter-orders within the transaction db.
+        Returns (orders left unfulfilled, [(order_id, available)] of the orders changed, inventories changed,
+        [(gamespace_id, order_id, order or None)] of the counter-orders the book is wrong about),
+        or None if there is no such order to match
+        """
         items = self.app.items
         transactions = self.app.transactions
 
-        async with (self.db.acquire(auto_commit=False)) as db:
-            item_to_fulfill_data = await db.get(
-                """
-                SELECT * FROM `orders`
-                WHERE gamespace_id=%s AND market_id=%s AND owner_id=%s AND `order_available`!=0
-                FOR UPDATE;
-                """, gamespace_id, market_id, owner_id)
+        item_to_fulfill_data = await db.get(
+            """
+            SELECT * FROM `orders`
+            WHERE order_id=%s AND gamespace_id=%s AND market_id=%s AND owner_id=%s AND `order_available`!=0;
+            """, order_id, gamespace_id, market_id, owner_id)
 
-            if item_to_fulfill_data is None:
-                return
+        if item_to_fulfill_data is None:
+            return None
 
-            fulfill = OrderAdapter(item_to_fulfill_data)
+        fulfill = OrderAdapter(item_to_fulfill_data)
 
-            logging.info(
-                "Matching orders: gc {0} ac {1} mk {2} give item {3} ({5}) give {7} "
-                "take item {4} ({6}) take {8} amount of orders {9}".format(
-                    gamespace_id, owner_id, market_id, fulfill.give_item, fulfill.take_item,
-                    ujson.dumps(fulfill.give_payload), ujson.dumps(fulfill.take_payload),
-                    fulfill.give_amount, fulfill.take_amount, fulfill.available))
+        # counter-orders are looked up without locking, best first
+        candidates = await self.__candidates__(db, gamespace_id, fulfill)
 
-            orders_to_fulfill = int(fulfill.available)
-            backup = 0
+        # then the order and its counter-orders are locked at once, in the order of their ids,
+        # so matches locking some of the same orders never wait for each other in a circle
+        query, data = OrderModel.__lock_orders_query__(gamespace_id, [int(order_id)] + candidates)
+        locked = await db.query(query, *data)
 
-            completed_orders = []
+        locked = {int(row["order_id"]): OrderAdapter(row) for row in locked}
 
-            matching_orders = await db.query(
-                """
-                SELECT * 
-                FROM `orders`
-                WHERE `gamespace_id`=%s AND `market_id`=%s 
-                AND `order_take_item`=%s AND `order_give_item`=%s 
-                AND JSON_CONTAINS(%s, `order_take_payload`) AND JSON_CONTAINS(`order_give_payload`, %s)
-                AND %s>=`order_take_amount` AND `order_give_amount`>=%s AND `owner_id`!=%s
-                ORDER BY `order_take_amount`, `order_give_amount`, `order_time` DESC
-                FOR UPDATE;
-                """, gamespace_id, market_id, fulfill.give_item, fulfill.take_item,
+        # anything could have changed before the lock, so the conditions are checked again
+        fulfill = locked.get(int(order_id))
+        if fulfill is None or fulfill.available <= 0 or \
+                fulfill.owner_id != str(owner_id) or fulfill.market_id != str(market_id):
+            return None
+
+        matching_orders = [
+            locked[candidate]
+            for candidate in candidates
+            if candidate in locked and OrderModel.__counter_order__(fulfill, locked[candidate])
+        ]
+
+        # whatever the database did not confirm is stale in the book, it's fixed once committed
+        # (the transaction could be run again)
+        confirmed = set(int(matched.order_id) for matched in matching_orders)
+        stale = [
+            (gamespace_id, candidate, locked.get(candidate))
+            for candidate in candidates
+            if candidate not in confirmed
+        ]
+
+        logging.info(
+            "Matching orders: gc {0} ac {1} mk {2} give item {3} ({5}) give {7} "
+            "take item {4} ({6}) take {8} amount of orders {9}".format(
+                gamespace_id, owner_id, market_id, fulfill.give_item, fulfill.take_item,
                 ujson.dumps(fulfill.give_payload), ujson.dumps(fulfill.take_payload),
-                fulfill.give_amount, fulfill.take_amount, owner_id)
+                fulfill.give_amount, fulfill.take_amount, fulfill.available))
 
-            for matched in map(OrderAdapter, matching_orders):
-                price_difference = int(fulfill.give_amount) - int(matched.take_amount)
+        orders_to_fulfill = fulfill.available
+        backup = 0
 
-                if int(matched.available) >= orders_to_fulfill:
-                    fulfill_amount = orders_to_fulfill
-                    updated_amount = int(matched.available) - orders_to_fulfill
-                else:
-                    fulfill_amount = int(matched.available)
-                    updated_amount = 0
+        completed_orders = []
+        fills = []
+        deltas = ItemDeltas()
 
-                backup += price_difference * fulfill_amount
-                orders_to_fulfill -= fulfill_amount
+        fulfill_give_hash = ItemModel.item_hash(fulfill.give_item, fulfill.give_payload or {})
 
-                logging.info(
-                    "Order matched: id {8} ac {0} give item {1} ({3}) give {5} take item {2} ({4}) take {6} "
-                    "amount of orders {7}".format(
-                        matched.owner_id, matched.give_item, matched.take_item,
-                        matched.give_payload, matched.take_payload, matched.give_amount, matched.take_amount,
-                        matched.available, matched.order_id))
+        updated_orders = []
 
-                logging.info("Giving {1} items to the matched seller: {0}".format(
-                    fulfill.give_item, int(fulfill_amount) * int(matched.take_amount)))
+        for matched in matching_orders:
+            price_difference = fulfill.give_amount - matched.take_amount
 
-                completed_orders.append(
-                    (matched, fulfill.take_amount, fulfill_amount,  int(matched.available) - fulfill_amount))
+            if matched.available >= orders_to_fulfill:
+                fulfill_amount = orders_to_fulfill
+                updated_amount = matched.available - orders_to_fulfill
+            else:
+                fulfill_amount = matched.available
+                updated_amount = 0
 
-                await transactions.new_transaction(
-                    gamespace_id, market_id, fulfill.give_item, fulfill.give_payload, int(matched.take_amount),
-                    fulfill.owner_id, matched.give_item, matched.give_payload, int(fulfill.take_amount),
-                    matched.owner_id, int(fulfill_amount), db=db)
+            backup += price_difference * fulfill_amount
+            orders_to_fulfill -= fulfill_amount
 
-                await items.update_item(
-                    gamespace_id, matched.owner_id, market_id, fulfill.give_item,
-                    fulfill_amount * int(matched.take_amount),
-                    fulfill.give_payload, db=db)
+            logging.info(
+                "Order matched: id {8} ac {0} give item {1} ({3}) give {5} take item {2} ({4}) take {6} "
+                "amount of orders {7}".format(
+                    matched.owner_id, matched.give_item, matched.take_item,
+                    matched.give_payload, matched.take_payload, matched.give_amount, matched.take_amount,
+                    matched.available, matched.order_id))
+
+            logging.info("Giving {1} items to the matched seller: {0}".format(
+                fulfill.give_item, int(fulfill_amount) * matched.take_amount))
+
+            completed_orders.append(
+                (matched, fulfill.take_amount, fulfill_amount,  matched.available - fulfill_amount))
+
+            fills.append({
+                "give_item": fulfill.give_item,
+                "give_payload": fulfill.give_payload,
+                "give_hash": fulfill_give_hash,
+                "give_amount": matched.take_amount,
+                "give_owner": fulfill.owner_id,
+                "take_item": matched.give_item,
+                "take_payload": matched.give_payload,
+                "take_hash": matched.give_hash,
+                "take_amount": fulfill.take_amount,
+                "take_owner": matched.owner_id,
+                "amount": int(fulfill_amount)
+            })
 
-                logging.info("Giving {1} items to the original seller: {0}".format(
-                    matched.give_item, int(fulfill_amount) * int(fulfill.take_amount)))
+            deltas.add(
+                gamespace_id, matched.owner_id, market_id, fulfill.give_item, fulfill.give_payload,
+                fulfill_amount * matched.take_amount, item_hash=fulfill_give_hash)
 
-                completed_orders.append(
-                    (fulfill, matched.take_amount, fulfill_amount, int(fulfill.available) - fulfill_amount))
+            logging.info("Giving {1} items to the original seller: {0}".format(
+                matched.give_item, int(fulfill_amount) * fulfill.take_amount))
 
-                await items.update_item(
-                    gamespace_id, fulfill.owner_id, market_id, matched.give_item,
-                    fulfill_amount * int(fulfill.take_amount),
-                    matched.give_payload, db=db)
+            completed_orders.append(
+                (fulfill, matched.take_amount, fulfill_amount, fulfill.available - fulfill_amount))
 
-                matched_price_difference = int(matched.give_amount) - int(fulfill.take_amount)
+            deltas.add(
+                gamespace_id, fulfill.owner_id, market_id, matched.give_item, matched.give_payload,
+                fulfill_amount * fulfill.take_amount, item_hash=matched.give_hash or None)
 
-                matched_backup = matched_price_difference * fulfill_amount
+            matched_price_difference = matched.give_amount - fulfill.take_amount
 
-                if matched_backup > 0:
-                    logging.info("Giving {1} items back to the original seller: {0}".format(
-                        fulfill.take_item, matched_backup))
+            matched_backup = matched_price_difference * fulfill_amount
 
-                    await items.update_item(
-                        gamespace_id, matched.owner_id, market_id, matched.give_item,
-                        matched_backup,
-                        matched.give_payload, db=db)
+            if matched_backup > 0:
+                logging.info("Giving {1} items back to the original seller: {0}".format(
+                    fulfill.take_item, matched_backup))
 
-                if updated_amount == 0:
-                    logging.info("Deleted order: {0}".format(matched.order_id))
-                    await db.execute(
-                        """
-                        DELETE FROM `orders`
-                        WHERE `order_id`=%s;
-                        """, matched.order_id)
-                else:
-                    logging.info("Updated order {0} availability to: {1}".format(matched.order_id, updated_amount))
-                    await db.execute(
-                        """
-                        UPDATE `orders`
-                        SET `order_available`=%s
-                        WHERE `order_id`=%s;
-                        """, updated_amount, matched.order_id)
+                deltas.add(
+                    gamespace_id, matched.owner_id, market_id, matched.give_item, matched.give_payload,
+                    matched_backup, item_hash=matched.give_hash or None)
 
-                if orders_to_fulfill <= 0:
-                    logging.info("Order has been fulfilled, skipping matching")
-                    break
+            updated_orders.append((matched.order_id, updated_amount))
 
-            if orders_to_fulfill == 0:
-                logging.info("Deleted original order: {0}".format(order_id))
+            if updated_amount == 0:
+                logging.info("Deleted order: {0}".format(matched.order_id))
                 await db.execute(
                     """
                     DELETE FROM `orders`
                     WHERE `order_id`=%s;
-                    """, order_id)
+                    """, matched.order_id)
             else:
-                if orders_to_fulfill != int(fulfill.available):
-                    logging.info("Updated original order {0} availability to: {1}".format(order_id, orders_to_fulfill))
-                    await db.execute(
-                        """
-                        UPDATE `orders`
-                        SET `order_available`=%s
-                        WHERE `order_id`=%s;
-                        """, orders_to_fulfill, order_id)
+                logging.info("Updated order {0} availability to: {1}".format(matched.order_id, updated_amount))
+                await db.execute(
+                    """
+                    UPDATE `orders`
+                    SET `order_available`=%s
+                    WHERE `order_id`=%s;
+                    """, updated_amount, matched.order_id)
+
+            if orders_to_fulfill <= 0:
+                logging.info("Order has been fulfilled, skipping matching")
+                break
+
+        if orders_to_fulfill == 0:
+            logging.info("Deleted original order: {0}".format(order_id))
+            await db.execute(
+                """
+                DELETE FROM `orders`
+                WHERE `order_id`=%s;
+                """, order_id)
+        else:
+            if orders_to_fulfill != fulfill.available:
+                logging.info("Updated original order {0} availability to: {1}".format(order_id, orders_to_fulfill))
+                await db.execute(
+                    """
+                    UPDATE `orders`
+                    SET `order_available`=%s
+                    WHERE `order_id`=%s;
+                    """, orders_to_fulfill, order_id)
+
+        if backup > 0:
+            logging.info("Giving items back: {0} of {1} ({2})".format(
+                backup, fulfill.give_item, ujson.dumps(fulfill.give_payload)))
+
+            deltas.add(
+                gamespace_id, owner_id, market_id, fulfill.give_item, fulfill.give_payload,
+                backup, item_hash=fulfill_give_hash)
+
+        # every item change and every transaction of the sweep is written at once
+        await deltas.flush(items, db=db)
+        await transactions.new_transactions_bulk(gamespace_id, market_id, fills, db=db)
+
+        await self.outbox.add([
+            self.__order_completed__(gamespace_id, market_id, completed, g_amount, amount, left)
+            for completed, g_amount, amount, left in completed_orders
+        ], db)
+
+        logging.info("Matching complete")
+
+        updated_orders.append((order_id, orders_to_fulfill))
+        return orders_to_fulfill, updated_orders, deltas.owners(), stale
+
+    @staticmethod
+    def __counter_order__(fulfill, matched):
+        """
+        Checks that the matched order is a counter-order of the one being fulfilled (what the lookup queries check)
+        """
+        return matched.market_id == fulfill.market_id and matched.owner_id != fulfill.owner_id and \
+            matched.take_item == fulfill.give_item and matched.give_item == fulfill.take_item and \
+            payload_contains(fulfill.give_payload or {}, matched.take_payload or {}) and \
+            payload_contains(matched.give_payload or {}, fulfill.take_payload or {}) and \
+            fulfill.give_amount >= matched.take_amount and matched.give_amount >= fulfill.take_amount and \
+            matched.available > 0
+
+    @staticmethod
+    def __exact_candidates_query__(gamespace_id, fulfill):
+        """
+        Returns (query, data) looking up the counter-orders of the same payloads as the given order, best first
+        """
+        return """
+            SELECT `order_id`, `order_available`, `order_take_amount`, `order_give_amount`, `order_time`
+            FROM `orders`
+            WHERE `gamespace_id`=%s AND `market_id`=%s
+            AND `order_give_hash`=%s AND `order_take_hash`=%s
+            AND %s>=`order_take_amount` AND `order_give_amount`>=%s AND `owner_id`!=%s
+            ORDER BY `order_take_amount`, `order_give_amount`, `order_time` DESC;
+        """, [
+            gamespace_id, fulfill.market_id,
+            ItemModel.item_hash(fulfill.take_item, fulfill.take_payload or {}),
+            ItemModel.item_hash(fulfill.give_item, fulfill.give_payload or {}),
+            fulfill.give_amount, fulfill.take_amount, fulfill.owner_id
+        ]
 
-            if backup > 0:
-                logging.info("Giving items back: {0} of {1} ({2})".format(
-                    backup, fulfill.give_item, ujson.dumps(fulfill.give_payload)))
+    @staticmethod
+    def __contained_candidates_query__(gamespace_id, fulfill, excluded):
+        """
+        Returns (query, data) looking up the counter-orders whose payloads contain or are contained by
+        the ones of the given order (except for the excluded order ids), best first
+        """
+        return """
+            SELECT `order_id`, `order_available`, `order_take_amount`, `order_give_amount`, `order_time`
+            FROM `orders`
+            WHERE `gamespace_id`=%s AND `market_id`=%s
+            AND `order_take_item`=%s AND `order_give_item`=%s
+            AND JSON_CONTAINS(%s, `order_take_payload`) AND JSON_CONTAINS(`order_give_payload`, %s)
+            AND %s>=`order_take_amount` AND `order_give_amount`>=%s AND `owner_id`!=%s
+            AND `order_id` NOT IN %s
+            ORDER BY `order_take_amount`, `order_give_amount`, `order_time` DESC;
+        """, [
+            gamespace_id, fulfill.market_id, fulfill.give_item, fulfill.take_item,
+            ujson.dumps(fulfill.give_payload), ujson.dumps(fulfill.take_payload),
+            fulfill.give_amount, fulfill.take_amount, fulfill.owner_id,
+            list(excluded) or [0]
+        ]
 
-                await items.update_item(
-                    gamespace_id, owner_id, market_id, fulfill.give_item,
-                    backup, fulfill.give_payload, db=db)
+    @staticmethod
+    def __lock_orders_query__(gamespace_id, order_ids):
+        """
+        Returns (query, data) locking the given orders in the order of their ids
+        """
+        return """
+            SELECT * FROM `orders`
+            WHERE `order_id` IN %s AND `gamespace_id`=%s
+            ORDER BY `order_id`
+            FOR UPDATE;
+        """, [sorted(set(order_ids)), gamespace_id]
+
+    async def __candidates__(self, db, gamespace_id, fulfill):
+        """
+        Returns ids of the orders that may match the given one, best first
+        """
+        booked = []
+
+        # books missing the changes of other nodes would miss their orders, so the database is asked instead
+        if self.books is not None and self.books.synced:
+            booked, enough = self.books.candidates(gamespace_id, fulfill)
+
+            # so are the orders just placed on other nodes, that have not made it to the book yet,
+            # hence the database is asked whenever the book falls short
+            if enough:
+                return booked
+
+        # counter-orders that take and give exactly what this order gives and takes are found
+        # by the hash index alone
+        query, data = OrderModel.__exact_candidates_query__(gamespace_id, fulfill)
+        exact = await db.query(query, *data)
+
+        exact_available = sum(int(candidate["order_available"]) for candidate in exact)
+
+        if exact_available >= fulfill.available:
+            candidates = exact
+        else:
+            # fall back to the payload containment for the rest
+            query, data = OrderModel.__contained_candidates_query__(
+                gamespace_id, fulfill, [int(candidate["order_id"]) for candidate in exact])
+            contained = await db.query(query, *data)
 
-            logging.info("Matching complete")
-            await db.commit()
+            # both are merged in the same order the queries sort by, newer orders going first on a tie
+            candidates = sorted(
+                exact + contained, key=lambda c: (c["order_time"], int(c["order_id"])), reverse=True)
+            candidates.sort(key=lambda c: (int(c["order_take_amount"]), int(c["order_give_amount"])))
 
-            for completed, g_amount, amount, left in completed_orders:
-                await self.__order_completed__(gamespace_id, market_id, completed, g_amount, amount, left)
+        candidates = [int(candidate["order_id"]) for candidate in candidates]
 
-            return orders_to_fulfill == 0
+        # the ones only the book knows about go last, so the match finds out they are stale
+        found = set(candidates)
+        return candidates + [candidate for candidate in booked if candidate not in found]
 
     @validate(order_id="int", gamespace_id="int", fulfill_account="int", market_id="int", orders_amount="int")
     async def fulfill_order_with_account(self, order_id, gamespace_id, fulfill_account, market_id, orders_amount):
+        pair = await self.__order_pair__(gamespace_id, order_id)
+        if pair is None:
+            return None
+
+        async with self.matching.lock(gamespace_id, market_id, *pair):
+            return await self.__fulfill_order_with_account__(
+                order_id, gamespace_id, fulfill_account, market_id, orders_amount)
+
+    async def __fulfill_order_with_account__(self, order_id, gamespace_id, fulfill_account, market_id, orders_amount):
         items = self.app.items
         transactions = self.app.transactions
 
-        async with (self.db.acquire(auto_commit=False)) as db:
+        async def fulfill(db):
             item_to_fulfill_data = await db.get(
                 """
                 SELECT * FROM `orders`
@@ -553,8 +1577,8 @@ class OrderModel(Model):
                     ujson.dumps(order.give_payload), ujson.dumps(order.take_payload),
                     order.give_amount, order.take_amount, order.available))
 
-            items_needed = int(order.take_amount) * int(orders_amount)
-            items_given = int(order.give_amount) * int(orders_amount)
+            items_needed = order.take_amount * int(orders_amount)
+            items_given = order.give_amount * int(orders_amount)
 
             logging.info("Taking {1} items from the fulfiller: {0}".format(
                 order.take_item, items_needed))
@@ -570,25 +1594,36 @@ class OrderModel(Model):
             logging.info("Giving {1} items to the original seller: {0}".format(
                 order.take_item, items_needed))
 
-            await items.update_item(
-                gamespace_id, order.owner_id, market_id, order.take_item,
-                items_needed,
-                order.take_payload, db=db)
+            deltas = ItemDeltas()
+
+            deltas.add(
+                gamespace_id, order.owner_id, market_id, order.take_item, order.take_payload,
+                items_needed, item_hash=order.take_hash or None)
 
             logging.info("Giving {1} items to the fulfiller: {0}".format(
                 order.give_item, items_given))
 
-            await items.update_item(
-                gamespace_id, fulfill_account, market_id, order.give_item,
-                items_given,
-                order.give_payload, db=db)
+            deltas.add(
+                gamespace_id, fulfill_account, market_id, order.give_item, order.give_payload,
+                items_given, item_hash=order.give_hash or None)
+
+            await deltas.flush(items, db=db)
 
-            await transactions.new_transaction(
-                gamespace_id, market_id, order.give_item, order.give_payload, int(order.give_amount),
-                order.owner_id, order.take_item, order.take_payload, int(order.take_amount),
-                fulfill_account, int(orders_amount), db=db)
+            await transactions.new_transactions_bulk(gamespace_id, market_id, [{
+                "give_item": order.give_item,
+                "give_payload": order.give_payload,
+                "give_hash": order.give_hash,
+                "give_amount": order.give_amount,
+                "give_owner": order.owner_id,
+                "take_item": order.take_item,
+                "take_payload": order.take_payload,
+                "take_hash": order.take_hash,
+                "take_amount": order.take_amount,
+                "take_owner": fulfill_account,
+                "amount": int(orders_amount)
+            }], db=db)
 
-            orders_left = int(order.available) - int(orders_amount)
+            orders_left = order.available - int(orders_amount)
 
             if orders_left > 0:
                 logging.info("Updated original order {0} availability to: {1}".format(order_id, orders_left))
@@ -606,14 +1641,29 @@ class OrderModel(Model):
                     WHERE `order_id`=%s;
                     """, order_id)
 
-            await db.commit()
+            await self.outbox.add([self.__order_completed__(
+                gamespace_id, market_id, order, order.give_amount,
+                int(orders_amount), orders_left)], db)
+
             logging.info("Fulfillment complete")
+            return orders_left, deltas.owners() | {(gamespace_id, fulfill_account, market_id)}
 
-            await self.__order_completed__(
-                gamespace_id, market_id, order, order.give_amount,
-                int(orders_amount), orders_left)
+        result = await self.runner.run("fulfill_order_with_account", fulfill)
+
+        if result is None:
+            return None
 
-            return orders_left <= 0
+        orders_left, owners = result
+
+        self.outbox.wake()
+        await items.invalidate_inventories(owners)
+
+        if orders_left <= 0:
+            self.deadlines.cancel(order_id)
+        if self.books is not None:
+            self.books.update_order(order_id, orders_left)
+
+        return orders_left <= 0
 
     @validate(gamespace_id="int", order_id="int", market_id="int", order_give_item="str_name",
               order_give_payload="json", order_give_amount="int", order_take_item="str_name", order_take_payload="json",
@@ -628,32 +1678,37 @@ class OrderModel(Model):
         if order_take_amount <= 0 or order_give_amount <= 0 or order_available <= 0:
             raise OrderError(400, "Bad order amounts")
 
+        async def place(db):
+            if subtract_items:
+                if not await self.app.items.subtract_item(
+                        gamespace_id, owner_id, market_id,
+                        order_give_item, int(order_give_amount) * int(order_available),
+                        order_give_payload, db=db):
+                    raise OrderError(409, "Not enough items to generate an order")
+
+            # only create order after all of the items have been successfully subtracted
+            return await db.insert(
+                """
+                    INSERT INTO `orders` 
+                    (gamespace_id, owner_id, market_id, order_give_item, order_give_payload, order_give_amount, 
+                        order_take_item, order_take_payload, order_take_amount, order_available, order_payload, 
+                        order_deadline, order_give_hash, order_take_hash)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                """, gamespace_id, owner_id, market_id, order_give_item, ujson.dumps(order_give_payload),
+                order_give_amount, order_take_item, ujson.dumps(order_take_payload), order_take_amount,
+                order_available, ujson.dumps(order_payload), order_deadline,
+                ItemModel.item_hash(order_give_item, order_give_payload or {}),
+                ItemModel.item_hash(order_take_item, order_take_payload or {}))
+
         try:
-            async with self.db.acquire(auto_commit=False) as db:
-                if subtract_items:
-                    if not await self.app.items.subtract_item(
-                            gamespace_id, owner_id, market_id,
-                            order_give_item, int(order_give_amount) * int(order_available),
-                            order_give_payload, db=db):
-                        raise OrderError(409, "Not enough items to generate an order")
-
-                # only create order after all of the items have been successfully subtracted
-                order_id = await db.insert(
-                    """
-                        INSERT INTO `orders` 
-                        (gamespace_id, owner_id, market_id, order_give_item, order_give_payload, order_give_amount, 
-                            order_take_item, order_take_payload, order_take_amount, order_available, order_payload, 
-                            order_deadline)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    """, gamespace_id, owner_id, market_id, order_give_item, ujson.dumps(order_give_payload),
-                    order_give_amount, order_take_item, ujson.dumps(order_take_payload), order_take_amount,
-                    order_available, ujson.dumps(order_payload), order_deadline)
-
-                # commit both the subtraction and the order at the same time
-                await db.commit()
+            # commit both the subtraction and the order at the same time
+            order_id = await self.runner.run("new_order", place)
         except DatabaseError as e:
             raise OrderError(500, "Failed to gather order info: " + e.args[1])
 
+        if subtract_items:
+            await self.app.items.invalidate_inventories([(gamespace_id, owner_id, market_id)])
+
         logging.info(
             "User {0} gc {1} mk {2} created an {3} order(s) to sell {4} of {5}({6}) and "
             "buy {7} of {8}({9})".format(
@@ -662,8 +1717,170 @@ class OrderModel(Model):
                 ujson.dumps(order_give_payload), order_take_amount, order_take_item,
                 ujson.dumps(order_take_payload)))
 
+        self.deadlines.schedule(order_id, order_deadline)
+
+        if self.books is not None:
+            self.books.add_order(gamespace_id, OrderAdapter({
+                "order_id": order_id,
+                "owner_id": owner_id,
+                "market_id": market_id,
+                "order_give_item": order_give_item,
+                "order_give_payload": order_give_payload,
+                "order_give_amount": order_give_amount,
+                "order_available": order_available,
+                "order_take_item": order_take_item,
+                "order_take_payload": order_take_payload,
+                "order_take_amount": order_take_amount
+            }))
+
         return order_id
 
+    @validate(gamespace_id="int", owner_id="int", market_id="int", orders="json_list")
+    async def new_orders(self, gamespace_id, owner_id, market_id, orders):
+        """
+        Places many orders of the same owner at once: the items of every order are subtracted with a single
+        statement, and the orders are inserted with another one. Either every order is placed, or none.
+        :returns: a list of the orders placed as (order_id, OrderFromUserAdapter), in the same order
+        """
+        if not orders:
+            raise OrderError(400, "No orders to place")
+
+        if len(orders) > self.batch_limit:
+            raise OrderError(400, "Cannot place more than {0} orders at once".format(self.batch_limit))
+
+        orders = list(map(OrderFromUserAdapter, orders))
+        now = datetime.utcnow()
+
+        # the same item could be given by more than one order, so the amounts are summed up per hash
+        debits = {}
+
+        for order in orders:
+            if order.deadline < now:
+                raise OrderError(400, "Order's deadline cannot be set for the past")
+
+            if order.take_amount <= 0 or order.give_amount <= 0 or order.available <= 0:
+                raise OrderError(400, "Bad order amounts")
+
+            debits[order.give_hash] = debits.get(order.give_hash, 0) + order.give_amount * order.available
+
+        # every row is marked, so the ids given to them could be told apart from the ones given to the rows
+        # inserted at the same time (those of a multi-row insert are not consecutive unless
+        # innodb_autoinc_lock_mode is 1 or less)
+        batch = uuid.uuid4().hex
+        markers = ["{0}:{1}".format(batch, index) for index in range(0, len(orders))]
+
+        values = []
+        for order, marker in zip(orders, markers):
+            values.extend([
+                gamespace_id, owner_id, market_id, order.give_item, ujson.dumps(order.give_payload),
+                order.give_amount, order.take_item, ujson.dumps(order.take_payload), order.take_amount,
+                order.available, ujson.dumps(order.payload), order.deadline, order.give_hash, order.take_hash,
+                marker])
+
+        async def place(db):
+            if not await self.app.items.debit_items(gamespace_id, owner_id, market_id, debits, db=db):
+                raise OrderError(409, "Not enough items to generate orders")
+
+            first_id = await db.insert(
+                """
+                    INSERT INTO `orders`
+                    (gamespace_id, owner_id, market_id, order_give_item, order_give_payload, order_give_amount,
+                        order_take_item, order_take_payload, order_take_amount, order_available, order_payload,
+                        order_deadline, order_give_hash, order_take_hash, order_batch)
+                    VALUES {0};
+                """.format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(orders))),
+                *values)
+
+            # a multi-row insert only reports the first id, the rest are found by their markers
+            placed = await db.query(
+                """
+                    SELECT `order_id`, `order_batch`
+                    FROM `orders`
+                    WHERE `order_id`>=%s AND `order_batch` IN %s;
+                """, first_id, markers)
+
+            placed = {row["order_batch"]: row["order_id"] for row in placed}
+
+            if len(placed) != len(markers):
+                raise OrderError(500, "Failed to place orders: some of them are missing")
+
+            return [placed[marker] for marker in markers]
+
+        try:
+            order_ids = await self.runner.run("new_orders", place)
+        except DatabaseError as e:
+            raise OrderError(500, "Failed to place orders: " + e.args[1])
+        except ItemError as e:
+            raise OrderError(e.code, e.message)
+
+        await self.app.items.invalidate_inventories([(gamespace_id, owner_id, market_id)])
+
+        logging.info("User {0} gc {1} mk {2} placed {3} orders at once: {4}".format(
+            owner_id, gamespace_id, market_id, len(order_ids), ", ".join(map(str, order_ids))))
+
+        for order_id, order in zip(order_ids, orders):
+            self.deadlines.schedule(order_id, order.deadline)
+
+            if self.books is not None:
+                self.books.add_order(gamespace_id, OrderAdapter({
+                    "order_id": order_id,
+                    "owner_id": owner_id,
+                    "market_id": market_id,
+                    "order_give_item": order.give_item,
+                    "order_give_payload": order.give_payload,
+                    "order_give_amount": order.give_amount,
+                    "order_available": order.available,
+                    "order_take_item": order.take_item,
+                    "order_take_payload": order.take_payload,
+                    "order_take_amount": order.take_amount
+                }))
+
+        return list(zip(order_ids, orders))
+
+    @validate(gamespace_id="int", owner_id="int", market_id="int")
+    async def fulfill_orders(self, gamespace_id, owner_id, market_id, orders):
+        """
+        Matches orders of the same owner just placed by new_orders. Orders of the same pair are matched
+        one after another within a single transaction, different pairs are matched in parallel.
+        :param orders: a list of (order_id, OrderFromUserAdapter)
+        :returns: a dict of order_id -> True if the order has been fulfilled completely
+        """
+        pairs = {}
+        for order_id, order in orders:
+            pairs.setdefault(
+                MatchingQueues.pair_key(gamespace_id, market_id, order.give_item, order.take_item), []
+            ).append((order_id, order))
+
+        fulfilled = {}
+
+        async def match_pair(pair_orders):
+            async def match(db):
+                return [
+                    await self.__match__(db, order_id, gamespace_id, owner_id, market_id)
+                    for order_id, order in pair_orders
+                ]
+
+            _, first = pair_orders[0]
+
+            try:
+                async with self.matching.lock(gamespace_id, market_id, first.give_item, first.take_item):
+                    results = await self.runner.run("fulfill_orders", match)
+            except Exception:
+                logging.exception("Could not fulfill orders after creation")
+                return
+
+            for (order_id, order), result in zip(pair_orders, results):
+                if result is not None:
+                    await self.__matched__(result)
+                    fulfilled[order_id] = result[0] == 0
+
+        await asyncio.gather(*[match_pair(pair_orders) for pair_orders in pairs.values()])
+
+        return {
+            order_id: fulfilled.get(order_id, False)
+            for order_id, order in orders
+        }
+
     @validate(gamespace_id="int", owner_id="int", market_id="int", order_id="int", order_give_item="str_name",
               order_give_payload="json", order_give_amount="int", order_take_item="str_name",
               order_take_payload="json", order_take_amount="int",
@@ -678,12 +1895,31 @@ class OrderModel(Model):
                     UPDATE `orders` 
                     SET order_give_item=%s, order_give_payload=%s, order_give_amount=%s,
                     order_take_item=%s, order_take_payload=%s, order_take_amount=%s,
-                    order_available=%s, order_payload=%s, order_deadline=%s
+                    order_available=%s, order_payload=%s, order_deadline=%s,
+                    order_give_hash=%s, order_take_hash=%s
                     WHERE order_id=%s AND gamespace_id=%s AND `owner_id`=%s AND `market_id`=%s;
                 """, order_give_item, ujson.dumps(order_give_payload), order_give_amount,
                 order_take_item, ujson.dumps(order_take_payload), order_take_amount,
-                order_available, ujson.dumps(order_payload), order_deadline, order_id,
-                gamespace_id, owner_id, market_id
+                order_available, ujson.dumps(order_payload), order_deadline,
+                ItemModel.item_hash(order_give_item, order_give_payload or {}),
+                ItemModel.item_hash(order_take_item, order_take_payload or {}),
+                order_id, gamespace_id, owner_id, market_id
             )
         except DatabaseError as e:
             raise OrderError(500, "Failed to gather order info: " + e.args[1])
+
+        self.deadlines.schedule(order_id, order_deadline)
+
+        if self.books is not None:
+            self.books.add_order(gamespace_id, OrderAdapter({
+                "order_id": order_id,
+                "owner_id": owner_id,
+                "market_id": market_id,
+                "order_give_item": order_give_item,
+                "order_give_payload": order_give_payload,
+                "order_give_amount": order_give_amount,
+                "order_available": order_available,
+                "order_take_item": order_take_item,
+                "order_take_payload": order_take_payload,
+                "order_take_amount": order_take_amount
+            }))
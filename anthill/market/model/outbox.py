@@ -0,0 +1,212 @@
+
+from anthill.common.internal import InternalError
+from anthill.common.database import DatabaseError
+
+import asyncio
+import logging
+import ujson
+import uuid
+
+
+class MessageOutbox(object):
+    """
+    Durable outbox of messages to be sent through the message service.
+
+    Messages are written into the `order_events` table within the same transaction as the change
+    they are about, so a message is never lost (nor sent for a change that has been rolled back).
+    A background relay claims whatever is pending, groups it by gamespace and sender,
+    delivers each group with a single `send_batch` call and deletes what has been delivered.
+    A claim of a relay that has died (or failed to deliver) expires after `claim_timeout` seconds,
+    so the messages are picked up again. The amount of messages waiting is reported as the queue depth.
+    """
+
+    def __init__(self, app, db, internal, batch_size=100, retries=5, backoff=1.0,
+                 poll_interval=5, claim_timeout=60):
+        self.app = app
+        self.db = db
+        self.internal = internal
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.pending = asyncio.Event()
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.__work__())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+
+        self.worker.cancel()
+        self.worker = None
+
+    def wake(self):
+        """
+        Should be called once the transaction that added messages is committed
+        """
+        self.pending.set()
+
+    async def add(self, messages, db):
+        """
+        Adds messages to the outbox as a part of the transaction db
+        :param messages: a list of (gamespace_id, sender, recipient_class, recipient_key, message_type, payload)
+        """
+        if not messages:
+            return
+
+        values = []
+        for gamespace_id, sender, recipient_class, recipient_key, message_type, payload in messages:
+            values.extend([gamespace_id, sender, recipient_class, recipient_key, message_type, ujson.dumps(payload)])
+
+        await db.execute(
+            """
+                INSERT INTO `order_events`
+                (`gamespace_id`, `event_sender`, `event_recipient_class`, `event_recipient_key`,
+                    `event_type`, `event_payload`)
+                VALUES {0};
+            """.format(", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(messages))), *values)
+
+    async def deliver(self, gamespace_id, sender, messages):
+        """
+        Sends messages of the same gamespace and sender at once, retrying on failure
+        :returns: False if the messages should be tried again later
+        """
+        delay = self.backoff
+
+        for attempt in range(0, self.retries + 1):
+            try:
+                await self.internal.request(
+                    "message", "send_batch",
+                    gamespace=gamespace_id, sender=sender,
+                    messages=messages, authoritative=True)
+            except InternalError as e:
+                if e.code < 500:
+                    # the messages have been rejected, trying again won't help
+                    logging.error("Could not deliver {0} message(s): {1}".format(len(messages), str(e)))
+                    return True
+
+                if attempt == self.retries:
+                    logging.error("Could not deliver {0} message(s): {1}".format(len(messages), str(e)))
+                    return False
+
+                logging.warning("Failed to deliver {0} message(s), retrying in {1}s: {2}".format(
+                    len(messages), delay, str(e)))
+
+                await asyncio.sleep(delay)
+                delay *= 2
+            else:
+                return True
+
+        return False
+
+    async def __claim__(self):
+        claim = str(uuid.uuid4())
+
+        claimed = await self.db.execute(
+            """
+                UPDATE `order_events`
+                SET `event_claim`=%s, `event_claimed`=NOW()
+                WHERE `event_claim` IS NULL OR `event_claimed`<NOW() - INTERVAL %s SECOND
+                ORDER BY `event_id`
+                LIMIT %s;
+            """, claim, self.claim_timeout, self.batch_size)
+
+        if not claimed:
+            return []
+
+        return await self.db.query(
+            """
+                SELECT *, TIMESTAMPDIFF(SECOND, `event_time`, NOW()) AS `event_age`
+                FROM `order_events`
+                WHERE `event_claim`=%s
+                ORDER BY `event_id`;
+            """, claim)
+
+    async def __depth__(self):
+        """
+        Returns how many messages are waiting to be delivered, claimed or not
+        """
+        depth = await self.db.get(
+            """
+                SELECT COUNT(*) AS `count`
+                FROM `order_events`;
+            """)
+
+        return int(depth["count"]) if depth else 0
+
+    async def __relay__(self):
+        """
+        Delivers one batch of pending messages
+        :returns: how many messages have been claimed
+        """
+        events = await self.__claim__()
+        if not events:
+            return 0
+
+        groups = {}
+        for event in events:
+            groups.setdefault((event["gamespace_id"], event["event_sender"]), []).append(event)
+
+        groups = list(groups.items())
+        results = await asyncio.gather(*[
+            self.deliver(gamespace_id, sender, [
+                {
+                    "recipient_class": event["event_recipient_class"],
+                    "recipient_key": event["event_recipient_key"],
+                    "message_type": event["event_type"],
+                    "payload": event["event_payload"],
+                    "flags": ["remove_delivered"]
+                }
+                for event in group
+            ])
+            for (gamespace_id, sender), group in groups
+        ])
+
+        delivered = [
+            event["event_id"]
+            for ((gamespace_id, sender), group), result in zip(groups, results) if result
+            for event in group
+        ]
+
+        if delivered:
+            await self.db.execute(
+                """
+                    DELETE FROM `order_events`
+                    WHERE `event_id` IN %s;
+                """, delivered)
+
+        self.app.monitor_action("messages.outbox", {
+            "delivered": len(delivered),
+            "failed": len(events) - len(delivered),
+            "latency": max(event["event_age"] for event in events)
+        })
+
+        return len(events)
+
+    async def __work__(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self.pending.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                self.pending.clear()
+
+                while await self.__relay__() >= self.batch_size:
+                    pass
+
+                # reported on every pass, so a queue that stopped draining shows up as well
+                self.app.monitor_action("messages.outbox", {"depth": await self.__depth__()})
+            except asyncio.CancelledError:
+                return
+            except DatabaseError as e:
+                logging.error("Failed to relay messages: " + e.args[1])
+                await asyncio.sleep(self.poll_interval)
+            except Exception:
+                logging.exception("Message outbox relay has failed")
+                await asyncio.sleep(self.poll_interval)
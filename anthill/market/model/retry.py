@@ -0,0 +1,86 @@
+
+from anthill.common.database import DatabaseError
+
+import asyncio
+import logging
+import random
+
+
+class TransactionRunner(object):
+    """
+    Runs transactions that lock several rows at once, retrying them when MySQL gives up on a lock.
+
+    A transaction is a coroutine function body(db) that does its work on the connection db and returns
+    the result, the runner commits it afterwards. If the transaction gets chosen as a deadlock victim
+    or times out waiting for a lock, it is rolled back and run again from scratch after a jittered
+    (full jitter) exponential backoff, up to `retries` times. The models wrap database errors into their own,
+    so the error is looked for in the whole chain of the exception raised. Once retries are exhausted
+    (or on any other error) the exception is raised as is, so callers keep reporting it the way they did.
+
+    Since a transaction may run more than once, the body should only change the database; everything else
+    (caches, in-memory books, waking the outbox) belongs after the run.
+    """
+
+    LOCK_WAIT_TIMEOUT = 1205
+    DEADLOCK = 1213
+
+    RETRYABLE = (LOCK_WAIT_TIMEOUT, DEADLOCK)
+
+    def __init__(self, app, db, retries=3, backoff=0.05, backoff_max=1.0):
+        self.app = app
+        self.db = db
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+    @staticmethod
+    def retryable(e):
+        """
+        Returns the deadlock or lock wait timeout error that has caused the exception, if any
+        """
+        while e is not None:
+            if isinstance(e, DatabaseError) and e.args and e.args[0] in TransactionRunner.RETRYABLE:
+                return e
+            e = e.__cause__ or e.__context__
+        return None
+
+    async def run(self, name, body):
+        attempt = 0
+
+        while True:
+            async with self.db.acquire(auto_commit=False) as db:
+                try:
+                    result = await body(db)
+                    await db.commit()
+                except BaseException as e:
+                    await self.__rollback__(db)
+
+                    error = TransactionRunner.retryable(e)
+
+                    if error is None:
+                        raise
+
+                    if attempt >= self.retries:
+                        logging.error("Transaction '{0}' has failed after {1} retries: {2}".format(
+                            name, attempt, error.args[1]))
+                        self.app.monitor_action("transactions.retry", {"exhausted": 1}, transaction=name)
+                        raise
+                else:
+                    if attempt:
+                        self.app.monitor_action("transactions.retry", {"retries": attempt}, transaction=name)
+                    return result
+
+            attempt += 1
+            delay = random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+            logging.warning("Transaction '{0}' has failed ({1}), retrying in {2:.3f}s".format(
+                name, error.args[1], delay))
+
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def __rollback__(db):
+        try:
+            await db.rollback()
+        except Exception:
+            logging.exception("Failed to rollback a transaction")
@@ -14,23 +14,56 @@ import ujson
 
 
 class TransactionAdapter(object):
+    __slots__ = (
+        "transaction_id", "market_id", "give_item", "give_payload", "give_hash", "give_amount", "give_owner",
+        "amount", "take_item", "take_payload", "take_hash", "take_amount", "take_owner", "date")
+
     def __init__(self, data):
         self.transaction_id = str(data.get("transaction_id"))
         self.market_id = str(data.get("market_id"))
         self.give_item = str(data.get("transaction_give_item"))
         self.give_payload = data.get("transaction_give_payload")
         self.give_hash = str(data.get("transaction_give_hash"))
-        self.give_amount = str(data.get("transaction_give_amount"))
+        self.give_amount = int(data.get("transaction_give_amount"))
         self.give_owner = str(data.get("transaction_give_owner"))
-        self.amount = str(data.get("transaction_amount"))
+        self.amount = int(data.get("transaction_amount"))
         self.take_item = str(data.get("transaction_take_item"))
         self.take_payload = data.get("transaction_take_payload")
         self.take_hash = str(data.get("transaction_take_hash"))
-        self.take_amount = str(data.get("transaction_take_amount"))
+        self.take_amount = int(data.get("transaction_take_amount"))
         self.take_owner = str(data.get("transaction_take_owner"))
         self.date = data.get("transaction_date")
 
 
+class RollupAdapter(object):
+    """
+    Trades of a pair within a time bucket. Prices are in take items per one give item
+    """
+    __slots__ = (
+        "period", "start", "open", "high", "low", "close", "give_volume", "take_volume", "amount", "trades")
+
+    def __init__(self, data, inverse=False):
+        self.period = data.get("rollup_period")
+        self.start = data.get("rollup_start")
+        self.amount = int(data.get("rollup_amount"))
+        self.trades = int(data.get("rollup_trades"))
+
+        if inverse:
+            self.open = 1.0 / data.get("rollup_open")
+            self.high = 1.0 / data.get("rollup_low")
+            self.low = 1.0 / data.get("rollup_high")
+            self.close = 1.0 / data.get("rollup_close")
+            self.give_volume = int(data.get("rollup_take_volume"))
+            self.take_volume = int(data.get("rollup_give_volume"))
+        else:
+            self.open = data.get("rollup_open")
+            self.high = data.get("rollup_high")
+            self.low = data.get("rollup_low")
+            self.close = data.get("rollup_close")
+            self.give_volume = int(data.get("rollup_give_volume"))
+            self.take_volume = int(data.get("rollup_take_volume"))
+
+
 class TransactionError(Exception):
     def __init__(self, code, message):
         self.code = code
@@ -46,12 +79,22 @@ class NoTransactionError(Exception):
 
 class TransactionModel(Model):
 
+    # rollup periods in the same order as the `rollup_period` enum, with the formats of their bucket starts
+    ROLLUP_PERIODS = (
+        ("minute", "%Y-%m-%d %H:%i:00"),
+        ("hour", "%Y-%m-%d %H:00:00"),
+        ("day", "%Y-%m-%d 00:00:00")
+    )
+
+    # how many transaction ids are rolled up at once when rolling up the existing ones
+    BACKFILL_CHUNK = 10000
+
     def __init__(self, app, db):
         self.app = app
         self.db = db
 
     def get_setup_tables(self):
-        return ["transactions"]
+        return ["transactions", "transaction_rollups"]
 
     def get_setup_db(self):
         return self.db
@@ -59,6 +102,143 @@ class TransactionModel(Model):
     def has_delete_account_event(self):
         return False
 
+    async def started(self, application):
+        await super().started(application)
+        await self.app.migrations.migrate(self, application)
+
+    def get_migrations(self):
+        return [
+            "transaction_rollups_backfill"
+        ]
+
+    async def migration_transaction_rollups_backfill(self, db):
+        """
+        Rolls up the transactions recorded before the rollups were introduced.
+
+        Everything recorded up to now is rolled up again from scratch (so running it again after a failure
+        does not count anything twice), while the transactions recorded from now on are rolled up as usual.
+        Transactions are rolled up in chunks of ids, so trades are not kept waiting on the locks
+        a single scan of the whole table would take.
+        """
+        # the end of the table is locked, so no trade is recorded between finding out where it is
+        # and dropping the rollups, or it would be either lost or counted twice
+        async with self.db.acquire(auto_commit=False) as tx:
+            try:
+                last = await tx.get(
+                    """
+                        SELECT MAX(`transaction_id`) AS `last_id`
+                        FROM `transactions`
+                        FOR UPDATE;
+                    """)
+
+                await tx.execute(
+                    """
+                        DELETE FROM `transaction_rollups`;
+                    """)
+            except DatabaseError:
+                await tx.rollback()
+                raise
+            else:
+                await tx.commit()
+
+        last_id = last["last_id"] if last else None
+
+        if last_id is None:
+            return
+
+        last_id = int(last_id)
+        price = "`transaction_take_amount` / `transaction_give_amount`"
+
+        for chunk_start in range(0, last_id, TransactionModel.BACKFILL_CHUNK):
+            chunk_end = min(chunk_start + TransactionModel.BACKFILL_CHUNK, last_id)
+
+            for period, bucket_format in TransactionModel.ROLLUP_PERIODS:
+                # chunks go in the order of ids, so a bucket spanning several of them is merged
+                # just like the trades are rolled up one after another
+                await db.execute(
+                    """
+                        INSERT INTO `transaction_rollups`
+                        (`gamespace_id`, `market_id`, `rollup_give_hash`, `rollup_take_hash`, `rollup_period`,
+                            `rollup_start`, `rollup_open`, `rollup_high`, `rollup_low`, `rollup_close`,
+                            `rollup_give_volume`, `rollup_take_volume`, `rollup_amount`, `rollup_trades`)
+                        SELECT `gamespace_id`, `market_id`, `transaction_give_hash`, `transaction_take_hash`, %s,
+                            DATE_FORMAT(`transaction_date`, %s) AS `bucket`,
+                            SUBSTRING_INDEX(GROUP_CONCAT({0} ORDER BY `transaction_id`), ',', 1),
+                            MAX({0}), MIN({0}),
+                            SUBSTRING_INDEX(GROUP_CONCAT({0} ORDER BY `transaction_id` DESC), ',', 1),
+                            SUM(`transaction_give_amount` * `transaction_amount`),
+                            SUM(`transaction_take_amount` * `transaction_amount`),
+                            SUM(`transaction_amount`), COUNT(*)
+                        FROM `transactions`
+                        WHERE `transaction_id`>%s AND `transaction_id`<=%s
+                        GROUP BY `gamespace_id`, `market_id`, `transaction_give_hash`, `transaction_take_hash`,
+                            `bucket`
+                        ON DUPLICATE KEY UPDATE
+                            `rollup_high` = GREATEST(`rollup_high`, VALUES(`rollup_high`)),
+                            `rollup_low` = LEAST(`rollup_low`, VALUES(`rollup_low`)),
+                            `rollup_close` = VALUES(`rollup_close`),
+                            `rollup_give_volume` = `rollup_give_volume` + VALUES(`rollup_give_volume`),
+                            `rollup_take_volume` = `rollup_take_volume` + VALUES(`rollup_take_volume`),
+                            `rollup_amount` = `rollup_amount` + VALUES(`rollup_amount`),
+                            `rollup_trades` = `rollup_trades` + VALUES(`rollup_trades`);
+                    """.format(price), period, bucket_format, chunk_start, chunk_end)
+
+        logging.warning("Rolled up existing transactions")
+
+    async def __rollup__(self, gamespace_id, market_id, trades, db):
+        """
+        Adds trades to the current minute, hour and day buckets of their pairs
+        :param trades: a list of (give_hash, take_hash, give_amount, take_amount, amount), in the order
+            they have happened, oriented the same way as they are recorded
+        """
+        pairs = {}
+
+        for give_hash, take_hash, give_amount, take_amount, amount in trades:
+            price = take_amount / give_amount
+            bucket = pairs.get((give_hash, take_hash))
+            if bucket is None:
+                pairs[(give_hash, take_hash)] = [
+                    price, price, price, price, give_amount * amount, take_amount * amount, amount, 1]
+            else:
+                bucket[1] = max(bucket[1], price)
+                bucket[2] = min(bucket[2], price)
+                bucket[3] = price
+                bucket[4] += give_amount * amount
+                bucket[5] += take_amount * amount
+                bucket[6] += amount
+                bucket[7] += 1
+
+        rows = []
+        values = []
+
+        # same order as the primary key, so concurrent rollups cannot deadlock each other
+        for (give_hash, take_hash), bucket in sorted(pairs.items()):
+            for period, bucket_format in TransactionModel.ROLLUP_PERIODS:
+                rows.append("(%s, %s, %s, %s, %s, DATE_FORMAT(NOW(), %s), %s, %s, %s, %s, %s, %s, %s, %s)")
+                values.extend([gamespace_id, market_id, give_hash, take_hash, period, bucket_format])
+                values.extend(bucket)
+
+        try:
+            await db.execute(
+                """
+                    INSERT INTO `transaction_rollups`
+                    (`gamespace_id`, `market_id`, `rollup_give_hash`, `rollup_take_hash`, `rollup_period`,
+                        `rollup_start`, `rollup_open`, `rollup_high`, `rollup_low`, `rollup_close`,
+                        `rollup_give_volume`, `rollup_take_volume`, `rollup_amount`, `rollup_trades`)
+                    VALUES {0}
+                    ON DUPLICATE KEY UPDATE
+                        `rollup_high` = GREATEST(`rollup_high`, VALUES(`rollup_high`)),
+                        `rollup_low` = LEAST(`rollup_low`, VALUES(`rollup_low`)),
+                        `rollup_close` = VALUES(`rollup_close`),
+                        `rollup_give_volume` = `rollup_give_volume` + VALUES(`rollup_give_volume`),
+                        `rollup_take_volume` = `rollup_take_volume` + VALUES(`rollup_take_volume`),
+                        `rollup_amount` = `rollup_amount` + VALUES(`rollup_amount`),
+                        `rollup_trades` = `rollup_trades` + VALUES(`rollup_trades`);
+                """.format(", ".join(rows)), *values
+            )
+        except DatabaseError as e:
+            raise TransactionError(500, "Failed to update transaction rollups: " + e.args[1])
+
     @validate(gamespace_id="int", market_id="int", transaction_id="int")
     async def get_transaction(self, gamespace_id, market_id, transaction_id, db=None):
         try:
@@ -111,12 +291,172 @@ class TransactionModel(Model):
         except DatabaseError as e:
             raise TransactionError(500, "Failed to gather market info: " + e.args[1])
 
+        await self.__rollup__(gamespace_id, market_id, [(a[2], b[2], a[3], b[3], amount)], db or self.db)
+
         return str(transaction_id)
 
+    async def new_transactions_bulk(self, gamespace_id, market_id, fills, db=None):
+        """
+        Records many transactions with a single statement.
+        :param fills: a list of dicts, each having the same keys as the new_transaction arguments
+            (give_item, give_payload, give_amount, give_owner, take_item, take_payload, take_amount,
+            take_owner, amount), plus optional give_hash and take_hash to not compute them again
+        """
+        if not fills:
+            return
+
+        rows = []
+        values = []
+        trades = []
+
+        for fill in fills:
+            give_hash = fill.get("give_hash") or ItemModel.item_hash(fill["give_item"], fill["give_payload"] or {})
+            take_hash = fill.get("take_hash") or ItemModel.item_hash(fill["take_item"], fill["take_payload"] or {})
+
+            give = (fill["give_item"], fill["give_payload"], give_hash, fill["give_amount"], fill["give_owner"])
+            take = (fill["take_item"], fill["take_payload"], take_hash, fill["take_amount"], fill["take_owner"])
+
+            if give_hash > take_hash:
+                a = give
+                b = take
+            else:
+                a = take
+                b = give
+
+            rows.append("(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+            values.extend([gamespace_id, market_id, a[0], ujson.dumps(a[1]), a[2], a[3],
+                           a[4], fill["amount"], b[0], ujson.dumps(b[1]), b[2], b[3], b[4]])
+            trades.append((a[2], b[2], a[3], b[3], fill["amount"]))
+
+        try:
+            await (db or self.db).execute(
+                """
+                    INSERT INTO `transactions`
+                    (gamespace_id, market_id, transaction_give_item, transaction_give_payload, transaction_give_hash,
+                    transaction_give_amount, transaction_give_owner, transaction_amount,
+                    transaction_take_item, transaction_take_payload, transaction_take_hash,
+                    transaction_take_amount, transaction_take_owner)
+                    VALUES {0};
+                """.format(", ".join(rows)), *values
+            )
+        except DatabaseError as e:
+            raise TransactionError(500, "Failed to record transactions: " + e.args[1])
+
+        await self.__rollup__(gamespace_id, market_id, trades, db or self.db)
+
+    @validate(gamespace_id="int", market_id="int", give_item="str_name", give_payload="json_dict",
+              take_item="str_name", take_payload="json_dict", period="str_name", limit="int")
+    async def list_history(self, gamespace_id, market_id, give_item, give_payload, take_item, take_payload,
+                           period="day", limit=100, db=None):
+        """
+        Returns the latest rollups of a pair, newest first
+        """
+
+        if period not in dict(TransactionModel.ROLLUP_PERIODS):
+            raise TransactionError(400, "Bad period")
+
+        if limit <= 0 or limit > 1000:
+            raise TransactionError(400, "Bad limit")
+
+        give_hash = ItemModel.item_hash(give_item, give_payload or {})
+        take_hash = ItemModel.item_hash(take_item, take_payload or {})
+
+        # the pair is recorded by the greater hash first
+        if give_hash > take_hash:
+            a = give_hash
+            b = take_hash
+        else:
+            a = take_hash
+            b = give_hash
+
+        try:
+            data = await (db or self.db).query(
+                """
+                    SELECT *
+                    FROM `transaction_rollups`
+                    WHERE `gamespace_id`=%s AND `market_id`=%s AND `rollup_give_hash`=%s AND
+                    `rollup_take_hash`=%s AND `rollup_period`=%s
+                    ORDER BY `rollup_start` DESC
+                    LIMIT %s;
+                """, gamespace_id, market_id, a, b, period, limit
+            )
+        except DatabaseError as e:
+            raise TransactionError(500, "Failed to gather transaction info: " + e.args[1])
+
+        return [RollupAdapter(row, inverse=(a != give_hash)) for row in data]
+
+    @validate(gamespace_id="int", market_id="int", give_item="str_name", give_payload="json_dict",
+              take_item="str_name", take_payload="json_dict")
+    async def get_ticker(self, gamespace_id, market_id, give_item, give_payload, take_item, take_payload, db=None):
+        """
+        Returns the last price of a pair and its trades of the last 24 hours rolled up into one RollupAdapter
+        (None if there were no trades)
+        """
+
+        give_hash = ItemModel.item_hash(give_item, give_payload or {})
+        take_hash = ItemModel.item_hash(take_item, take_payload or {})
+
+        if give_hash > take_hash:
+            a = give_hash
+            b = take_hash
+        else:
+            a = take_hash
+            b = give_hash
+
+        inverse = a != give_hash
+
+        try:
+            hours = await (db or self.db).query(
+                """
+                    SELECT *
+                    FROM `transaction_rollups`
+                    WHERE `gamespace_id`=%s AND `market_id`=%s AND `rollup_give_hash`=%s AND
+                    `rollup_take_hash`=%s AND `rollup_period`='hour' AND `rollup_start`>NOW() - INTERVAL 1 DAY
+                    ORDER BY `rollup_start`;
+                """, gamespace_id, market_id, a, b
+            )
+
+            if not hours:
+                last = await (db or self.db).get(
+                    """
+                        SELECT *
+                        FROM `transaction_rollups`
+                        WHERE `gamespace_id`=%s AND `market_id`=%s AND `rollup_give_hash`=%s AND
+                        `rollup_take_hash`=%s AND `rollup_period`='day'
+                        ORDER BY `rollup_start` DESC
+                        LIMIT 1;
+                    """, gamespace_id, market_id, a, b
+                )
+        except DatabaseError as e:
+            raise TransactionError(500, "Failed to gather transaction info: " + e.args[1])
+
+        if not hours:
+            if not last:
+                return None, None
+            return RollupAdapter(last, inverse=inverse).close, None
+
+        day = RollupAdapter({
+            "rollup_period": "day",
+            "rollup_start": hours[0]["rollup_start"],
+            "rollup_open": hours[0]["rollup_open"],
+            "rollup_high": max(hour["rollup_high"] for hour in hours),
+            "rollup_low": min(hour["rollup_low"] for hour in hours),
+            "rollup_close": hours[-1]["rollup_close"],
+            "rollup_give_volume": sum(hour["rollup_give_volume"] for hour in hours),
+            "rollup_take_volume": sum(hour["rollup_take_volume"] for hour in hours),
+            "rollup_amount": sum(hour["rollup_amount"] for hour in hours),
+            "rollup_trades": sum(hour["rollup_trades"] for hour in hours)
+        }, inverse=inverse)
+
+        return day.close, day
+
     @validate(gamespace_id="int", market_id="int", give_item="str_name", give_payload="json_dict",
               take_item="str_name", take_payload="json_dict", limit="int")
     async def list_transaction(self, gamespace_id, market_id, give_item,
                                give_payload, take_item, take_payload, limit=100, db=None):
+        """
+        Kept for the existing callers, see list_history for the price history of a pair
+        """
 
         give_hash = ItemModel.item_hash(give_item, give_payload or {})
         take_hash = ItemModel.item_hash(take_item, take_payload or {})
@@ -64,4 +64,166 @@ define("cache_max_connections",
        default=500,
        help="Maximum connections to the regular cache (connection pool).",
        group="cache",
-       type=int)
\ No newline at end of file
+       type=int)
+
+define("lease_ttl",
+       default=15,
+       help="How long (in seconds) a node keeps leading the background jobs (like the expiry of due orders) "
+            "after it has stopped renewing its lease, for example because it has died.",
+       group="market",
+       type=int)
+
+# Markets
+
+define("market_cache_ttl",
+       default=60,
+       help="How long (in seconds) a market could be kept in the process-local cache.",
+       group="market",
+       type=int)
+
+define("market_cache_size",
+       default=1000,
+       help="Maximum amount of markets kept in the process-local cache.",
+       group="market",
+       type=int)
+
+# Items
+
+define("items_cache_ttl",
+       default=300,
+       help="How long (in seconds) player inventories are cached in the regular cache, 0 to disable.",
+       group="market",
+       type=int)
+
+define("items_cleanup_interval",
+       default=3600,
+       help="How often (in seconds) the items left with nothing are looked for and deleted.",
+       group="market",
+       type=int)
+
+define("items_cleanup_batch_size",
+       default=1000,
+       help="How many items are scanned at once while looking for the ones left with nothing.",
+       group="market",
+       type=int)
+
+define("items_cleanup_rate",
+       default=10,
+       help="Up to how many batches of items are scanned per second while looking for the ones left with nothing.",
+       group="market",
+       type=int)
+
+# Matching
+
+define("order_book",
+       default=False,
+       help="Keep resident order books in memory and use them to look up counter-orders during matching. "
+            "Books are loaded from the database on startup and kept in sync between the nodes over Redis; "
+            "while a node is out of sync, it looks counter-orders up in the database.",
+       group="market",
+       type=bool)
+
+define("matching_distributed",
+       default=False,
+       help="Also run matches of the same pair of items one at a time across the nodes (through the regular cache), "
+            "not only within a node.",
+       group="market",
+       type=bool)
+
+define("matching_lock_timeout",
+       default=5,
+       help="How long (in seconds) a match waits for the other nodes to finish matching the same pair, "
+            "the match goes on regardless once it is over.",
+       group="market",
+       type=int)
+
+define("transaction_retries",
+       default=3,
+       help="How many times a transaction on orders is retried after being chosen as a deadlock victim "
+            "or timing out waiting for a lock.",
+       group="market",
+       type=int)
+
+define("transaction_backoff",
+       default=0.05,
+       help="Base delay (in seconds) before retrying a transaction on orders, doubled with every retry "
+            "and randomized.",
+       group="market",
+       type=float)
+
+define("orders_batch_limit",
+       default=100,
+       help="Up to how many orders could be placed with a single batch request.",
+       group="market",
+       type=int)
+
+define("orders_stream_chunk",
+       default=100,
+       help="Order listings are read and written out in pages of this many orders, "
+            "0 to build the whole response in memory instead.",
+       group="market",
+       type=int)
+
+define("expire_batch_size",
+       default=500,
+       help="How many due orders are deleted within a single transaction.",
+       group="market",
+       type=int)
+
+define("expire_concurrency",
+       default=4,
+       help="How many transactions deleting due orders may run at the same time.",
+       group="market",
+       type=int)
+
+define("expire_check_interval",
+       default=300,
+       help="Orders are expired right when they are due, this is how often (in seconds) the database is also "
+            "checked for anything that has been missed.",
+       group="market",
+       type=int)
+
+define("expire_orphan_grace",
+       default=60,
+       help="Orders are expired by the node that has placed them. The ones still there this long (in seconds) "
+            "after their deadline (for example, because that node has died) are expired by the node leading "
+            "the background jobs instead.",
+       group="market",
+       type=int)
+
+define("outbox_batch_size",
+       default=100,
+       help="How many order notifications are taken from the outbox at once.",
+       group="market",
+       type=int)
+
+define("outbox_retries",
+       default=5,
+       help="How many times a failed delivery of order notifications is retried.",
+       group="market",
+       type=int)
+
+define("outbox_poll_interval",
+       default=5,
+       help="How often (in seconds) the outbox is checked for order notifications written by other nodes "
+            "or left undelivered.",
+       group="market",
+       type=int)
+
+define("history_cache_ttl",
+       default=10,
+       help="How long (in seconds) price history responses are cached.",
+       group="market",
+       type=int)
+
+define("ticker_cache_ttl",
+       default=2,
+       help="How long (in seconds) ticker responses are cached.",
+       group="market",
+       type=int)
+
+define("depth_cache_ttl",
+       default=2,
+       help="How long (in seconds) order book depth responses are cached.",
+       group="market",
+       type=int)
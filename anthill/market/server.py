@@ -7,8 +7,10 @@ from . import options as _opts
 from anthill.common import server, database, access, keyvalue
 
 from . import admin
+from . model.cache import SharedCache
 from . model.item import ItemModel
 from . model.market import MarketModel
+from . model.migration import MigrationModel
 from . model.order import OrderModel
 from . model.transaction import TransactionModel
 
@@ -30,13 +32,44 @@ class MarketServer(server.Server):
             db=options.cache_db,
             max_connections=options.cache_max_connections)
 
+        self.orders_stream_chunk = options.orders_stream_chunk
+        self.market_data = SharedCache(self, "market_data:")
+        self.history_cache_ttl = options.history_cache_ttl
+        self.ticker_cache_ttl = options.ticker_cache_ttl
+        self.depth_cache_ttl = options.depth_cache_ttl
+
+        self.migrations = MigrationModel(self, self.db)
         self.transactions = TransactionModel(self, self.db)
-        self.orders = OrderModel(self, self.db)
-        self.markets = MarketModel(self, self.db)
-        self.items = ItemModel(self, self.db)
+        self.orders = OrderModel(
+            self, self.db,
+            order_book=options.order_book,
+            expire_batch_size=options.expire_batch_size,
+            expire_concurrency=options.expire_concurrency,
+            expire_check_interval=options.expire_check_interval,
+            expire_orphan_grace=options.expire_orphan_grace,
+            outbox_batch_size=options.outbox_batch_size,
+            outbox_retries=options.outbox_retries,
+            outbox_poll_interval=options.outbox_poll_interval,
+            lease_ttl=options.lease_ttl,
+            matching_distributed=options.matching_distributed,
+            matching_lock_timeout=options.matching_lock_timeout,
+            transaction_retries=options.transaction_retries,
+            transaction_backoff=options.transaction_backoff,
+            batch_limit=options.orders_batch_limit)
+        self.markets = MarketModel(
+            self, self.db,
+            cache_ttl=options.market_cache_ttl,
+            cache_size=options.market_cache_size)
+        self.items = ItemModel(
+            self, self.db,
+            cache_ttl=options.items_cache_ttl,
+            cleanup_interval=options.items_cleanup_interval,
+            cleanup_batch_size=options.items_cleanup_batch_size,
+            cleanup_rate=options.items_cleanup_rate,
+            lease_ttl=options.lease_ttl)
 
     def get_models(self):
-        return [self.markets, self.transactions, self.items, self.orders]
+        return [self.migrations, self.markets, self.transactions, self.items, self.orders]
 
     def get_admin(self):
         return {
@@ -64,9 +97,14 @@ class MarketServer(server.Server):
             (r"/markets/(.*)/items/(.*)", h.MarketItemHandler),
             (r"/markets/(.*)/orders", h.UpdateMarketOrdersHandler),
             (r"/markets/(.*)/orders/my", h.UpdateMarketMyOrdersHandler),
+            (r"/markets/(.*)/orders/batch", h.MarketOrdersBatchHandler),
+            (r"/markets/(.*)/orders/cancel", h.MarketOrdersCancelHandler),
             (r"/markets/(.*)/orders/(.*)/fulfill", h.FulfillOrderHandler),
             (r"/markets/(.*)/orders/(.*)/delete", h.DeleteOrderHandler),
             (r"/markets/(.*)/orders/(.*)", h.OrderHandler),
+            (r"/markets/(.*)/history", h.MarketHistoryHandler),
+            (r"/markets/(.*)/ticker", h.MarketTickerHandler),
+            (r"/markets/(.*)/depth", h.MarketDepthHandler),
             (r"/markets/(.*)", h.GetMarketHandler)
         ]
 
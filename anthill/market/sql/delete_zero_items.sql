@@ -1,8 +0,0 @@
-CREATE EVENT delete_zero_items
-ON SCHEDULE EVERY 5 MINUTE
-STARTS '2021-01-28 23:55:45.000'
-ON COMPLETION NOT PRESERVE
-ENABLE
-DO DELETE
-   FROM `items`
-   WHERE `items`.`item_amount` = 0
\ No newline at end of file
@@ -0,0 +1 @@
+DROP EVENT IF EXISTS `delete_zero_items`;
\ No newline at end of file
@@ -0,0 +1,3 @@
+ALTER TABLE `orders`
+  ADD KEY `orders_take_amount_asc_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_take_amount`,`order_time` DESC,`order_id` DESC) USING BTREE,
+  ADD KEY `orders_give_amount_asc_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_give_amount`,`order_time` DESC,`order_id` DESC) USING BTREE;
\ No newline at end of file
@@ -0,0 +1,2 @@
+ALTER TABLE `orders`
+  ADD COLUMN `order_batch` varchar(48) DEFAULT NULL AFTER `order_deadline`;
\ No newline at end of file
@@ -0,0 +1,13 @@
+ALTER TABLE `orders`
+  DROP KEY `give_items`,
+  DROP KEY `take_items`,
+  DROP KEY `orders_order_time_IDX`,
+  DROP KEY `orders_order_take_amount_IDX`,
+  DROP KEY `orders_order_give_amount_IDX`,
+  DROP KEY `orders_hashes_IDX`,
+  ADD KEY `orders_market_IDX` (`gamespace_id`,`market_id`,`order_time`) USING BTREE,
+  ADD KEY `orders_owner_IDX` (`gamespace_id`,`owner_id`,`market_id`,`order_time`) USING BTREE,
+  ADD KEY `orders_take_amount_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_take_amount`,`order_time`) USING BTREE,
+  ADD KEY `orders_give_amount_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_give_amount`,`order_time`) USING BTREE,
+  ADD KEY `orders_fulfill_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_take_amount`,`order_give_amount`,`order_time` DESC) USING BTREE,
+  ADD KEY `orders_hashes_IDX` (`gamespace_id`,`market_id`,`order_give_hash`,`order_take_hash`,`order_take_amount`,`order_give_amount`,`order_time` DESC) USING BTREE;
\ No newline at end of file
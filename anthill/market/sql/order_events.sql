@@ -0,0 +1,14 @@
+CREATE TABLE `order_events` (
+  `event_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `event_sender` varchar(255) NOT NULL,
+  `event_recipient_class` varchar(64) NOT NULL,
+  `event_recipient_key` varchar(255) NOT NULL,
+  `event_type` varchar(64) NOT NULL,
+  `event_payload` json DEFAULT NULL,
+  `event_time` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `event_claim` varchar(36) DEFAULT NULL,
+  `event_claimed` datetime DEFAULT NULL,
+  PRIMARY KEY (`event_id`),
+  KEY `order_events_claim_IDX` (`event_claim`) USING BTREE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
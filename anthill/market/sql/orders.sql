@@ -10,14 +10,20 @@ CREATE TABLE `orders` (
   `order_take_item` varchar(64) NOT NULL,
   `order_take_payload` json DEFAULT NULL,
   `order_take_amount` int(11) unsigned NOT NULL,
+  `order_give_hash` varchar(64) NOT NULL DEFAULT '',
+  `order_take_hash` varchar(64) NOT NULL DEFAULT '',
   `order_payload` json DEFAULT NULL,
   `order_time` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `order_deadline` datetime NOT NULL,
+  `order_batch` varchar(48) DEFAULT NULL,
   PRIMARY KEY (`order_id`),
-  KEY `give_items` (`market_id`,`order_give_item`),
-  KEY `take_items` (`market_id`,`order_take_item`),
-  KEY `orders_order_time_IDX` (`order_time`) USING BTREE,
-  KEY `orders_order_take_amount_IDX` (`order_take_amount`) USING BTREE,
-  KEY `orders_order_give_amount_IDX` (`order_give_amount`) USING BTREE,
-  KEY `orders_order_deadline_IDX` (`order_deadline`) USING BTREE
+  KEY `orders_market_IDX` (`gamespace_id`,`market_id`,`order_time`) USING BTREE,
+  KEY `orders_owner_IDX` (`gamespace_id`,`owner_id`,`market_id`,`order_time`) USING BTREE,
+  KEY `orders_take_amount_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_take_amount`,`order_time`) USING BTREE,
+  KEY `orders_give_amount_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_give_amount`,`order_time`) USING BTREE,
+  KEY `orders_fulfill_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_take_amount`,`order_give_amount`,`order_time` DESC) USING BTREE,
+  KEY `orders_take_amount_asc_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_take_amount`,`order_time` DESC,`order_id` DESC) USING BTREE,
+  KEY `orders_give_amount_asc_IDX` (`gamespace_id`,`market_id`,`order_give_item`,`order_take_item`,`order_give_amount`,`order_time` DESC,`order_id` DESC) USING BTREE,
+  KEY `orders_order_deadline_IDX` (`order_deadline`) USING BTREE,
+  KEY `orders_hashes_IDX` (`gamespace_id`,`market_id`,`order_give_hash`,`order_take_hash`,`order_take_amount`,`order_give_amount`,`order_time` DESC) USING BTREE
 ) ENGINE=InnoDB AUTO_INCREMENT=171 DEFAULT CHARSET=utf8;
\ No newline at end of file
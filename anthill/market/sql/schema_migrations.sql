@@ -0,0 +1,5 @@
+CREATE TABLE `schema_migrations` (
+  `migration_name` varchar(128) NOT NULL,
+  `migration_applied` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`migration_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
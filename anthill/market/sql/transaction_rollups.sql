@@ -0,0 +1,17 @@
+CREATE TABLE `transaction_rollups` (
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `market_id` int(11) unsigned NOT NULL,
+  `rollup_give_hash` varchar(64) NOT NULL,
+  `rollup_take_hash` varchar(64) NOT NULL,
+  `rollup_period` enum('minute','hour','day') NOT NULL,
+  `rollup_start` datetime NOT NULL,
+  `rollup_open` double NOT NULL,
+  `rollup_high` double NOT NULL,
+  `rollup_low` double NOT NULL,
+  `rollup_close` double NOT NULL,
+  `rollup_give_volume` bigint(20) unsigned NOT NULL,
+  `rollup_take_volume` bigint(20) unsigned NOT NULL,
+  `rollup_amount` bigint(20) unsigned NOT NULL,
+  `rollup_trades` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`market_id`,`rollup_give_hash`,`rollup_take_hash`,`rollup_period`,`rollup_start`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
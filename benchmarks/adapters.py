@@ -0,0 +1,104 @@
+"""
+Compares the per-row memory and CPU cost of the order adapters on a 1000-row listing:
+the old dict-backed adapter keeping amounts as strings against the current __slots__ one.
+
+    python benchmarks/adapters.py
+"""
+
+from anthill.market.model.order import OrderAdapter
+from anthill.market.handler import MarketHandler
+
+from datetime import datetime
+import timeit
+import tracemalloc
+
+ROWS = 1000
+
+
+class LegacyOrderAdapter(object):
+    def __init__(self, data):
+        self.order_id = str(data.get("order_id"))
+        self.owner_id = str(data.get("owner_id"))
+        self.market_id = str(data.get("market_id"))
+        self.give_item = str(data.get("order_give_item"))
+        self.give_payload = data.get("order_give_payload")
+        self.give_amount = str(data.get("order_give_amount"))
+        self.available = str(data.get("order_available"))
+        self.take_item = str(data.get("order_take_item"))
+        self.take_payload = data.get("order_take_payload")
+        self.take_amount = str(data.get("order_take_amount"))
+        self.give_hash = data.get("order_give_hash")
+        self.take_hash = data.get("order_take_hash")
+        self.payload = data.get("order_payload")
+        self.time = data.get("order_time")
+        self.deadline = data.get("order_deadline")
+
+
+def legacy_dump_order(order):
+    return {
+        "order_id": str(order.order_id),
+        "owner_id": order.owner_id,
+        "give_item": order.give_item,
+        "give_payload": order.give_payload,
+        "give_amount": int(order.give_amount),
+        "take_item": order.take_item,
+        "take_payload": order.take_payload,
+        "take_amount": int(order.take_amount),
+        "time": str(order.time),
+        "available": int(order.available),
+        "payload": order.payload,
+        "deadline": str(order.deadline),
+    }
+
+
+def rows():
+    now = datetime.utcnow()
+    return [
+        {
+            "order_id": 100000 + i,
+            "owner_id": 1000 + i % 50,
+            "market_id": 1,
+            "order_give_item": "gold",
+            "order_give_payload": {},
+            "order_give_amount": 10 + i % 7,
+            "order_available": 1 + i % 3,
+            "order_take_item": "sword",
+            "order_take_payload": {"level": i % 5},
+            "order_take_amount": 1,
+            "order_give_hash": "a" * 64,
+            "order_take_hash": "b" * 64,
+            "order_payload": {},
+            "order_time": now,
+            "order_deadline": now
+        }
+        for i in range(0, ROWS)
+    ]
+
+
+def measure(adapter, dump):
+    data = rows()
+
+    tracemalloc.start()
+    orders = list(map(adapter, data))
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    def listing():
+        return [dump(order) for order in map(adapter, data)]
+
+    seconds = min(timeit.repeat(listing, number=20, repeat=5)) / 20
+
+    del orders
+    return allocated / ROWS, seconds * 1000
+
+
+def main():
+    for name, adapter, dump in (
+            ("legacy", LegacyOrderAdapter, legacy_dump_order),
+            ("slots", OrderAdapter, MarketHandler.dump_order)):
+        per_row, ms = measure(adapter, dump)
+        print("{0:>8}: {1:8.1f} bytes per row, {2:6.2f} ms per {3} rows".format(name, per_row, ms, ROWS))
+
+
+if __name__ == "__main__":
+    main()
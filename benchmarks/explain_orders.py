@@ -0,0 +1,149 @@
+"""
+Checks that the hot `orders` queries are served by the indexes in their order, without a filesort.
+
+The `orders` table is (re)created in a scratch database from sql/orders.sql, filled with generated
+orders and analyzed, then every query shape below is EXPLAINed, as built by OrderQuery and OrderModel
+themselves. The script exits with a non-zero code if any of them needs a filesort. The matching queries
+and ascending listings sort by the amounts ascending and the order time descending, so they rely on
+descending index key parts (MySQL 8.0+).
+
+    python benchmarks/explain_orders.py --host 127.0.0.1 --user root --database market_explain
+"""
+
+from anthill.market.model.order import OrderQuery, OrderModel, OrderAdapter
+from anthill.market.model.item import ItemModel
+
+import argparse
+import os
+import pymysql
+import random
+import sys
+import ujson
+
+GAMESPACE_ID = 1
+MARKET_ID = 1
+ITEMS = ["gold", "silver", "sword", "shield", "potion", "gem"]
+
+SQL_PATH = os.path.join(os.path.dirname(__file__), "..", "anthill", "market", "sql", "orders.sql")
+
+
+def setup(conn, rows):
+    with open(SQL_PATH) as f:
+        schema = f.read()
+
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS `orders`;")
+        cursor.execute(schema)
+
+        rnd = random.Random(0)
+        batch = []
+
+        for i in range(0, rows):
+            give_item, take_item = rnd.sample(ITEMS, 2)
+            give_payload = {"level": rnd.randint(1, 5)} if give_item in ("sword", "shield") else {}
+            take_payload = {"level": rnd.randint(1, 5)} if take_item in ("sword", "shield") else {}
+
+            batch.append((
+                rnd.randint(1, 2), rnd.randint(1, 5000), rnd.randint(1, 3),
+                give_item, ujson.dumps(give_payload), rnd.randint(1, 100), rnd.randint(1, 10),
+                take_item, ujson.dumps(take_payload), rnd.randint(1, 100),
+                ItemModel.item_hash(give_item, give_payload), ItemModel.item_hash(take_item, take_payload)))
+
+            if len(batch) >= 1000 or i == rows - 1:
+                cursor.executemany(
+                    """
+                        INSERT INTO `orders`
+                        (`gamespace_id`, `owner_id`, `market_id`, `order_give_item`, `order_give_payload`,
+                            `order_give_amount`, `order_available`, `order_take_item`, `order_take_payload`,
+                            `order_take_amount`, `order_give_hash`, `order_take_hash`, `order_payload`,
+                            `order_time`, `order_deadline`)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, '{}',
+                            NOW() - INTERVAL FLOOR(RAND() * 86400) SECOND, NOW() + INTERVAL 1 DAY);
+                    """, batch)
+                batch = []
+
+        cursor.execute("ANALYZE TABLE `orders`;")
+        cursor.fetchall()
+
+    conn.commit()
+
+
+def order_query(**kwargs):
+    q = OrderQuery(GAMESPACE_ID, None, MARKET_ID)
+    q.limit = 100
+    for key, value in kwargs.items():
+        setattr(q, key, value)
+    return q.__build__()
+
+
+def fulfill_order(give_item, give_payload, give_amount, take_item, take_payload, take_amount):
+    return OrderAdapter({
+        "order_id": 1, "owner_id": 42, "market_id": MARKET_ID,
+        "order_give_item": give_item, "order_give_payload": give_payload, "order_give_amount": give_amount,
+        "order_available": 10,
+        "order_take_item": take_item, "order_take_payload": take_payload, "order_take_amount": take_amount
+    })
+
+
+def queries():
+    yield "market orders, newest first", order_query()
+    yield "owner orders, newest first", order_query(owner=42)
+
+    for sort_by in ("take_amount", "give_amount"):
+        for sort_desc in (True, False):
+            yield "pair by {0} {1}".format(sort_by, "desc" if sort_desc else "asc"), order_query(
+                give_item="gold", take_item="sword", sort_by=sort_by, sort_desc=sort_desc)
+
+    # the order being matched gives gold for a sword, so its counter-orders give swords for gold
+    fulfill = fulfill_order("gold", {}, 50, "sword", {"level": 3}, 10)
+
+    yield "fulfill, exact payloads", OrderModel.__exact_candidates_query__(GAMESPACE_ID, fulfill)
+    yield "fulfill, payload containment", OrderModel.__contained_candidates_query__(
+        GAMESPACE_ID, fulfill, [1, 2, 3])
+    yield "fulfill, lock", OrderModel.__lock_orders_query__(GAMESPACE_ID, [1, 2, 3])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3306)
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--database", default="market_explain")
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    conn = pymysql.connect(
+        host=args.host, port=args.port, user=args.user, password=args.password,
+        cursorclass=pymysql.cursors.DictCursor, autocommit=False)
+
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE DATABASE IF NOT EXISTS `{0}`;".format(args.database))
+        cursor.execute("SELECT VERSION() AS `version`;")
+        print("MySQL " + cursor.fetchone()["version"])
+
+    conn.select_db(args.database)
+    setup(conn, args.rows)
+
+    failed = 0
+
+    for name, (query, data) in queries():
+        with conn.cursor() as cursor:
+            cursor.execute("EXPLAIN " + query, data)
+            plan = cursor.fetchall()
+
+        extra = "; ".join(row["Extra"] or "" for row in plan)
+        keys = ", ".join(str(row["key"]) for row in plan)
+        ok = "Using filesort" not in extra
+
+        if not ok:
+            failed += 1
+
+        print("{0:>4} {1:<30} key: {2:<24} {3}".format("ok" if ok else "FAIL", name, keys, extra))
+
+    conn.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()